@@ -0,0 +1,83 @@
+# benchmarks/extract_json.py
+# Micro-benchmark: JSON extraction from model replies, today's _extract_json vs. the
+# previous regex fallback, over the agent outputs recorded in .sutra/runs.
+#
+#   python3 benchmarks/extract_json.py [runs_dir]
+#
+# Every recorded output is re-wrapped the way local models tend to reply (prose
+# around it, code fences, <think> blocks, single quotes, trailing commas); raw
+# replies that failed to parse at the time are included as-is.
+
+import json, pathlib, re, sys, time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+import sutra
+
+def legacy_extract_json(text):
+    try:
+        return json.loads(text)
+    except Exception:
+        pass
+    m = re.search(r'(\{.*?\}|\[.*?\])', text, re.DOTALL)
+    if not m: return None
+    try: return json.loads(m.group(1))
+    except: return None
+
+WRAPPERS = {
+    "plain":    lambda s, o: s,
+    "prose":    lambda s, o: f"Sure! Here is the JSON you asked for:\n{s}\nLet me know if you need anything else.",
+    "fenced":   lambda s, o: f"```json\n{s}\n```",
+    "think":    lambda s, o: f"<think>The user wants {{fields}} filled in, e.g. {{\"x\": 1}}.</think>\n{s}",
+    "quotes":   lambda s, o: repr(o).replace("True", "true").replace("False", "false").replace("None", "null"),
+    "trailing": lambda s, o: s[:-1].rstrip() + ",\n" + s[-1] if s[-1] in "}]" and len(s) > 2 else s,
+}
+
+def corpus(runs_dir):
+    sutra.RUNS_DIR = pathlib.Path(runs_dir)
+    seen = set()
+    for p in sorted(sutra.RUNS_DIR.iterdir()):
+        run_id = p.name if p.is_dir() else p.stem
+        try:
+            records = list(sutra.Trace.records(run_id))
+        except Exception:
+            continue
+        for rec in records:
+            for v in rec.get("out", {}).values():
+                key = json.dumps(v, sort_keys=True)
+                if key in seen: continue
+                seen.add(key)
+                if isinstance(v, dict) and v.get("error") == "invalid_json":
+                    yield "failed-raw", v.get("raw", ""), None
+                elif isinstance(v, (dict, list)) and "error" not in v:
+                    s = json.dumps(v, ensure_ascii=False, indent=2)
+                    for name, wrap in WRAPPERS.items():
+                        yield name, wrap(s, v), v
+
+def bench(fn, cases, rounds=20):
+    ok = {}
+    for kind, text, want in cases:
+        got = fn(text)
+        hit = got is not None if want is None else got == want
+        n, k = ok.get(kind, (0, 0)); ok[kind] = (n + 1, k + hit)
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        for _, text, _ in cases: fn(text)
+    us = (time.perf_counter() - t0) / (rounds * len(cases)) * 1e6
+    return ok, us
+
+def main():
+    runs_dir = sys.argv[1] if len(sys.argv) > 1 else ".sutra/runs"
+    cases = list(corpus(runs_dir))
+    if not cases:
+        print(f"No recorded outputs under {runs_dir}"); return
+    print(f"{len(cases)} replies from {runs_dir}\n")
+    results = {"regex (before)": bench(legacy_extract_json, cases),
+               "scanner (now)": bench(sutra._extract_json, cases)}
+    kinds = sorted({k for k, _, _ in cases})
+    print(f"{'':16}" + "".join(f"{k:>12}" for k in kinds) + f"{'total':>10}{'us/call':>10}")
+    for name, (ok, us) in results.items():
+        total = sum(k for _, k in ok.values()) / len(cases)
+        print(f"{name:16}" + "".join(f"{ok[k][1] / ok[k][0]:>12.0%}" for k in kinds) + f"{total:>10.0%}{us:>10.1f}")
+
+if __name__ == "__main__":
+    main()
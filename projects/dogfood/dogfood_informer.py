@@ -28,5 +28,6 @@ Return ONLY valid JSON matching the schema above.''',
     output_key='informer',
     required_keys=["full_name", "residence", "citizenships", "monthly_deposits_gbp", "risk_flags"],
     retries=1,
-    temperature=0.1
+    temperature=0.1,
+    shared_prefix=True
 )
@@ -5,7 +5,7 @@ reviewer = Agent(
     name='reviewer',
     objective='Apply UK Gambling Commission rules to the consolidated customer profile and output the compliance verdict.',
     model='qwen3:4b',
-    prompt='''You are the compliance reviewer. You receive the original case text plus structured attributes from the informer agent (available in {informer}).
+    prompt='''You are the compliance reviewer. You receive the original case text plus structured attributes from the informer agent.
 
 Assess affordability, source-of-funds risk, citizenship constraints, and any AML red flags. Produce JSON with this shape:
 {{
@@ -20,12 +20,17 @@ Rules:
 - Only cite breach_rules that are justified by the given facts.
 - recommended_actions should be actionable (e.g., "Request proof of income for last 3 months").
 
+Informer attributes: {informer}
+
 Input: {text}
 
 Return ONLY valid JSON matching the schema above.''',
     expects_json=True,
     output_key='reviewer',
     required_keys=["verdict", "summary", "breach_rules", "recommended_actions"],
+    types={"verdict": ["approve", "manual_review", "reject"], "summary": str,
+           "breach_rules": list, "recommended_actions": list},
     retries=1,
-    temperature=0.1
+    temperature=0.1,
+    shared_prefix=True
 )
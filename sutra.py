@@ -1,83 +1,1542 @@
 # sutra.py — SutraAI: Local-first agent workflows
-import argparse, importlib.util, json, pathlib, sys, time, types, urllib.request, urllib.error, subprocess
+import argparse, importlib.util, json, pathlib, re, string, sys, time, types, subprocess
+import atexit, contextlib, contextvars, http.client, os, queue, random, socket, threading, urllib.parse
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 # ---------- Trace ----------
 RUNS_DIR = pathlib.Path(".sutra") / "runs"
-RUNS_DIR.mkdir(parents=True, exist_ok=True)
+TRACE_LEVELS = ("off", "errors", "full")
+TRACE_LEVEL = "full"   # default level for Pipeline.run(trace=True)
+TRACE_SAMPLE = 1.0     # fraction of runs traced
+
+class _TraceWriter:
+    """One background thread appending trace lines to run files.
+
+    The queue is bounded, so producers block (rather than grow memory) when
+    the disk falls behind. flush() waits until everything queued is written.
+    """
+    def __init__(self, maxsize=1024):
+        self.q = queue.Queue(maxsize)
+        self._thread, self._lock, self._files = None, threading.Lock(), {}
+
+    def put(self, path, text, close=False):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="sutra-trace", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+        self.q.put((path, text, close))
+
+    def _loop(self):
+        while True:
+            path, text, close = self.q.get()
+            try:
+                f = self._files.get(path)
+                if f is None:
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    f = self._files[path] = open(path, "a", encoding="utf-8")
+                if text: f.write(text)
+                if close:
+                    self._files.pop(path).close()
+                    if RUN_STORE is not None: RUN_STORE.index(path)
+                elif self.q.empty(): f.flush()
+            except Exception as e:
+                print(f"trace write failed for {path}: {e}", file=sys.stderr)
+            finally:
+                self.q.task_done()
+
+    def flush(self):
+        if self._thread is not None: self.q.join()
+
+_TRACE_WRITER = _TraceWriter()
+
+def new_run_id()->str:
+    """Timestamp plus random suffix, so concurrent runs never share a trace."""
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{os.urandom(4).hex()}"
 
 class Trace:
+    """Delta-based run trace: one append-only JSONL file per run in RUNS_DIR.
+
+    Records are {"ev": "start", "state": initial}, then one {"ev": "step", ...}
+    per step holding the keys it took, the outputs it produced, its start
+    offset, duration and status, then {"ev": "end"}. level="errors" keeps the
+    records in memory and writes them only if some step failed. states()
+    rebuilds the full state after any step.
+    """
+    def __init__(self, level=None, run_id=None, pipeline=None):
+        self.level = level or TRACE_LEVEL
+        if self.level not in TRACE_LEVELS: raise ValueError(f"trace level must be one of {TRACE_LEVELS}")
+        self.id = run_id or new_run_id()
+        self.path = RUNS_DIR / f"{self.id}.jsonl"
+        self.pipeline, self.failed, self.skipped = pipeline, False, 0
+        self._t0, self._buf = time.time(), []
+
+    @classmethod
+    def open(cls, trace, **kw):
+        """Trace for Pipeline.run(trace=...): False/"off" or unsampled -> None, True -> TRACE_LEVEL."""
+        level = TRACE_LEVEL if trace is True else (trace or "off")
+        if level == "off" or random.random() >= TRACE_SAMPLE: return None
+        return cls(level, **kw)
+
+    def _emit(self, rec, close=False):
+        line = json.dumps(rec, ensure_ascii=False, default=str) + "\n"
+        if self.level == "full":
+            _TRACE_WRITER.put(self.path, line, close)
+        else:
+            self._buf.append(line)
+            if close and self.failed: _TRACE_WRITER.put(self.path, "".join(self._buf), True)
+
+    def start(self, state):
+        self._emit({"ev": "start", "run": self.id, "pipeline": self.pipeline, "ts": self._t0, "state": state})
+
+    def step(self, idx, st, out, t0, error=None, status=None):
+        status = status or ("exception" if error else (
+            "error" if any(isinstance(v, dict) and "error" in v for v in out.values()) else "ok"))
+        self.failed |= status in ("error", "exception")
+        self.skipped += status == "skipped"
+        rec = {"ev": "step", "idx": idx, "step": st.agent.name, "model": getattr(st.agent, "model", None),
+               "takes": st.takes, "out": out,
+               "t": round(t0 - self._t0, 6), "dur": round(time.time() - t0, 6), "status": status}
+        if error: rec["error"] = error
+        self._emit(rec)
+
+    def end(self, status="ok"):
+        self.failed |= status != "ok"
+        self._emit({"ev": "end", "dur": round(time.time() - self._t0, 6), "status": status,
+                    "skipped": self.skipped}, close=True)
+
+    @staticmethod
+    def flush():
+        """Block until every queued trace record is on disk."""
+        _TRACE_WRITER.flush()
+
+    @staticmethod
+    def records(run_id):
+        """Yield the start and step records of a run. Older one-file-per-snapshot
+        run directories are converted on the fly (step outputs diffed out)."""
+        _TRACE_WRITER.flush()
+        p = RUNS_DIR / run_id
+        if p.is_dir():
+            first = min(p.glob("*_in.json"), default=None)
+            prev = json.loads(first.read_text(encoding="utf-8")) if first else {}
+            yield {"ev": "start", "state": prev}
+            for f in sorted(p.glob("*_out.json")):
+                cur = json.loads(f.read_text(encoding="utf-8"))
+                out = {k: v for k, v in cur.items() if prev.get(k, f) != v}
+                err = any(isinstance(v, dict) and "error" in v for v in out.values())
+                yield {"ev": "step", "step": f.stem.split("_", 1)[1][:-len("_out")], "out": out,
+                       "status": "error" if err else "ok"}
+                prev = cur
+            return
+        if not p.suffix: p = p.with_suffix(".jsonl")
+        if not p.exists():
+            store = RUN_STORE or (RunStore() if _runs_db().exists() else None)
+            if store is not None and store.has(run_id):
+                yield from store.records(run_id); return
+            raise FileNotFoundError(f"No trace for run {run_id!r} in {RUNS_DIR}")
+        with open(p, encoding="utf-8") as f:
+            for line in f:
+                rec = json.loads(line)
+                if rec["ev"] in ("start", "step"): yield rec
+
+    @staticmethod
+    def run_ids()->list:
+        """Every recorded run: trace files in RUNS_DIR plus runs compacted into the run store."""
+        ids = [p.stem if p.suffix == ".jsonl" else p.name for p in sorted(RUNS_DIR.glob("*"))
+               if p.is_dir() or p.suffix == ".jsonl"] if RUNS_DIR.exists() else []
+        store = RUN_STORE or (RunStore() if _runs_db().exists() else None)
+        if store is not None: ids += [r for r in store.compacted() if r not in set(ids)]
+        return sorted(ids)
+
+    @staticmethod
+    def states(run_id):
+        """Yield (step name, full state after it), starting with ("<start>", initial)."""
+        state = {}
+        for rec in Trace.records(run_id):
+            if rec["ev"] == "start":
+                state = dict(rec["state"]); yield "<start>", dict(state)
+            else:
+                state.update(rec["out"]); yield rec["step"], dict(state)
+
+    @staticmethod
+    def load(run_id):
+        """Return (initial state, {step name: (outputs, status)}) for a recorded run."""
+        initial, steps = {}, {}
+        for rec in Trace.records(run_id):
+            if rec["ev"] == "start": initial = rec["state"]
+            else: steps[rec["step"]] = (rec["out"], rec["status"])
+        return initial, steps
+
+# ---------- Run store ----------
+def _runs_db():
+    return RUNS_DIR.parent / "runs.db"
+
+def _hash(v)->str:
+    import hashlib
+    return hashlib.sha256(json.dumps(v, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()[:16]
+
+def _seconds(text)->float:
+    """"90", "45m", "12h", "7d" or "2w" in seconds."""
+    m = re.fullmatch(r"\s*([\d.]+)\s*([smhdw]?)\s*", str(text))
+    if not m: raise ValueError(f"bad duration {text!r} (e.g. 12h, 7d)")
+    return float(m.group(1)) * {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}[m.group(2)]
+
+def _nbytes(text)->int:
+    """"500000", "200K", "500MB" or "2G" in bytes."""
+    m = re.fullmatch(r"\s*([\d.]+)\s*([kmgt]?)i?b?\s*", str(text).lower())
+    if not m: raise ValueError(f"bad size {text!r} (e.g. 500MB, 2G)")
+    return int(float(m.group(1)) * 1024 ** " kmgt".index(m.group(2) or " "))
+
+def _run_time(run_id):
+    """Start time encoded in a run id ("20250921-143005[-suffix]", local time), or None."""
+    m = re.match(r"(\d{8}-\d{6})(?:\D|$)", run_id)
+    if not m: return None
+    try:
+        return time.mktime(time.strptime(m.group(1), "%Y%m%d-%H%M%S"))
+    except ValueError:
+        return None
+
+class RunStore:
+    """SQLite index over run traces (.sutra/runs.db).
+
+    index() reads a trace into a runs row (pipeline, start, duration, status,
+    input hash) and one steps row per step (step, model, status, offset,
+    duration, input/output hashes, zlib-compressed outputs), so runs can be
+    queried without parsing files. compact() moves finished traces older than
+    a cutoff entirely into the database and deletes their files; records()
+    rebuilds them, so resume and replay keep working. prune() applies
+    retention: a maximum age and total size, optionally keeping failed runs.
+    """
+    def __init__(self, path=None):
+        import sqlite3
+        self.path = pathlib.Path(path or _runs_db())
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (run_id TEXT PRIMARY KEY, pipeline TEXT, ts REAL, dur REAL,
+                status TEXT, steps INTEGER, errors INTEGER, in_hash TEXT, state BLOB, size INTEGER,
+                mtime REAL, compacted INTEGER DEFAULT 0);
+            CREATE TABLE IF NOT EXISTS steps (run_id TEXT, idx INTEGER, step TEXT, model TEXT, status TEXT,
+                t REAL, dur REAL, takes TEXT, keys TEXT, in_hash TEXT, out_hash TEXT, out BLOB, error TEXT,
+                PRIMARY KEY (run_id, idx));
+            CREATE INDEX IF NOT EXISTS runs_ts ON runs(ts);
+            CREATE INDEX IF NOT EXISTS runs_pipeline ON runs(pipeline, ts);
+            CREATE INDEX IF NOT EXISTS steps_step ON steps(step, status);
+            CREATE INDEX IF NOT EXISTS steps_dur ON steps(dur);""")
+        # Rows indexed before run-id times were used took the file's mtime as their start time.
+        with self._tx() as db:
+            fix = [(t, r) for r, ts, mt in db.execute("SELECT run_id, ts, mtime FROM runs WHERE ts = mtime")
+                   for t in [_run_time(r)] if t and t != ts]
+            db.executemany("UPDATE runs SET ts=? WHERE run_id=?", fix)
+
+    @contextlib.contextmanager
+    def _tx(self):
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK"); raise
+            self._db.execute("COMMIT")
+
+    def has(self, run_id)->bool:
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM runs WHERE run_id=?", (run_id,)).fetchone() is not None
+
+    def compacted(self)->list:
+        with self._lock:
+            return [r for r, in self._db.execute("SELECT run_id FROM runs WHERE compacted=1")]
+
+    def index(self, path)->bool:
+        """(Re)index the trace at path (a JSONL file or a legacy run directory);
+        False when it is unchanged since the last index."""
+        import zlib
+        path = pathlib.Path(path)
+        run_id = path.stem if path.suffix == ".jsonl" else path.name
+        mtime = path.stat().st_mtime if path.exists() else None
+        with self._lock:
+            row = self._db.execute("SELECT mtime FROM runs WHERE run_id=?", (run_id,)).fetchone()
+        if row and row[0] == mtime: return False
+        start, end, steps = {}, None, []
+        if path.is_dir():
+            recs = Trace.records(run_id)
+        else:
+            with open(path, encoding="utf-8") as f: recs = [json.loads(line) for line in f if line.strip()]
+        for rec in recs:
+            if rec["ev"] == "start": start = rec
+            elif rec["ev"] == "step": steps.append(rec)
+            elif rec["ev"] == "end": end = rec
+        state, rows, size = dict(start.get("state") or {}), [], 0
+        for n, rec in enumerate(steps):
+            keys = list(dict.fromkeys(t.split(".", 1)[0] for t in rec.get("takes") or []))
+            ins = {k: state.get(k) for k in keys} if keys else state
+            blob = zlib.compress(json.dumps(rec["out"], ensure_ascii=False, default=str).encode("utf-8"))
+            size += len(blob)
+            rows.append((run_id, rec.get("idx", n), rec["step"], rec.get("model"), rec.get("status"), rec.get("t"),
+                         rec.get("dur"), json.dumps(rec.get("takes") or []), "," + ",".join(rec["out"]) + ",",
+                         _hash(ins), _hash(rec["out"]), blob, rec.get("error")))
+            state.update(rec["out"])
+        blob = zlib.compress(json.dumps(start.get("state") or {}, ensure_ascii=False, default=str).encode("utf-8"))
+        errors = sum(r[4] in ("error", "exception") for r in rows)
+        status = end["status"] if end else ("running" if path.suffix == ".jsonl" else "ok")
+        if status == "ok" and errors: status = "error"
+        # Legacy traces have no ts; their files' mtimes are only checkout or copy times.
+        ts = start.get("ts") or _run_time(run_id) or (path.stat().st_mtime if path.exists() else time.time())
+        with self._tx() as db:
+            db.execute("DELETE FROM steps WHERE run_id=?", (run_id,))
+            db.execute("INSERT OR REPLACE INTO runs VALUES (?,?,?,?,?,?,?,?,?,?,?,0)",
+                       (run_id, start.get("pipeline"), ts, end["dur"] if end else None, status, len(rows),
+                        errors, _hash(start.get("state") or {}), blob, size + len(blob), mtime))
+            db.executemany("INSERT INTO steps VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)", rows)
+        return True
+
+    def sync(self)->int:
+        """Index every trace in RUNS_DIR that is new or changed; returns how many."""
+        Trace.flush()
+        if not RUNS_DIR.exists(): return 0
+        return sum(self.index(p) for p in sorted(RUNS_DIR.iterdir()) if p.is_dir() or p.suffix == ".jsonl")
+
+    def records(self, run_id):
+        """The start and step records of an indexed run, as Trace.records() yields them."""
+        import zlib
+        with self._lock:
+            row = self._db.execute("SELECT pipeline, ts, state FROM runs WHERE run_id=?", (run_id,)).fetchone()
+            steps = self._db.execute("SELECT idx, step, model, takes, out, t, dur, status, error FROM steps"
+                                     " WHERE run_id=? ORDER BY t, idx", (run_id,)).fetchall()
+        if row is None: raise FileNotFoundError(f"No run {run_id!r} in {self.path}")
+        yield {"ev": "start", "run": run_id, "pipeline": row[0], "ts": row[1],
+               "state": json.loads(zlib.decompress(row[2]))}
+        for idx, step, model, takes, out, t, dur, status, error in steps:
+            rec = {"ev": "step", "idx": idx, "step": step, "model": model, "takes": json.loads(takes),
+                   "out": json.loads(zlib.decompress(out)), "t": t, "dur": dur, "status": status}
+            if error: rec["error"] = error
+            yield rec
+
+    def query(self, pipeline=None, step=None, status=None, since=None, where=None, run_id=None,
+              order="ts", limit=50)->list:
+        """Matching runs, or steps when step or where is given, newest first
+        (order="dur" for slowest first). where is {"output.path": value}: a
+        step matches when the value at the dotted path of its outputs equals
+        value (any item, through lists)."""
+        by_step = bool(step or where)
+        sql, args = (["SELECT s.run_id, r.pipeline, r.ts + COALESCE(s.t, 0), s.step, s.model, s.status, s.dur,"
+                      " s.in_hash, s.out_hash, s.out FROM steps s JOIN runs r USING (run_id) WHERE 1=1"]
+                     if by_step else ["SELECT run_id, pipeline, ts, steps, errors, status, dur, in_hash, size"
+                                      " FROM runs r WHERE 1=1"]), []
+        for col, v in (("r.pipeline", pipeline), ("s.step", step), ("r.run_id", run_id)):
+            if v is not None: sql.append(f"AND {col}=?"); args.append(v)
+        if status is not None: sql.append("AND s.status=?" if by_step else "AND r.status=?"); args.append(status)
+        if since is not None: sql.append("AND r.ts>=?"); args.append(since)
+        for path in where or {}:
+            sql.append("AND s.keys LIKE ?"); args.append(f"%,{path.split('.', 1)[0]},%")
+        sql.append("ORDER BY " + ("s.dur" if by_step else "r.dur") + " DESC" if order == "dur" else
+                   "ORDER BY r.ts DESC" + (", s.t DESC" if by_step else ""))
+        with self._lock:
+            rows = self._db.execute(" ".join(sql), args).fetchall()
+        import zlib
+        out = []
+        for r in rows:
+            if not by_step:
+                out.append(dict(zip(("run_id", "pipeline", "ts", "steps", "errors", "status", "dur", "in_hash",
+                                     "size"), r)))
+            else:
+                rec = dict(zip(("run_id", "pipeline", "ts", "step", "model", "status", "dur", "in_hash",
+                                "out_hash"), r[:9]))
+                if where:
+                    outs = json.loads(zlib.decompress(r[9]))
+                    if not all(_matches(outs, p.split("."), v) for p, v in where.items()): continue
+                    rec["out"] = outs
+                out.append(rec)
+            if limit and len(out) >= limit: break
+        return out
+
+    def compact(self, older_than=86400.0)->int:
+        """Move runs that started more than older_than seconds ago into the
+        database and delete their trace files; returns how many. A run with no
+        end record is left alone until its file is that old too ("incomplete")."""
+        self.sync()
+        cutoff = time.time() - older_than
+        with self._lock:
+            ids = [r for r, in self._db.execute("SELECT run_id FROM runs WHERE compacted=0 AND ts<?"
+                                                " AND (status!='running' OR mtime<?)", (cutoff, cutoff))]
+        for run_id in ids:
+            with self._lock:
+                self._db.execute("UPDATE runs SET compacted=1, mtime=NULL, status=CASE status WHEN 'running'"
+                                 " THEN 'incomplete' ELSE status END WHERE run_id=?", (run_id,))
+            _remove_trace(run_id)
+        return len(ids)
+
+    def prune(self, max_age=None, max_bytes=None, keep_errors=True)->int:
+        """Delete runs older than max_age seconds, then the oldest runs until the
+        store holds at most max_bytes of payload; failed runs are kept when
+        keep_errors. Returns how many runs were deleted."""
+        keep = " AND status NOT IN ('error', 'exception')" if keep_errors else ""
+        cutoff = time.time() - max_age if max_age is not None else None
+        with self._lock:
+            total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM runs").fetchone()[0]
+            rows = self._db.execute(f"SELECT run_id, ts, size FROM runs WHERE status!='running'{keep}"
+                                    " ORDER BY ts").fetchall()
+        doomed = []
+        for r, ts, size in rows:   # oldest first
+            if (cutoff is not None and ts < cutoff) or (max_bytes is not None and total > max_bytes):
+                doomed.append(r); total -= size
+        with self._tx() as db:
+            db.executemany("DELETE FROM steps WHERE run_id=?", [(r,) for r in doomed])
+            db.executemany("DELETE FROM runs WHERE run_id=?", [(r,) for r in doomed])
+        for r in doomed: _remove_trace(r)
+        return len(doomed)
+
+    def stats(self)->dict:
+        with self._lock:
+            n, c, size, err = self._db.execute("SELECT COUNT(*), COALESCE(SUM(compacted), 0), COALESCE(SUM(size), 0),"
+                                               " COALESCE(SUM(status IN ('error', 'exception')), 0) FROM runs").fetchone()
+        return {"runs": n, "compacted": c, "errors": err, "bytes": size}
+
+def _remove_trace(run_id):
+    import shutil
+    p = RUNS_DIR / run_id
+    if p.is_dir(): shutil.rmtree(p, ignore_errors=True)
+    else: p.with_suffix(".jsonl").unlink(missing_ok=True)
+
+def _matches(v, path, want)->bool:
+    """True when the value at path in v (through lists) equals want, compared as text."""
+    if isinstance(v, list): return any(_matches(x, path, want) for x in v)
+    if not path: return str(v) == str(want) or (isinstance(v, bool) and str(v).lower() == str(want).lower())
+    return isinstance(v, dict) and path[0] in v and _matches(v[path[0]], path[1:], want)
+
+RUN_STORE = None  # when set, traces are indexed as they close and retention runs in the background
+
+def set_run_store(on=True, path=None, max_age=None, max_bytes=None, keep_errors=True,
+                  compact_after=86400.0, interval=600.0):
+    """Index runs as they finish and, every interval seconds, compact runs older
+    than compact_after and apply the retention policy (see RunStore.prune)."""
+    global RUN_STORE
+    RUN_STORE = RunStore(path) if on else None
+    store = RUN_STORE
+    def maintain():
+        while RUN_STORE is store:
+            try:
+                store.compact(compact_after); store.prune(max_age, max_bytes, keep_errors)
+            except Exception as e:
+                print(f"run store maintenance failed: {e}", file=sys.stderr)
+            time.sleep(interval)
+    if store is not None:
+        threading.Thread(target=maintain, name="sutra-runs", daemon=True).start()
+    return store
+
+# ---------- Spans ----------
+HOOKS = []   # process-wide span hooks, called as hook(span_dict) when a span ends
+_SPAN = contextvars.ContextVar("sutra_span", default=None)
+
+class Span:
+    """A timed operation (pipeline run, step, agent call, generation) in the
+    OpenTelemetry span shape. Used as a context manager it becomes the parent of
+    spans opened inside it; when it ends, to_dict() goes to every hook of its
+    ancestors, its own hooks and HOOKS. Token and model-call counts roll up to
+    the parent."""
+    _ROLLUP = ("gen_ai.usage.input_tokens", "gen_ai.usage.output_tokens", "sutra.model_calls", "sutra.skipped",
+               "sutra.model_wait_ms")
+    _INHERIT = ("sutra.pipeline", "sutra.run_id", "sutra.step", "sutra.agent")
+
+    def __init__(self, name, kind="internal", hooks=(), attrs=None):
+        parent = self.parent = _SPAN.get()
+        self.trace_id = parent.trace_id if parent else f"{random.getrandbits(128):032x}"
+        self.span_id, self.name, self.kind = f"{random.getrandbits(64):016x}", name, kind
+        self.hooks = (parent.hooks if parent else tuple(HOOKS)) + tuple(hooks or ())
+        self.attrs, self.status, self.message = dict(attrs or {}), "OK", None
+        if parent:
+            for k in self._INHERIT:
+                if k in parent.attrs: self.attrs.setdefault(k, parent.attrs[k])
+        self.start, self.end = time.time_ns(), None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def add(self, counts):
+        for k, v in counts.items():
+            if v: self.attrs[k] = self.attrs.get(k, 0) + v
+
+    def __enter__(self):
+        self._token = _SPAN.set(self); return self
+
+    def __exit__(self, et, e, tb):
+        _SPAN.reset(self._token)
+        if e is not None: self.status, self.message = "ERROR", f"{et.__name__}: {e}"
+        self.finish()
+
+    def finish(self):
+        self.end = time.time_ns()
+        if self.parent: self.parent.add({k: self.attrs.get(k) for k in self._ROLLUP})
+        if not self.hooks: return
+        d = self.to_dict()
+        for hook in self.hooks:
+            try: hook(d)
+            except Exception as e: print(f"span hook {hook!r} failed: {e}", file=sys.stderr)
+
+    def to_dict(self)->dict:
+        return {"trace_id": self.trace_id, "span_id": self.span_id,
+                "parent_span_id": self.parent.span_id if self.parent else None,
+                "name": self.name, "kind": self.kind,
+                "start_time_unix_nano": self.start, "end_time_unix_nano": self.end,
+                "attributes": self.attrs, "status": {"code": self.status, "message": self.message}}
+
+def add_hook(hook):
+    """Register a process-wide span hook (e.g. JsonlExporter, Metrics); returns it."""
+    HOOKS.append(hook); return hook
+
+def _in_context(fn):
+    """fn bound to a copy of the current context, so spans opened on another thread nest."""
+    ctx = contextvars.copy_context()
+    return lambda *a, **kw: ctx.run(fn, *a, **kw)
+
+class JsonlExporter:
+    """Span hook appending one JSON line per finished span to path."""
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+    def __call__(self, span):
+        _TRACE_WRITER.put(self.path, json.dumps(span, ensure_ascii=False, default=str) + "\n")
+
+class Metrics:
+    """Span hook aggregating steps and generations into counters and latency
+    histograms; prometheus() renders them in the Prometheus text format."""
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
     def __init__(self):
-        ts = time.strftime("%Y%m%d-%H%M%S")
-        self.d = RUNS_DIR / ts
-        self.d.mkdir(parents=True, exist_ok=True)
-        self.i = 0
-    def dump(self, name, payload):
-        self.i += 1
-        (self.d / f"{self.i:02d}_{name}.json").write_text(
-            json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8"
-        )
+        self._lock, self._hist, self._count = threading.Lock(), {}, {}
 
-# ---------- Ollama ----------
-class Ollama:
-    def __init__(self, model="llama3.1:latest", host="http://localhost:11434"):
-        self.model, self.host = model, host.rstrip("/")
-
-    def generate(self, prompt, temperature=0.2, json_mode=False, timeout=120):
-        url = f"{self.host}/api/generate"
-        payload = {"model": self.model, "prompt": prompt, "temperature": temperature, "stream": False}
-        if json_mode: payload["format"] = "json"
-        data = json.dumps(payload).encode("utf-8")
-        req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    def _observe(self, name, labels, v):
+        key = (name, tuple(sorted(labels.items())))
+        h = self._hist.get(key)
+        if h is None: h = self._hist[key] = [[0] * len(self.BUCKETS), 0, 0.0]
+        for i, b in enumerate(self.BUCKETS):
+            if v <= b: h[0][i] += 1
+        h[1] += 1; h[2] += v
+
+    def _inc(self, name, labels, v=1):
+        if v:
+            key = (name, tuple(sorted(labels.items())))
+            self._count[key] = self._count.get(key, 0) + v
+
+    def __call__(self, span):
+        a, dur = span["attributes"], (span["end_time_unix_nano"] - span["start_time_unix_nano"]) / 1e9
+        with self._lock:
+            if span["kind"] == "step":
+                labels = {"pipeline": a.get("sutra.pipeline") or "", "step": a.get("sutra.step", ""),
+                          "status": a.get("sutra.status", "ok")}
+                self._inc("sutra_steps_total", labels)
+                self._observe("sutra_step_duration_seconds", {k: labels[k] for k in ("pipeline", "step")}, dur)
+            elif span["kind"] == "agent":
+                labels = {"agent": a.get("sutra.agent", ""), "model": a.get("gen_ai.request.model", "")}
+                self._inc("sutra_agent_retries_total", labels, a.get("sutra.retries", 0))
+                self._inc("sutra_agent_parse_failures_total", labels, a.get("sutra.parse_failures", 0))
+                self._inc("sutra_agent_hedges_total", labels, a.get("sutra.hedges", 0))
+                self._inc("sutra_agent_hedge_wins_total", labels, a.get("sutra.hedge_wins", 0))
+                self._inc("sutra_agent_escalations_total", labels, a.get("sutra.escalations", 0))
+                if a.get("sutra.served_model"):
+                    self._inc("sutra_agent_served_total", dict(labels, model=a["sutra.served_model"]))
+                self._inc("sutra_agent_prompt_tokens_est_total", labels, a.get("sutra.prompt_tokens_est", 0))
+                self._inc("sutra_agent_truncations_total", labels, bool(a.get("sutra.truncated")))
+            elif span["kind"] == "client":
+                labels = {"agent": a.get("sutra.agent") or "", "model": a.get("gen_ai.request.model", "")}
+                self._inc("sutra_generations_total", dict(labels, status=span["status"]["code"].lower()))
+                self._observe("sutra_generation_duration_seconds", labels, dur)
+                self._inc("sutra_input_tokens_total", labels, a.get("gen_ai.usage.input_tokens", 0))
+                self._inc("sutra_output_tokens_total", labels, a.get("gen_ai.usage.output_tokens", 0))
+                self._inc("sutra_queue_seconds_total", labels, a.get("sutra.queue_ms", 0) / 1000)
+                self._inc("sutra_model_load_seconds_total", labels, a.get("sutra.load_ms", 0) / 1000)
+                self._inc("sutra_prefix_tokens_saved_total", labels, a.get("sutra.prefix_tokens_saved", 0))
+                self._inc("sutra_prompt_eval_saved_seconds_total", labels, a.get("sutra.prompt_eval_saved_ms", 0) / 1000)
+
+    def prometheus(self)->str:
+        fmt = lambda labels: "{" + ",".join(f'{k}="{str(v).replace(chr(34), chr(39))}"' for k, v in labels) + "}"
+        out, seen = [], set()
+        with self._lock:
+            for (name, labels), v in sorted(self._count.items()):
+                if name not in seen: seen.add(name); out.append(f"# TYPE {name} counter")
+                out.append(f"{name}{fmt(labels)} {v:g}")
+            for (name, labels), (buckets, n, total) in sorted(self._hist.items()):
+                if name not in seen: seen.add(name); out.append(f"# TYPE {name} histogram")
+                for b, c in zip(self.BUCKETS, buckets):
+                    out.append(f"{name}_bucket{fmt(labels + (('le', f'{b:g}'),))} {c}")
+                out.append(f"{name}_bucket{fmt(labels + (('le', '+Inf'),))} {n}")
+                out.append(f"{name}_sum{fmt(labels)} {total:.6f}")
+                out.append(f"{name}_count{fmt(labels)} {n}")
+        return "\n".join(out) + "\n"
+
+class PrometheusExporter(Metrics):
+    """Metrics that rewrite a node_exporter text-file collector file at most
+    every `interval` seconds, and once more at exit."""
+    def __init__(self, path, interval=10.0):
+        super().__init__()
+        self.path, self.interval, self._written = pathlib.Path(path), interval, 0.0
+        self._wlock = threading.Lock()
+        atexit.register(self.write)
+
+    def __call__(self, span):
+        super().__call__(span)
+        if time.monotonic() - self._written >= self.interval: self.write()
+
+    def write(self):
+        with self._wlock:
+            self._written = time.monotonic()
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_name(self.path.name + f".{os.getpid()}.tmp")
+            tmp.write_text(self.prometheus(), encoding="utf-8")
+            os.replace(tmp, self.path)
+
+# ---------- Model gate ----------
+class _ModelGate:
+    """Caps concurrent generations per model; limit=None means unlimited."""
+    def __init__(self, limit=None):
+        self.limit = limit
+        self._sems, self._lock = {}, threading.Lock()
+    @contextlib.contextmanager
+    def slot(self, model):
+        n = self.limit
+        if not n:
+            yield; return
+        with self._lock:
+            sem = self._sems.get((model, n))
+            if sem is None: sem = self._sems[(model, n)] = threading.BoundedSemaphore(n)
+        with sem:
+            yield
+
+MODEL_GATE = _ModelGate()
+_MODEL_GATE = contextvars.ContextVar("sutra_model_gate", default=None)   # set per item by run_many(per_model=...)
+
+def _gate():
+    return _MODEL_GATE.get() or MODEL_GATE
+
+# ---------- HTTP ----------
+HTTP_POOL_SIZE = 8        # idle keep-alive connections kept per host
+HTTP_IDLE_TIMEOUT = 60.0  # seconds before an idle connection is discarded
+
+class _HttpPool:
+    """Thread-safe pool of persistent keep-alive connections to one host."""
+    _STALE = (http.client.RemoteDisconnected, http.client.BadStatusLine, BrokenPipeError, ConnectionResetError)
+
+    def __init__(self, host, size=None, idle_timeout=None):
+        u = urllib.parse.urlsplit(host if "://" in host else f"http://{host}")
+        self.https, self.netloc, self.base = u.scheme == "https", u.netloc, u.path.rstrip("/")
+        self.size = HTTP_POOL_SIZE if size is None else size
+        self.idle_timeout = HTTP_IDLE_TIMEOUT if idle_timeout is None else idle_timeout
+        self.stats = {"opened": 0, "reused": 0, "failed": 0}
+        self._idle, self._lock = [], threading.Lock()
+
+    def _get(self, timeout):
+        now = time.monotonic()
+        with self._lock:
+            while self._idle:
+                conn, used = self._idle.pop()
+                if now - used > self.idle_timeout:
+                    conn.close(); continue
+                self.stats["reused"] += 1
+                conn.timeout = timeout
+                if conn.sock: conn.sock.settimeout(timeout)
+                return conn, True
+            self.stats["opened"] += 1
+        cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        return cls(self.netloc, timeout=timeout), False
+
+    def _put(self, conn):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((conn, time.monotonic())); return
+        conn.close()
+
+    def _fail(self, conn):
+        conn.close()
+        with self._lock: self.stats["failed"] += 1
+
+    @contextlib.contextmanager
+    def open(self, method, path, body=None, timeout=120):
+        """Yield the http.client response. The connection goes back to the pool only
+        if the body was read to the end; otherwise it is closed."""
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        for attempt in (0, 1):
+            conn, reused = self._get(timeout)
+            try:
+                if conn.sock is None:
+                    try: conn.connect()
+                    except TimeoutError as e: raise ConnectionError(f"connect to {self.netloc} timed out") from e
+                conn.request(method, self.base + path, body=body, headers=headers)
+                resp = conn.getresponse()
+                break
+            except self._STALE:
+                # A reused socket the server already closed: retry once on a fresh one.
+                if reused and attempt == 0:
+                    conn.close(); continue
+                self._fail(conn); raise
+            except BaseException:
+                self._fail(conn); raise
         try:
-            with urllib.request.urlopen(req, timeout=timeout) as r:
-                body = r.read().decode("utf-8")
-        except urllib.error.HTTPError as e:
+            yield resp
+        except BaseException:
+            conn.close(); raise
+        if resp.isclosed() and not resp.will_close: self._put(conn)
+        else: conn.close()
+
+    def request(self, method, path, body=None, timeout=120):
+        """Send one request and return (status, body bytes)."""
+        with self.open(method, path, body, timeout) as r:
+            return r.status, r.read()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle: conn.close()
+
+_POOLS, _POOLS_LOCK = {}, threading.Lock()
+
+def http_pool(host)->_HttpPool:
+    """Process-wide connection pool for host, shared by every Ollama client."""
+    key = host.rstrip("/")
+    with _POOLS_LOCK:
+        pool = _POOLS.get(key)
+        if pool is None: pool = _POOLS[key] = _HttpPool(key)
+        return pool
+
+def configure_http(pool_size=None, idle_timeout=None):
+    """Change pool size / idle timeout for new and existing pools."""
+    global HTTP_POOL_SIZE, HTTP_IDLE_TIMEOUT
+    if pool_size is not None: HTTP_POOL_SIZE = pool_size
+    if idle_timeout is not None: HTTP_IDLE_TIMEOUT = idle_timeout
+    with _POOLS_LOCK:
+        for pool in _POOLS.values():
+            pool.size, pool.idle_timeout = HTTP_POOL_SIZE, HTTP_IDLE_TIMEOUT
+
+def http_stats()->dict:
+    """Per-host counters: connections opened, reused, failed, and currently idle."""
+    with _POOLS_LOCK:
+        return {h: dict(p.stats, idle=len(p._idle)) for h, p in _POOLS.items()}
+
+class _AsyncResponse:
+    """HTTP/1.1 response read from asyncio streams (Content-Length, chunked or until EOF)."""
+    def __init__(self, reader, status, headers):
+        self.reader, self.status, self.headers = reader, status, headers
+        self.complete = False
+        self.keep_alive = headers.get("connection", "").lower() != "close"
+
+    async def chunks(self):
+        r, h = self.reader, self.headers
+        if "chunked" in h.get("transfer-encoding", "").lower():
+            while True:
+                size = int((await r.readline()).split(b";")[0].strip() or b"0", 16)
+                if size == 0:
+                    while (await r.readline()).strip(): pass  # trailers
+                    break
+                yield await r.readexactly(size)
+                await r.readexactly(2)
+        elif "content-length" in h:
+            n = int(h["content-length"])
+            if n: yield await r.readexactly(n)
+        else:
+            self.keep_alive = False
+            while True:
+                b = await r.read(65536)
+                if not b: break
+                yield b
+        self.complete = True
+
+    async def read(self)->bytes:
+        return b"".join([c async for c in self.chunks()])
+
+    async def lines(self):
+        buf = b""
+        async for c in self.chunks():
+            buf += c
+            *done, buf = buf.split(b"\n")
+            for line in done: yield line
+        if buf: yield buf
+
+class _AsyncHttp:
+    """Keep-alive HTTP/1.1 client for one host on asyncio streams; one instance per event loop."""
+    def __init__(self, host, size=None):
+        u = urllib.parse.urlsplit(host if "://" in host else f"http://{host}")
+        self.ssl, self.hostname, self.base = u.scheme == "https", u.hostname, u.path.rstrip("/")
+        self.port = u.port or (443 if self.ssl else 80)
+        self.netloc, self.size = u.netloc, HTTP_POOL_SIZE if size is None else size
+        self.stats = {"opened": 0, "reused": 0, "failed": 0}
+        self._idle = []
+
+    async def _conn(self):
+        import asyncio
+        while self._idle:
+            reader, writer, used = self._idle.pop()
+            if time.monotonic() - used <= HTTP_IDLE_TIMEOUT and not reader.at_eof() and not writer.is_closing():
+                self.stats["reused"] += 1
+                return reader, writer, True
+            writer.close()
+        self.stats["opened"] += 1
+        reader, writer = await asyncio.open_connection(self.hostname, self.port, ssl=self.ssl or None)
+        return reader, writer, False
+
+    @contextlib.asynccontextmanager
+    async def open(self, method, path, body=None):
+        """Yield an _AsyncResponse; the connection is pooled again only if the body was read to the end."""
+        head = f"{method} {self.base}{path} HTTP/1.1\r\nHost: {self.netloc}\r\nConnection: keep-alive\r\n"
+        if body is not None:
+            head += f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+        for attempt in (0, 1):
+            reader, writer, reused = await self._conn()
+            try:
+                writer.write(head.encode("latin-1") + b"\r\n" + (body or b""))
+                await writer.drain()
+                status_line = await reader.readline()
+                if not status_line: raise ConnectionResetError("server closed the connection")
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode("latin-1").strip()
+                    if not line: break
+                    k, _, v = line.partition(":")
+                    headers[k.strip().lower()] = v.strip()
+                break
+            except (ConnectionError, OSError) as e:
+                writer.close()
+                if reused and attempt == 0: continue  # stale keep-alive socket
+                self.stats["failed"] += 1; raise
+            except BaseException:
+                writer.close(); self.stats["failed"] += 1; raise
+        resp = _AsyncResponse(reader, int(status_line.split()[1]), headers)
+        try:
+            yield resp
+        except BaseException:
+            writer.close(); raise
+        if resp.complete and resp.keep_alive and len(self._idle) < self.size:
+            self._idle.append((reader, writer, time.monotonic()))
+        else:
+            writer.close()
+
+    async def request(self, method, path, body=None):
+        async with self.open(method, path, body) as r:
+            return r.status, await r.read()
+
+_ASYNC_POOLS = None
+
+def _close_async_pools():
+    """Mark idle sockets of finished event loops closed, so their StreamWriters do not
+    complain while the interpreter is being torn down."""
+    for pools in list(_ASYNC_POOLS.values()):
+        for pool in pools.values():
+            while pool._idle:
+                try: pool._idle.pop()[1].transport.abort()
+                except RuntimeError: pass   # loop already closed; the transport is marked closing
+
+def async_http(host)->_AsyncHttp:
+    """Connection pool for host bound to the running event loop."""
+    import asyncio, weakref
+    global _ASYNC_POOLS
+    if _ASYNC_POOLS is None:
+        _ASYNC_POOLS = weakref.WeakKeyDictionary(); atexit.register(_close_async_pools)
+    pools = _ASYNC_POOLS.setdefault(asyncio.get_running_loop(), {})
+    key = host.rstrip("/")
+    if key not in pools: pools[key] = _AsyncHttp(key)
+    return pools[key]
+
+# ---------- Response cache ----------
+CACHE_MODES = ("off", "read", "readwrite", "replay-only")
+CACHE_PATH = pathlib.Path(".sutra") / "cache.db"
+
+class ResponseCache:
+    """Content-addressed store of model responses, shared across processes.
+
+    Entries live in a SQLite file (zlib-compressed text) keyed on a hash of
+    (model, host, prompt, temperature, json_mode, format). Least-recently-used
+    entries are evicted beyond max_bytes, and entries older than ttl seconds
+    are treated as misses. mode is one of CACHE_MODES: "read" never writes,
+    "replay-only" raises on a miss so runs can be forced fully offline.
+    """
+    def __init__(self, mode="readwrite", path=None, max_bytes=256 << 20, ttl=None):
+        import sqlite3
+        if mode not in CACHE_MODES[1:]: raise ValueError(f"cache mode must be one of {CACHE_MODES[1:]}")
+        self.mode, self.max_bytes, self.ttl = mode, max_bytes, ttl
+        self.path = pathlib.Path(path or CACHE_PATH)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB NOT NULL,"
+                         " size INTEGER NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries(accessed)")
+
+    @staticmethod
+    def key(model, host, prompt, temperature, json_mode, fmt=None)->str:
+        import hashlib
+        raw = json.dumps([model, host, prompt, temperature, bool(json_mode), fmt], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        import zlib
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT value, created FROM entries WHERE key=?", (key,)).fetchone()
+            if row and self.ttl is not None and now - row[1] > self.ttl:
+                self._db.execute("DELETE FROM entries WHERE key=?", (key,)); row = None
+            if row is None:
+                self.misses += 1
+                if self.mode == "replay-only":
+                    raise RuntimeError(f"cache miss in replay-only mode ({key[:12]})")
+                return None
+            self.hits += 1
+            self._db.execute("UPDATE entries SET accessed=? WHERE key=?", (now, key))
+        return zlib.decompress(row[0]).decode("utf-8")
+
+    def put(self, key, text):
+        import zlib
+        if self.mode != "readwrite": return
+        blob, now = zlib.compress(text.encode("utf-8")), time.time()
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO entries VALUES (?,?,?,?,?)", (key, blob, len(blob), now, now))
+            self._evict(now)
+
+    def _evict(self, now):
+        if self.ttl is not None:
+            self._db.execute("DELETE FROM entries WHERE created < ?", (now - self.ttl,))
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes: return
+        doomed = []
+        for key, size in self._db.execute("SELECT key, size FROM entries ORDER BY accessed"):
+            if total <= self.max_bytes: break
+            doomed.append((key,)); total -= size
+        self._db.executemany("DELETE FROM entries WHERE key=?", doomed)
+
+    def stats(self)->dict:
+        with self._lock:
+            n, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        looked = self.hits + self.misses
+        return {"mode": self.mode, "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / looked if looked else 0.0, "entries": n, "bytes": size}
+
+CACHE = None  # active ResponseCache, or None when caching is off
+
+def set_cache(mode="readwrite", **kw):
+    """Turn the response cache on for this process (mode="off" turns it off)."""
+    global CACHE
+    CACHE = None if mode == "off" else ResponseCache(mode, **kw)
+    return CACHE
+
+MEMO_PATH = pathlib.Path(".sutra") / "memo.db"
+MEMO = None  # step-output store; when set, a step whose inputs and agent are unchanged is skipped
+
+def set_memo(on=True, path=None, **kw):
+    """Turn step memoization on (or off) for this process."""
+    global MEMO
+    MEMO = ResponseCache("readwrite", path=path or MEMO_PATH, **kw) if on else None
+    return MEMO
+
+# ---------- Backends ----------
+class OllamaConnectionError(RuntimeError):
+    """The host did not take the request (refused, reset, DNS, connect timeout); safe to send elsewhere."""
+
+def _wire_error(e):
+    """What to raise for a failed request: connection failures become
+    OllamaConnectionError (failed over, counted against the backend), read
+    timeouts are raised unchanged (a slow backend is not an unhealthy one),
+    anything else is a RuntimeError."""
+    if isinstance(e, (RuntimeError, TimeoutError)): return e
+    if isinstance(e, (ConnectionError, socket.gaierror)): return OllamaConnectionError(f"Ollama connection error: {e!r}")
+    return RuntimeError(f"Ollama response error: {e!r}")
+
+def _model_tag(name):
+    return name if ":" in name else f"{name}:latest"
+
+class _Backend:
+    def __init__(self, host):
+        self.host = host.strip().rstrip("/")
+        self.inflight, self.ewma, self.fails, self.ejected_until = 0, None, 0, 0.0
+        self.models, self.loaded = None, set()   # None: not probed yet
+
+    def stats(self)->dict:
+        return {"inflight": self.inflight, "ewma_ms": round(self.ewma * 1000, 1) if self.ewma else None,
+                "fails": self.fails, "ejected": self.ejected_until > time.monotonic(),
+                "models": sorted(self.models or ()), "loaded": sorted(self.loaded)}
+
+class BackendPool:
+    """Spreads generations over several Ollama hosts.
+
+    candidates(model) ranks healthy backends that have the model (per
+    /api/tags), preferring ones that have it loaded (/api/ps), then fewer
+    requests in flight, then a lower latency EWMA. After `eject_after`
+    consecutive connection errors a backend is ejected for `eject_for`
+    seconds; a background thread re-probes every backend every
+    `probe_interval` seconds. Ollama retries a failed request on the next
+    candidate as long as no token had been delivered.
+    """
+    def __init__(self, hosts, probe_interval=10.0, eject_after=3, eject_for=30.0, alpha=0.3):
+        if isinstance(hosts, str): hosts = hosts.split(",")
+        self.backends = [_Backend(h) for h in hosts if h.strip()]
+        if not self.backends: raise ValueError("BackendPool needs at least one host")
+        self.probe_interval, self.eject_after, self.eject_for, self.alpha = probe_interval, eject_after, eject_for, alpha
+        self._lock, self._prober = threading.Lock(), None
+
+    def probe(self, backends=None):
+        """Refresh model lists from /api/tags and /api/ps; un-eject backends that answer."""
+        for b in backends or self.backends:
             try:
-                body = e.read().decode("utf-8")
+                found = {}
+                for path in ("/api/tags", "/api/ps"):
+                    status, raw = http_pool(b.host).request("GET", path, timeout=2)
+                    if status >= 400: raise OllamaConnectionError(f"HTTP {status} on {path}")
+                    found[path] = {_model_tag(m["name"]) for m in json.loads(raw).get("models", []) if "name" in m}
             except Exception:
-                body = str(e)
-            raise RuntimeError(f"Ollama HTTP error {e.code}: {body}")
+                self._failed(b); continue
+            with self._lock:
+                b.models, b.loaded = found["/api/tags"], found["/api/ps"]
+                b.fails, b.ejected_until = 0, 0.0
+
+    def _watch(self):
+        while True:
+            time.sleep(self.probe_interval)
+            self.probe()
+
+    def candidates(self, model)->list:
+        with self._lock:
+            first = self._prober is None
+            if first:
+                self._prober = threading.Thread(target=self._watch, name="sutra-probe", daemon=True)
+        if first:
+            self.probe(); self._prober.start()
+        tag, now = _model_tag(model), time.monotonic()
+        with self._lock:
+            rank = lambda b: (b.ejected_until > now, b.models is not None and tag not in b.models,
+                              tag not in b.loaded, b.inflight, b.ewma or 0.0)
+            return sorted(self.backends, key=rank)
+
+    @contextlib.contextmanager
+    def use(self, b):
+        """Count a request in flight on b; feeds the EWMA on success and ejection on connection errors."""
+        with self._lock: b.inflight += 1
+        t0 = time.monotonic()
+        try:
+            yield
+        except OllamaConnectionError:
+            self._failed(b); raise
+        else:
+            dt = time.monotonic() - t0
+            with self._lock:
+                b.ewma = dt if b.ewma is None else self.alpha * dt + (1 - self.alpha) * b.ewma
+                b.fails = 0
+        finally:
+            with self._lock: b.inflight -= 1
+
+    def _failed(self, b):
+        with self._lock:
+            b.fails += 1
+            if b.fails >= self.eject_after: b.ejected_until = time.monotonic() + self.eject_for
+
+    def stats(self)->dict:
+        with self._lock: return {b.host: b.stats() for b in self.backends}
+
+BACKENDS = BackendPool(os.environ["SUTRA_BACKENDS"]) if os.environ.get("SUTRA_BACKENDS") else None
+_BACKEND_POOL = contextvars.ContextVar("sutra_backends", default=None)   # set by Pipeline(backends=...)
+
+def set_backends(hosts=None, **kw):
+    """Route every Ollama without an explicit host through a BackendPool of hosts (None: off)."""
+    global BACKENDS
+    BACKENDS = hosts if isinstance(hosts, BackendPool) else (BackendPool(hosts, **kw) if hosts else None)
+    return BACKENDS
+
+# ---------- Ollama ----------
+DEFAULT_HOST = os.environ.get("OLLAMA_HOST", "http://localhost:11434")
+_PINNED_HOST = None  # set by bench(): every Ollama talks to this host, whatever its own host or backends
+_CALL_OPTS = contextvars.ContextVar("sutra_call_opts", default={})  # extra payload fields, e.g. keep_alive
+LOAD_THRESHOLD = 0.1   # seconds of load_duration that count as a model (re)load
+NO_SCHEMA = set()      # hosts that rejected a JSON Schema format; they get format="json"
+_DEADLINE = contextvars.ContextVar("sutra_deadline", default=None)  # time.monotonic() the current step must end by
+
+class DeadlineExceeded(RuntimeError):
+    """The run's deadline passed before this request could finish."""
+
+def time_left():
+    """Seconds until the current deadline, or None without one."""
+    end = _DEADLINE.get()
+    return None if end is None else end - time.monotonic()
+
+_PACE = {}  # model -> [seconds per generation, seconds before decoding, output tokens/s] (moving averages)
+
+def _learn(model, last):
+    """Fold one generation's timings into _PACE, which sizes retries and num_predict under deadlines."""
+    total, n, d = last.get("total"), last.get("eval_count"), last.get("eval_duration")
+    if not total or last.get("cached"): return
+    pace = _PACE.setdefault(model, [total, total, None])
+    pace[0] += 0.2 * (total - pace[0])
+    if n and d:
+        rate, lead = n / (d / 1e9), max(0.0, total - d / 1e9)
+        pace[1] += 0.2 * (lead - pace[1])
+        pace[2] = rate if pace[2] is None else pace[2] + 0.2 * (rate - pace[2])
+
+PREFIX_KEEP_ALIVE = "30m"  # keep_alive of shared-prefix calls, so the model and its cached prefix stay resident
+
+class _PrefixStats:
+    """Per model/agent sending a shared prefix: how many prompt tokens Ollama
+    skipped thanks to its cached prefix, and the prompt-eval time that saved.
+    A call that evaluated (nearly) its whole prompt calibrates chars per token
+    and seconds per prompt token; later calls are compared with that."""
+    def __init__(self):
+        self._d, self._lock = {}, threading.Lock()
+
+    def record(self, key, chars, last)->dict:
+        """Fold one generation in; returns its span attributes."""
+        n, d = last.get("prompt_eval_count"), last.get("prompt_eval_duration")
+        if not n or last.get("cached"): return {}
+        with self._lock:
+            st = self._d.setdefault(key, {"calls": 0, "reused": 0, "tokens_saved": 0, "saved_s": 0.0,
+                                          "chars_per_token": None, "s_per_token": None})
+            st["calls"] += 1
+            expected = chars / st["chars_per_token"] if st["chars_per_token"] else n
+            saved = max(0, round(expected - n))
+            if saved <= 0.1 * expected:
+                ema = lambda old, new: new if old is None else old + 0.2 * (new - old)
+                st["chars_per_token"] = ema(st["chars_per_token"], chars / n)
+                if d: st["s_per_token"] = ema(st["s_per_token"], d / 1e9 / n)
+                return {"sutra.prefix_reused": False}
+            sec = saved * (st["s_per_token"] or (d / 1e9 / n if d else 0.0))
+            st["reused"] += 1; st["tokens_saved"] += saved; st["saved_s"] += sec
+        return {"sutra.prefix_reused": True, "sutra.prefix_tokens_saved": saved,
+                "sutra.prompt_eval_saved_ms": round(sec * 1000, 3)}
+
+    def stats(self)->dict:
+        with self._lock:
+            return {f"{m}/{a}": {"calls": st["calls"], "reused": st["reused"], "tokens_saved": st["tokens_saved"],
+                                 "saved_ms_per_call": round(st["saved_s"] * 1000 / st["calls"], 3) if st["calls"] else 0.0}
+                    for (m, a), st in self._d.items()}
+
+PREFIXES = _PrefixStats()
+
+def prefix_stats()->dict:
+    """Per "model/agent" using a shared prefix: calls, calls that reused the cached
+    prefix, prompt tokens not re-evaluated and estimated prompt-eval ms saved per call."""
+    return PREFIXES.stats()
+
+def _room(model)->bool:
+    """True unless a deadline is set and a typical generation on model no longer fits before it."""
+    left = time_left()
+    return left is None or left > (_PACE.get(model) or [0.0])[0]
+
+class Ollama:
+    def __init__(self, model="llama3.1:latest", host=None):
+        """host is a URL, a BackendPool, or None for the pipeline's backends,
+        then BACKENDS (SUTRA_BACKENDS), then DEFAULT_HOST (OLLAMA_HOST)."""
+        if _PINNED_HOST: host = _PINNED_HOST
+        self.model, self.target = model, host
+        self.pool = host if isinstance(host, BackendPool) else (None if host else _BACKEND_POOL.get() or BACKENDS)
+        self.host = (self.pool.backends[0].host if self.pool else host or DEFAULT_HOST).rstrip("/")
+        self.http = http_pool(self.host)
+        self._until = None  # deadline of the current request (time.monotonic())
+        self._path = "/api/generate"
+
+    def _routes(self):
+        """Backends to try in order ([None] without a pool); sets self.host/self.http for each."""
+        if not self.pool:
+            yield None; return
+        for b in self.pool.candidates(self.model):
+            self.host, self.http = b.host, http_pool(b.host)
+            yield b
+
+    def _routed(self, send, sp):
+        err = None
+        for b in self._routes():
+            if b is None: return send()
+            if err and self._until is not None and time.monotonic() >= self._until: break
+            sp.set(**{"server.address": b.host})
+            try:
+                with self.pool.use(b): return send()
+            except OllamaConnectionError as e:
+                if self.last.get("ttft") is not None: raise   # tokens already delivered
+                err = e; sp.add({"sutra.failovers": 1})
+        raise err
+
+    async def _arouted(self, send, sp):
+        err = None
+        for b in self._routes():
+            if b is None: return await send()
+            if err and self._until is not None and time.monotonic() >= self._until: break
+            sp.set(**{"server.address": b.host})
+            try:
+                with self.pool.use(b): return await send()
+            except OllamaConnectionError as e:
+                if self.last.get("ttft") is not None: raise
+                err = e; sp.add({"sutra.failovers": 1})
+        raise err
+
+    def generate(self, prompt, temperature=0.2, json_mode=False, timeout=120,
+                 stream=False, on_token=None, stop_when=None, cancel=None, system=None):
+        """Return the generated text.
+
+        With stream=True (implied by on_token/stop_when) the NDJSON stream is read
+        token by token: on_token(piece) sees every piece, and as soon as a complete
+        JSON value in the output satisfies stop_when(obj) the request is closed and
+        the text so far is returned. Timings land in self.last (ttft, total, early_stop).
+        Setting the threading.Event cancel abandons a streaming request between tokens.
+        When a ResponseCache is active (see set_cache) identical requests are served from it.
+        Ollama's own counters (eval_count, load_duration, ...) are kept in self.last too,
+        and each call is a "generate" Span.
+        With system set the call goes to /api/chat as a system message (the static
+        prefix Ollama can keep cached) plus prompt as the user message.
+        """
+        payload, key, hit = self._prepare(prompt, temperature, json_mode, stream or on_token or stop_when or cancel, system)
+        if self._until is not None: timeout = max(0.001, min(timeout, self._until - time.monotonic()))
+        with self._span(payload) as sp:
+            if hit is not None:
+                if on_token: on_token(hit)
+                text = hit
+            else:
+                send = lambda data: self._routed(lambda: self._stream(data, timeout, on_token, stop_when, cancel)
+                                                 if payload["stream"] else self._post(data, timeout), sp)
+                try:
+                    text = send(json.dumps(payload).encode("utf-8"))
+                except (RuntimeError, TimeoutError) as e:
+                    if not self._schema_rejected(payload, e, sp): raise self._overdue(e)
+                    if key: key = self._cache_key(payload, prompt, system, temperature, json_mode)
+                    text = send(json.dumps(payload).encode("utf-8"))
+                _learn(self.model, self.last)
+                if system is not None: sp.set(**self._prefix_saved(system, prompt, sp))
+            sp.set(**_usage(self.last))
+        if key: CACHE.put(key, text)
+        return text
+
+    async def agenerate(self, prompt, temperature=0.2, json_mode=False, timeout=120,
+                        stream=False, on_token=None, stop_when=None, system=None):
+        """Async twin of generate() on asyncio streams. timeout bounds the whole
+        request; on timeout or task cancellation the connection is dropped."""
+        import asyncio
+        payload, key, hit = self._prepare(prompt, temperature, json_mode, stream or on_token or stop_when, system)
+        if self._until is not None: timeout = max(0.001, min(timeout, self._until - time.monotonic()))
+        with self._span(payload) as sp:
+            if hit is not None:
+                if on_token: on_token(hit)
+                text = hit
+            else:
+                async def send():
+                    data = json.dumps(payload).encode("utf-8")
+                    try:
+                        return await asyncio.wait_for(self._astream(data, payload["stream"], on_token, stop_when), timeout)
+                    except asyncio.TimeoutError as e:
+                        raise TimeoutError(f"{self.model} timed out after {timeout:.3g}s") from e
+                    except Exception as e:
+                        raise _wire_error(e)
+                try:
+                    text = await self._arouted(send, sp)
+                except (RuntimeError, TimeoutError) as e:
+                    if not self._schema_rejected(payload, e, sp): raise self._overdue(e)
+                    if key: key = self._cache_key(payload, prompt, system, temperature, json_mode)
+                    text = await self._arouted(send, sp)
+                _learn(self.model, self.last)
+                if system is not None: sp.set(**self._prefix_saved(system, prompt, sp))
+            sp.set(**_usage(self.last))
+        if key: CACHE.put(key, text)
+        return text
+
+    def load(self, keep_alive=None, timeout=300):
+        """Ask Ollama to load the model now (an empty generate) and return its load time in seconds."""
+        payload = {"model": self.model, "stream": False}
+        if keep_alive is not None: payload["keep_alive"] = keep_alive
+        next(self._routes())
+        status, raw = self.http.request("POST", "/api/generate", json.dumps(payload).encode("utf-8"), timeout)
+        if status >= 400: raise RuntimeError(f"Ollama HTTP error {status}: {raw.decode('utf-8', errors='replace')}")
+        last = {}
+        _response_text(raw.decode("utf-8", errors="replace"), last)
+        return last.get("load_duration", 0) / 1e9
+
+    def _span(self, payload):
+        return Span(f"generate {self.model}", "client", attrs={
+            "gen_ai.system": "ollama", "gen_ai.request.model": self.model, "server.address": self.host,
+            "sutra.json_mode": "format" in payload, "sutra.schema": isinstance(payload.get("format"), dict),
+            "sutra.stream": payload["stream"]})
+
+    def _cache_key(self, payload, prompt, system, temperature, json_mode):
+        """Cache key for the request as sent: a reply to format="json" (e.g. after a
+        schema fallback) is never stored under the schema's key."""
+        return CACHE.key(self.model, self.host, prompt if system is None else [system, prompt],
+                         temperature, json_mode, payload.get("format"))
+
+    def _prefix_saved(self, system, prompt, sp)->dict:
+        return PREFIXES.record((self.model, sp.attrs.get("sutra.agent") or "-"), len(system) + len(prompt), self.last)
+
+    def _overdue(self, err):
+        """err, or DeadlineExceeded when the request failed because the deadline ran out."""
+        if self._until is not None and time.monotonic() >= self._until - 0.01 and not isinstance(err, DeadlineExceeded):
+            e = DeadlineExceeded(f"deadline exceeded ({err})"); e.__cause__ = err
+            return e
+        return err
+
+    def _schema_rejected(self, payload, err, sp)->bool:
+        """True when err is a server refusing a schema format (Ollama before 0.5);
+        the host is remembered and payload falls back to format="json"."""
+        if not isinstance(payload.get("format"), dict) or isinstance(err, OllamaConnectionError) \
+                or "format" not in str(err).lower() or self.last.get("ttft") is not None:
+            return False
+        NO_SCHEMA.add(self.host); payload["format"] = "json"
+        sp.set(**{"sutra.schema": False})
+        return True
+
+    def _prepare(self, prompt, temperature, json_mode, stream, system=None):
+        """Build the request payload; return (payload, cache key, cached text or None)."""
+        if system is None:
+            self._path, payload = "/api/generate", {"model": self.model, "prompt": prompt}
+        else:
+            self._path, payload = "/api/chat", {"model": self.model, "messages": [
+                {"role": "system", "content": system}, {"role": "user", "content": prompt}]}
+        payload.update(temperature=temperature, stream=bool(stream))
+        if json_mode: payload["format"] = json_mode if isinstance(json_mode, dict) and self.host not in NO_SCHEMA else "json"
+        payload.update(_CALL_OPTS.get())
+        if system is not None: payload.setdefault("keep_alive", PREFIX_KEEP_ALIVE)
+        self.last = {"ttft": None, "total": None, "early_stop": False}
+        self._until = None
+        cache, key = CACHE, None
+        if cache:
+            key = self._cache_key(payload, prompt, system, temperature, json_mode)
+            hit = cache.get(key)
+            if hit is not None:
+                self.last.update(ttft=0.0, total=0.0, cached=True)
+                return payload, None, hit
+        left = time_left()
+        if left is not None:
+            if left <= 0: raise DeadlineExceeded(f"deadline passed before calling {self.model}")
+            self._until = time.monotonic() + left
+            _, lead, rate = _PACE.get(self.model) or (0, 0, None)
+            if rate:
+                # Cap output to what the model can decode in the time left; a capped reply is not cached.
+                payload["options"] = {**payload.get("options", {}), "num_predict": max(16, int(rate * (left - lead)))}
+                key = None
+        return payload, key, None
+
+    def _post(self, data, timeout):
+        t0 = time.monotonic()
+        try:
+            with _gate().slot(self.model):
+                self.last["queue"] = time.monotonic() - t0
+                status, raw = self.http.request("POST", self._path, data, timeout)
         except Exception as e:
-            raise RuntimeError(f"Ollama connection error: {e}")
+            raise _wire_error(e)
+        self.last["total"] = time.monotonic() - t0
+        body = raw.decode("utf-8", errors="replace")
+        if status >= 400:
+            raise RuntimeError(f"Ollama HTTP error {status}: {body}")
+        return _response_text(body, self.last)
 
-        # Try to parse JSON responses and normalize common shapes
+    def _stream(self, data, timeout, on_token, stop_when, cancel=None):
+        t0 = time.monotonic()
+        parts, scan = [], _JsonScanner() if stop_when else None
         try:
-            j = json.loads(body)
-            if isinstance(j, dict):
-                for key in ("response", "text", "output", "result"):
-                    if key in j:
-                        val = j[key]
-                        return val if isinstance(val, str) else json.dumps(val)
-                if "choices" in j and isinstance(j["choices"], list) and j["choices"]:
-                    choice = j["choices"][0]
-                    if isinstance(choice, dict):
-                        for k in ("text", "message"):
-                            if k in choice:
-                                val = choice[k]
-                                return val if isinstance(val, str) else json.dumps(val)
-                    if isinstance(choice, str):
-                        return choice
-            # If parsed JSON didn't contain a clear text field, return raw body
-            return body
-        except Exception:
-            # Not JSON — return raw body
-            return body
+            with _gate().slot(self.model):
+                self.last["queue"] = time.monotonic() - t0
+                with self.http.open("POST", self._path, data, timeout) as r:
+                    if r.status >= 400:
+                        raise RuntimeError(f"Ollama HTTP error {r.status}: {r.read().decode('utf-8', errors='replace')}")
+                    for line in r:
+                        if (cancel is not None and cancel.is_set()) or self._on_line(line, t0, parts, scan, on_token, stop_when):
+                            # Leaving the block unread closes the socket, which cancels the generation.
+                            break
+        except Exception as e:
+            raise _wire_error(e)
+        self.last["total"] = time.monotonic() - t0
+        self.last.setdefault("eval_count", len(parts))   # early stop: one chunk per token
+        return "".join(parts)
+
+    async def _astream(self, data, stream, on_token, stop_when):
+        t0 = time.monotonic()
+        parts, scan = [], _JsonScanner() if stop_when else None
+        async with async_http(self.host).open("POST", self._path, data) as r:
+            if r.status >= 400:
+                raise RuntimeError(f"Ollama HTTP error {r.status}: {(await r.read()).decode('utf-8', errors='replace')}")
+            if not stream:
+                self.last["total"] = time.monotonic() - t0
+                return _response_text((await r.read()).decode("utf-8", errors="replace"), self.last)
+            async for line in r.lines():
+                if self._on_line(line, t0, parts, scan, on_token, stop_when): break
+        self.last["total"] = time.monotonic() - t0
+        self.last.setdefault("eval_count", len(parts))
+        return "".join(parts)
+
+    def _on_line(self, line, t0, parts, scan, on_token, stop_when)->bool:
+        """Handle one NDJSON stream line; True means stop reading."""
+        if self._until is not None and time.monotonic() > self._until:
+            raise DeadlineExceeded(f"deadline exceeded while {self.model} was generating")
+        if not line.strip(): return False
+        j = json.loads(line)
+        if j.get("error"): raise RuntimeError(f"Ollama error: {j['error']}")
+        if j.get("done"): self.last.update((k, j[k]) for k in OLLAMA_COUNTERS if k in j)
+        piece = j.get("response") or (j.get("message") or {}).get("content") or ""
+        if piece:
+            if self.last["ttft"] is None: self.last["ttft"] = time.monotonic() - t0
+            parts.append(piece)
+            if on_token: on_token(piece)
+        if scan and any(stop_when(o) for o in _loads_all(scan.feed(piece))):
+            self.last["early_stop"] = True
+            return True
+        return False
+
+OLLAMA_COUNTERS = ("total_duration", "load_duration", "prompt_eval_count", "prompt_eval_duration",
+                   "eval_count", "eval_duration")
+
+def _usage(last)->dict:
+    """Span attributes for one generation from Ollama.last (durations in ms)."""
+    ms = lambda sec: round(sec * 1000, 3)
+    out = {"sutra.model_calls": 1, "sutra.early_stop": bool(last.get("early_stop"))}
+    if last.get("cached"): out["sutra.cached"] = True
+    if last.get("queue") is not None: out["sutra.queue_ms"] = ms(last["queue"])
+    if last.get("ttft") is not None: out["sutra.ttft_ms"] = ms(last["ttft"])
+    if "prompt_eval_count" in last: out["gen_ai.usage.input_tokens"] = last["prompt_eval_count"]
+    if "eval_count" in last: out["gen_ai.usage.output_tokens"] = last["eval_count"]
+    for k, attr in (("load_duration", "sutra.load_ms"), ("prompt_eval_duration", "sutra.prompt_eval_ms"),
+                    ("eval_duration", "sutra.eval_ms"), ("total_duration", "sutra.model_ms")):
+        if k in last: out[attr] = ms(last[k] / 1e9)
+    if last.get("eval_duration") and last.get("eval_count"):
+        out["sutra.tokens_per_s"] = round(last["eval_count"] / (last["eval_duration"] / 1e9), 2)
+    return out
+
+def _response_text(body, last=None):
+    """Pull the generated text out of a non-streaming response body; Ollama's
+    counters are copied into last when given."""
+    # Try to parse JSON responses and normalize common shapes
+    try:
+        j = json.loads(body)
+        if isinstance(j, dict):
+            if last is not None: last.update((k, j[k]) for k in OLLAMA_COUNTERS if k in j)
+            if isinstance(j.get("message"), dict) and "content" in j["message"]:   # /api/chat
+                return j["message"]["content"]
+            for key in ("response", "text", "output", "result"):
+                if key in j:
+                    val = j[key]
+                    return val if isinstance(val, str) else json.dumps(val)
+            if "choices" in j and isinstance(j["choices"], list) and j["choices"]:
+                choice = j["choices"][0]
+                if isinstance(choice, dict):
+                    for k in ("text", "message"):
+                        if k in choice:
+                            val = choice[k]
+                            return val if isinstance(val, str) else json.dumps(val)
+                if isinstance(choice, str):
+                    return choice
+        # If parsed JSON didn't contain a clear text field, return raw body
+        return body
+    except Exception:
+        # Not JSON — return raw body
+        return body
 
 # ---------- JSON Helpers ----------
-def _extract_json(text: str):
-    import re
-    m = None
+_JSON_SPECIAL = re.compile(r'</?think>|[\[\]{}"\\]')
+_THINK_TAGS = ("<think>", "</think>")
+
+class _JsonScanner:
+    """Incremental scanner for balanced top-level {...} / [...] spans in a text stream.
+
+    feed() is linear in the new input: a regex jumps between the only characters
+    that matter (brackets, quotes, backslashes), and the open-bracket stack and
+    string / escape state carry over between calls. Text before the current
+    candidate is dropped, so memory stays bounded on long chatty streams.
+    <think>...</think> spans are skipped, as _strip_think drops them.
+    """
+    def __init__(self):
+        self.text, self.pos, self.start = "", 0, 0
+        self.stack, self.in_str, self.esc_at, self.think = [], False, -1, False
+
+    def feed(self, chunk):
+        self.text += chunk
+        t, found = self.text, []
+        # hold back a tag that may be split across chunks
+        end = next((k for k in range(max(self.pos, len(t) - 8), len(t))
+                    if t[k] == "<" and any(tag.startswith(t[k:]) for tag in _THINK_TAGS)), len(t))
+        for m in _JSON_SPECIAL.finditer(t, self.pos, end):
+            i, ch = m.start(), m.group()
+            if self.think:
+                self.think = ch != "</think>"
+            elif ch == "<think>":
+                self.think = True
+            elif ch == "</think>":
+                continue
+            elif self.in_str:
+                if i == self.esc_at: continue
+                if ch == "\\": self.esc_at = i + 1
+                elif ch == '"': self.in_str = False
+            elif ch == '"':
+                self.in_str = bool(self.stack)
+            elif ch == "{" or ch == "[":
+                if not self.stack: self.start = i
+                self.stack.append("}" if ch == "{" else "]")
+            elif (ch == "}" or ch == "]") and self.stack:
+                if self.stack.pop() != ch: self.stack = []
+                elif not self.stack: found.append(_strip_think(t[self.start:i + 1]))
+        cut = self.start if self.stack else end
+        self.text, self.pos = t[cut:], end - cut
+        self.start, self.esc_at = self.start - cut, self.esc_at - cut
+        return found
+
+def _loads_all(candidates):
+    for c in candidates:
+        try: yield json.loads(c)
+        except Exception: pass
+
+_DECODER = json.JSONDecoder()
+_JSON_OPEN = re.compile(r"[{\[]")
+
+def _strip_think(text):
+    """Drop <think>...</think> reasoning blocks (qwen3 and other reasoning models)."""
+    while "<think>" in text:
+        i = text.index("<think>"); j = text.find("</think>", i)
+        text = text[:i] + (text[j + 8:] if j >= 0 else text[i + 7:])
+    return text
+
+_REPAIRABLE = re.compile(r'"(?:[^"\\]|\\.)*"|\'((?:[^\'\\]|\\.)*)\'|,(\s*[}\]])', re.DOTALL)
+
+def _repair_match(m):
+    if m.group(2) is not None: return m.group(2)          # trailing comma
+    if m.group(1) is None: return m.group(0)              # already a JSON string
+    body = m.group(1).replace("\\'", "'").replace('"', '\\"')
+    return f'"{body}"'
+
+def _repair_json(s):
+    """Rewrite single-quoted strings as JSON strings and drop trailing commas, in one pass."""
+    return _REPAIRABLE.sub(_repair_match, s)
+
+def _decode(candidate):
+    for c in (candidate, None):
+        try:
+            return _DECODER.raw_decode(c if c is not None else _repair_json(candidate))[0]
+        except ValueError:
+            pass
+    return None
+
+def _extract_json(text: str, required=None):
+    """Best JSON value embedded in a model reply, or None.
+
+    After a whole-text parse, <think> blocks are dropped and the value at the
+    first bracket is decoded in place; if that fails or misses required keys,
+    one linear scan collects every balanced {...}/[...] span (so code fences and surrounding
+    prose don't matter). Each span is decoded, with a repair pass for single
+    quotes and trailing commas, and the winner is the one that satisfies
+    required (then has the most required keys, then is longest).
+    """
     # Try full-text JSON parse first
     try:
         return json.loads(text)
     except Exception:
         pass
 
-    # Fallback: find first JSON object/array (non-greedy)
-    m = re.search(r'(\{.*?\}|\[.*?\])', text, re.DOTALL)
-    if not m: return None
-    try: return json.loads(m.group(1))
-    except: return None
+    # Common case: one clean value after some prose; decode it in place.
+    text = _strip_think(text)
+    m = _JSON_OPEN.search(text)
+    if m is None: return None
+    try:
+        obj = _DECODER.raw_decode(text, m.start())[0]
+        if _validate(_coerce_json_shape(obj, required), required)[0]: return obj
+    except ValueError:
+        pass
+
+    best, best_score = None, None
+    for c in _JsonScanner().feed(text):
+        obj = _decode(c)
+        if obj is None: continue
+        first = obj[0] if isinstance(obj, list) and obj else obj
+        present = sum(k in first for k in required) if required and isinstance(first, dict) else 0
+        score = (_validate(_coerce_json_shape(obj, required), required)[0], present, len(c))
+        if best_score is None or score > best_score: best, best_score = obj, score
+    return best
 
 def _validate(obj, required):
     if not required: return True, ""
@@ -95,7 +1554,8 @@ def _validate(obj, required):
 
 _WRAPPER_KEYS = ("items", "data", "result", "results", "topics", "list")
 
-def _coerce_json_shape(obj, required):
+def _coerce_json_shape(obj, required, keep=()):
+    """obj in output shape: a list whose items hold the required keys (plus any of keep they carry)."""
     if obj is None: return None
     if isinstance(obj, dict):
         for k in _WRAPPER_KEYS:
@@ -113,89 +1573,2052 @@ def _coerce_json_shape(obj, required):
             if "note" not in it and "notes" in it:
                 it["note"] = it.pop("notes")
             if required:
-                it = {k: it.get(k, "") for k in required}
+                it = {**{k: it.get(k, "") for k in required}, **{k: it[k] for k in keep if k in it}}
             out.append(it)
         return out
     return obj
 
+# ---------- JSON Schema ----------
+_PY_TYPES = {str: "string", int: "integer", float: "number", bool: "boolean", list: "array", dict: "object"}
+
+def schema_for(required, types=None)->dict:
+    """An object schema for required keys. types maps a key to a Python type
+    (str, int, float, bool, list, dict), a JSON type name, a list of allowed
+    values (an enum, e.g. ["approve", "manual_review", "reject"]) or a schema."""
+    types, props = types or {}, {}
+    for k in list(required) + [k for k in types if k not in required]:
+        t = types.get(k)
+        props[k] = ({} if t is None else {"type": _PY_TYPES[t]} if isinstance(t, type) else {"type": t}
+                    if isinstance(t, str) else {"enum": list(t)} if isinstance(t, (list, tuple)) else t)
+    return {"type": "object", "properties": props, "required": list(required)}
+
+_JSON_TYPES = {"string": str, "integer": int, "number": (int, float), "boolean": bool,
+               "array": list, "object": dict, "null": type(None)}
+
+def _compile_schema(sc):
+    """check(obj) -> None, or why obj breaks the schema. Covers the subset Ollama's
+    format accepts: type, enum, const, properties, required, additionalProperties,
+    items, anyOf/oneOf and length/size bounds."""
+    if sc is True or not sc: return lambda v: None
+    if sc is False: return lambda v: "not allowed"
+    checks = []
+    if "type" in sc:
+        names = sc["type"] if isinstance(sc["type"], list) else [sc["type"]]
+        pys = tuple(t for n in names for t in (_JSON_TYPES[n] if isinstance(_JSON_TYPES[n], tuple) else (_JSON_TYPES[n],)))
+        strict_bool = "boolean" not in names
+        checks.append(lambda v: None if isinstance(v, pys) and not (strict_bool and isinstance(v, bool))
+                      else f"expected {'/'.join(names)}")
+    if "enum" in sc:
+        allowed = sc["enum"]; checks.append(lambda v: None if v in allowed else f"{v!r} not in {allowed}")
+    if "const" in sc:
+        c = sc["const"]; checks.append(lambda v: None if v == c else f"expected {c!r}")
+    for key, op in (("minLength", "<"), ("maxLength", ">"), ("minItems", "<"), ("maxItems", ">")):
+        if key in sc:
+            n, kind = sc[key], (str if "Length" in key else list)
+            bad = (lambda v, n=n: len(v) < n) if op == "<" else (lambda v, n=n: len(v) > n)
+            checks.append(lambda v, n=n, kind=kind, bad=bad, key=key: f"{key} {n}" if isinstance(v, kind) and bad(v) else None)
+    for key, bad in (("minimum", lambda v, n: v < n), ("maximum", lambda v, n: v > n)):
+        if key in sc:
+            checks.append(lambda v, n=sc[key], bad=bad, key=key: f"{key} {n}"
+                          if isinstance(v, (int, float)) and not isinstance(v, bool) and bad(v, n) else None)
+    if "properties" in sc or "required" in sc or "additionalProperties" in sc:
+        props = {k: _compile_schema(x) for k, x in sc.get("properties", {}).items()}
+        req, extra = sc.get("required", []), sc.get("additionalProperties", True)
+        extra = _compile_schema(extra) if isinstance(extra, dict) else (None if extra else lambda v: "not allowed")
+        def obj(v):
+            if not isinstance(v, dict): return None
+            miss = [k for k in req if k not in v]
+            if miss: return f"missing {miss}"
+            for k, x in v.items():
+                c = props.get(k, extra)
+                why = c(x) if c else None
+                if why: return f"{k}: {why}"
+        checks.append(obj)
+    if isinstance(sc.get("items"), dict):
+        item = _compile_schema(sc["items"])
+        def arr(v):
+            if not isinstance(v, list): return None
+            for i, x in enumerate(v):
+                why = item(x)
+                if why: return f"item {i}: {why}"
+        checks.append(arr)
+    for key in ("anyOf", "oneOf"):
+        if key in sc:
+            alts = [_compile_schema(x) for x in sc[key]]
+            checks.append(lambda v, alts=alts: None if any(a(v) is None for a in alts) else "no alternative matches")
+    def check(v):
+        for c in checks:
+            why = c(v)
+            if why: return why
+    return check
+
+_SCHEMAS = {}  # id(schema) -> (schema, check); keeping the schema pins its id
+
+def _validator(sc):
+    """The compiled check for sc, built once per schema object."""
+    hit = _SCHEMAS.get(id(sc))
+    if hit is None or hit[0] is not sc:
+        hit = _SCHEMAS[id(sc)] = (sc, _compile_schema(sc))
+    return hit[1]
+
+# ---------- JSON mode strategy ----------
+class _ModeStats:
+    """Learns per (model, agent) which JSON mode (format="json" or plain) yields
+    valid output, and counts model calls per agent call to expose the retry tax."""
+    def __init__(self):
+        self._d, self._lock = {}, threading.Lock()
+
+    def _get(self, key):
+        return self._d.setdefault(key, {"calls": 0, "ok": 0, "model_calls": 0,
+                                        "modes": {True: [0, 0], False: [0, 0]}})
+
+    def order(self, key)->list:
+        """Modes by smoothed success rate, best first; a mode that has never won
+        in 8+ tries while the other has is dropped."""
+        with self._lock:
+            m = {jm: tuple(v) for jm, v in self._get(key)["modes"].items()}
+        modes = sorted((True, False), key=lambda jm: -(m[jm][1] + 1) / (m[jm][0] + 2))
+        loser = modes[1]
+        if m[loser][0] >= 8 and m[loser][1] == 0 and m[modes[0]][1] > 0: modes = modes[:1]
+        return modes
+
+    def record(self, key, json_mode, ok):
+        with self._lock:
+            st = self._get(key)
+            st["model_calls"] += 1
+            st["modes"][json_mode][0] += 1; st["modes"][json_mode][1] += bool(ok)
+
+    def finish(self, key, ok):
+        with self._lock:
+            st = self._get(key); st["calls"] += 1; st["ok"] += bool(ok)
+
+    def stats(self)->dict:
+        with self._lock:
+            return {f"{m}/{a}": {"calls": st["calls"], "ok": st["ok"], "model_calls": st["model_calls"],
+                                 "attempts_per_success": st["model_calls"] / st["ok"] if st["ok"] else None,
+                                 "json_mode": {"json" if jm else "plain": {"tries": t, "wins": w}
+                                               for jm, (t, w) in st["modes"].items()}}
+                    for (m, a), st in self._d.items()}
+
+JSON_MODES = _ModeStats()
+
+def json_mode_stats()->dict:
+    """Per "model/agent": calls, successes, model calls per success and wins per JSON mode."""
+    return JSON_MODES.stats()
+
+class _HedgeStats:
+    """Per (model, agent) latencies of plain calls plus hedge counters: how many
+    calls were hedged, how often the hedge won, and an estimate of the time it
+    saved (the mean observed latency beyond the point the hedge won)."""
+    def __init__(self, keep=256):
+        self._d, self._lock, self.keep = {}, threading.Lock(), keep
+
+    def _get(self, key):
+        st = self._d.get(key)
+        if st is None:
+            import collections
+            st = self._d[key] = {"calls": 0, "hedged": 0, "wins": 0, "saved": 0.0,
+                                 "lat": collections.deque(maxlen=self.keep)}
+        return st
+
+    def threshold(self, key, q, min_samples=20):
+        """The q-quantile of observed latency, or None until min_samples calls were seen."""
+        with self._lock:
+            st = self._get(key); st["calls"] += 1
+            lat = sorted(st["lat"])
+        return lat[min(len(lat) - 1, int(q * len(lat)))] if len(lat) >= min_samples else None
+
+    def allow(self, key, budget)->bool:
+        """Take one hedge from the budget (a fraction of calls); False once it is spent."""
+        with self._lock:
+            st = self._get(key)
+            if st["hedged"] + 1 > budget * st["calls"]: return False
+            st["hedged"] += 1; return True
+
+    def record(self, key, latency=None, hedge_won_at=None):
+        with self._lock:
+            st = self._get(key)
+            if latency is not None: st["lat"].append(latency)
+            if hedge_won_at is not None:
+                tail = [x for x in st["lat"] if x > hedge_won_at]
+                st["wins"] += 1
+                if tail: st["saved"] += sum(tail) / len(tail) - hedge_won_at
+
+    def stats(self)->dict:
+        with self._lock:
+            return {f"{m}/{a}": {"calls": st["calls"], "hedged": st["hedged"], "wins": st["wins"],
+                                 "hedge_rate": st["hedged"] / st["calls"] if st["calls"] else 0.0,
+                                 "est_saved_s": round(st["saved"], 3)}
+                    for (m, a), st in self._d.items()}
+
+HEDGES = _HedgeStats()
+
+def hedge_stats()->dict:
+    """Per "model/agent": calls, hedges issued, hedges that won and estimated seconds saved."""
+    return HEDGES.stats()
+
+class _CascadeStats:
+    """Per agent: which cascade tier (model) served each call, and how often
+    each tier escalated, by reason (invalid, confidence, timeout, error). A tier
+    that ran out of a deadline counts under "deadline" and ends the cascade."""
+    def __init__(self):
+        self._d, self._lock = {}, threading.Lock()
+
+    def record(self, agent, model, served=False, reason=None):
+        with self._lock:
+            st = self._d.setdefault(agent, {"calls": 0, "served": {}, "escalated": {}})
+            if served:
+                st["calls"] += 1; st["served"][model] = st["served"].get(model, 0) + 1
+            if reason:
+                e = st["escalated"].setdefault(model, {})
+                e[reason] = e.get(reason, 0) + 1
+
+    def stats(self)->dict:
+        with self._lock:
+            return {a: {"calls": st["calls"], "served": dict(st["served"]),
+                        "served_share": {m: n / st["calls"] for m, n in st["served"].items()} if st["calls"] else {},
+                        "escalated": {m: dict(e) for m, e in st["escalated"].items()}}
+                    for a, st in self._d.items()}
+
+CASCADES = _CascadeStats()
+
+def cascade_stats()->dict:
+    """Per agent with a cascade: calls, calls served per model and escalations per model and reason."""
+    return CASCADES.stats()
+
+def _waited(sp, t0):
+    """Count the time since t0 as waiting on the model (a race counts once, until its winner)."""
+    sp.add({"sutra.model_wait_ms": (time.perf_counter() - t0) * 1000})
+
+class _Race:
+    """Yielded by Agent._calls to run several generate() calls at once. The driver
+    sends back [(index, raw), ...] in completion order, stopping at the first raw
+    that accept() likes and cancelling the others.
+
+    With delay set, call i+1 starts only if no reply has arrived `delay` seconds
+    after call i started, and only if launch(i+1) agrees; a call that returns
+    early (invalid or failed) ends the race and is left to the caller's retries. started[i] / times[i] hold start offsets and
+    durations of the calls that ran.
+    """
+    def __init__(self, calls, accept, delay=None, launch=None):
+        self.calls, self.accept, self.delay, self.launch = calls, accept, delay, launch
+        self.started, self.times = {}, {}
+
+    def _next(self, n)->bool:
+        return n < len(self.calls) and (self.launch is None or self.launch(n))
+
+_RACE_POOL = ThreadPoolExecutor(max_workers=32, thread_name_prefix="sutra-race")
+
+def _race(llm, race):
+    cancel, futs, out, err, t0 = threading.Event(), {}, [], None, time.monotonic()
+    def launch(i):
+        race.started[i] = time.monotonic() - t0
+        kw = dict(race.calls[i]); m = kw.pop("model", llm.model)
+        futs[_RACE_POOL.submit(_in_context(Ollama(m, llm.target).generate), cancel=cancel, **kw)] = i
+    try:
+        for i in range(len(race.calls) if race.delay is None else 1): launch(i)
+        n = len(futs)
+        while futs:
+            done, _ = wait(futs, timeout=race.delay if n < len(race.calls) else None, return_when=FIRST_COMPLETED)
+            if not done and race._next(n): launch(n)
+            n += not done
+            for f in done:
+                i = futs.pop(f)
+                try: raw = f.result()
+                except Exception as e:
+                    err = e; continue
+                race.times[i] = time.monotonic() - t0 - race.started[i]
+                out.append((i, raw))
+                if race.accept(raw): return out
+    finally:
+        cancel.set()
+    if not out and err: raise err
+    return out
+
+async def _arace(llm, race):
+    import asyncio
+    tasks, out, err, t0 = {}, [], None, time.monotonic()
+    def launch(i):
+        race.started[i] = time.monotonic() - t0
+        kw = dict(race.calls[i]); m = kw.pop("model", llm.model)
+        tasks[asyncio.ensure_future(Ollama(m, llm.target).agenerate(**kw))] = i
+    pending = set()
+    try:
+        for i in range(len(race.calls) if race.delay is None else 1): launch(i)
+        n, pending = len(tasks), set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=race.delay if n < len(race.calls) else None,
+                                               return_when=asyncio.FIRST_COMPLETED)
+            if not done and race._next(n):
+                launch(n); pending.add(next(f for f, i in tasks.items() if i == n))
+            n += not done
+            for f in sorted(done, key=tasks.get):
+                if f.exception() is not None:
+                    err = f.exception(); continue
+                race.times[tasks[f]] = time.monotonic() - t0 - race.started[tasks[f]]
+                out.append((tasks[f], f.result()))
+                if race.accept(f.result()): return out
+    finally:
+        for f in pending: f.cancel()
+    if not out and err: raise err
+    return out
+
+# ---------- Prompt rendering ----------
+CHARS_PER_TOKEN = 4  # rough token estimate for budgets and reported prompt sizes
+
+def _est_tokens(text)->int:
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+def _dumps(v)->str:
+    """Minified JSON: what dicts and lists cost in a prompt, without repr's quotes and spaces."""
+    return json.dumps(v, ensure_ascii=False, separators=(",", ":"), default=str)
+
+def _render(v):
+    """A prompt value: structured inputs as minified JSON, everything else untouched
+    so format specs like {score:.2f} keep working."""
+    return _dumps(v) if isinstance(v, (dict, list, tuple)) else v
+
+class _PromptFormatter(string.Formatter):
+    """str.format for prompts: {analyzer[0][summary]} indexes the original input;
+    only the value a field finally resolves to goes through _render."""
+    def format_field(self, value, spec):
+        return super().format_field(_render(value), spec)
+
+_PROMPT_FORMAT = _PromptFormatter()
+
+def _indexed_fields(template)->set:
+    """Names a template reads with index or attribute access ({x[score]}, {x.y})."""
+    return {re.split(r"[.\[]", f, 1)[0] for _, f, _, _ in _PROMPT_FORMAT.parse(template)
+            if f and re.search(r"[.\[]", f)}
+
+def _project(v, path):
+    """v reduced to the dotted path (a list of keys); lists are projected item by item."""
+    if not path: return v
+    if isinstance(v, list): return [_project(x, path) for x in v]
+    if isinstance(v, dict): return {path[0]: _project(v[path[0]], path[1:])} if path[0] in v else {}
+    return v
+
+def _merge(a, b):
+    """Union of two projections of the same value."""
+    if isinstance(a, dict) and isinstance(b, dict):
+        return {**a, **{k: _merge(a[k], x) if k in a else x for k, x in b.items()}}
+    if isinstance(a, list) and isinstance(b, list) and len(a) == len(b):
+        return [_merge(x, y) for x, y in zip(a, b)]
+    return b
+
+def _cut(text, chars, strategy)->str:
+    """text shortened to chars, keeping its head, tail, or both ends."""
+    if len(text) <= chars: return text
+    chars = max(0, chars - 1)
+    if strategy == "tail": return "…" + text[len(text) - chars:]
+    if strategy == "middle": return text[:chars - chars // 2] + "…" + text[len(text) - chars // 2:]
+    return text[:chars] + "…"
+
+def _fit(v, tokens, strategy="head"):
+    """v rendered within a token budget. Lists drop items (from the end for "head",
+    the start for "tail", the middle for "middle") and long strings inside
+    structures are shortened so the JSON stays valid; plain text is cut."""
+    chars, text = tokens * CHARS_PER_TOKEN, _render(v)
+    if not isinstance(text, str): text = str(text)
+    if len(text) <= chars or not isinstance(v, (dict, list, tuple)): return _cut(text, chars, strategy)
+    if isinstance(v, (list, tuple)):
+        lo, hi = 0, len(v)  # most items that fit
+        pick = lambda n: (list(v[:n]) if strategy == "head" else list(v[len(v) - n:]) if strategy == "tail"
+                          else list(v[:n - n // 2]) + list(v[len(v) - n // 2:]))
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if len(_dumps(pick(mid))) <= chars: lo = mid
+            else: hi = mid - 1
+        if lo: return _dumps(pick(lo))
+    v = json.loads(text)
+    for _ in range(32):
+        leaves = []
+        def walk(x, parent, k):
+            if isinstance(x, str): leaves.append((len(x), parent, k))
+            elif isinstance(x, dict): [walk(y, x, j) for j, y in x.items()]
+            elif isinstance(x, list): [walk(y, x, j) for j, y in enumerate(x)]
+        walk(v, None, None)
+        n, parent, k = max(leaves, key=lambda t: t[0], default=(0, None, None))
+        if parent is None or n < 8: break
+        parent[k] = _cut(parent[k], n // 2, strategy)
+        text = _dumps(v)
+        if len(text) <= chars: return text
+    return _cut(text, chars, strategy)
+
+# ---------- Near-duplicate inputs ----------
+# Dates, times, epoch stamps, UUIDs and long hex ids: what changes when the same report is resubmitted.
+_VOLATILE = re.compile(r"\d{4}-\d\d-\d\d(?:[t ]\d\d:\d\d(?::\d\d(?:\.\d+)?)?(?:z|[+-]\d\d:?\d\d)?)?"
+                       r"|\b\d\d?:\d\d(?::\d\d(?:\.\d+)?)?\b|\b\d{10,13}\b"
+                       r"|\b[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\b|\b[0-9a-f]{16,}\b")
+_MERSENNE = (1 << 61) - 1
+
+def normalize_text(text)->str:
+    """text lowercased, whitespace collapsed, and timestamps and ids masked."""
+    return " ".join(_VOLATILE.sub("#", str(text).lower()).split())
+
+class NearDuplicates:
+    """Online MinHash/LSH index that clusters near-duplicate inputs (Pipeline.run_many(dedup=...)).
+
+    An input's text is its fields (all of them by default) as "key: value" lines,
+    normalized by `normalize`; its word `shingle`-grams are MinHashed with `perms`
+    permutations and banded so that inputs sharing a band are compared. An input
+    whose estimated Jaccard similarity to an earlier representative is at least
+    `threshold` joins that cluster; otherwise it becomes a representative.
+    At most `max_size` representatives are kept (signature plus the outputs
+    stored by keep()); the least recently matched one is forgotten first, so a
+    later near-duplicate of it starts a new cluster.
+    """
+    def __init__(self, threshold=0.9, fields=None, shingle=3, perms=64, normalize=normalize_text, seed=1,
+                 max_size=10000):
+        if not 0 < threshold <= 1: raise ValueError(f"dedup threshold must be in (0, 1], got {threshold}")
+        self.threshold, self.fields, self.shingle, self.normalize = threshold, fields, shingle, normalize
+        rnd = random.Random(seed)
+        self._perms = [(rnd.randrange(1, _MERSENNE), rnd.randrange(_MERSENNE)) for _ in range(perms)]
+        # Rows per band: the most whose LSH threshold (1/b)^(1/r) stays a margin below `threshold`.
+        self.rows = max((r for r in range(1, perms + 1) if perms % r == 0
+                         and (r / perms) ** (1 / r) <= threshold - 0.1), default=1)
+        self.max_size = max_size
+        self._bands, self._exact = {}, {}
+        self._reps = {}   # key -> [signature, text digest, kept outputs or None], least recently matched first
+        self._lock = threading.Lock()
+        self.stats = {"items": 0, "clusters": 0, "duplicates": 0, "calls_avoided": 0}
+
+    def text(self, inp)->str:
+        inp = inp if isinstance(inp, dict) else {"": inp}
+        keys = self.fields or sorted(inp, key=str)
+        return self.normalize("\n".join(f"{k}: {v if isinstance(v, str) else _dumps(v)}"
+                                        for k in keys if k in inp for v in [inp[k]]))
+
+    def signature(self, text)->tuple:
+        import zlib
+        words = text.split()
+        grams = {" ".join(words[i:i + self.shingle]) for i in range(max(1, len(words) - self.shingle + 1))}
+        hashes = [zlib.crc32(g.encode("utf-8")) for g in grams]
+        return tuple(min((a * h + b) % _MERSENNE for h in hashes) for a, b in self._perms)
+
+    def add(self, key, inp):
+        """Index inp under key. Returns (representative key, similarity) when it is a
+        near-duplicate of an earlier input, else None (key is now a representative)."""
+        text = self.text(inp); digest = _hash(text)
+        sig = None if digest in self._exact else self.signature(text)
+        with self._lock:
+            self.stats["items"] += 1
+            best, sim = self._exact.get(digest), 1.0
+            if best is None:
+                best, sim = None, 0.0
+                for rep in dict.fromkeys(k for b in self._bands_of(sig) for k in self._bands.get(b, ())):
+                    s = sum(x == y for x, y in zip(sig, self._reps[rep][0])) / len(sig)
+                    if s > sim: best, sim = rep, s
+                if sim < self.threshold: best = None
+            if best is not None:
+                self._reps[best] = self._reps.pop(best)
+                self.stats["duplicates"] += 1
+                return best, round(sim, 3)
+            if sig is None: sig = self.signature(text)
+            self._exact[digest], self._reps[key] = key, [sig, digest, None]
+            for b in self._bands_of(sig): self._bands.setdefault(b, []).append(key)
+            self.stats["clusters"] += 1
+            while len(self._reps) > self.max_size: self._forget(next(iter(self._reps)))
+        return None
+
+    def _bands_of(self, sig):
+        return [(i, sig[i:i + self.rows]) for i in range(0, len(sig), self.rows)]
+
+    def _forget(self, key):
+        sig, digest, _ = self._reps.pop(key)
+        self._exact.pop(digest, None)
+        for b in self._bands_of(sig):
+            keys = self._bands[b]; keys.remove(key)
+            if not keys: del self._bands[b]
+
+    def keep(self, key, outputs):
+        """Store what a representative's near-duplicates receive (if it is still indexed)."""
+        with self._lock:
+            if key in self._reps: self._reps[key][2] = outputs
+
+    def kept(self, key):
+        with self._lock:
+            return self._reps[key][2] if key in self._reps else None
+
+    def avoided(self, calls):
+        with self._lock: self.stats["calls_avoided"] += calls
+
 # ---------- CORE CLASSES ----------
+ON_TOKEN = None  # default token callback for every Agent; set by `sutra run --stream`
+SHARED_PREFIX = False  # default for Agent(shared_prefix=None); set by --shared-prefix
+
+def set_shared_prefix(on=True, keep_alive=None):
+    """Send every agent's static prompt prefix as a cached chat system message
+    (unless the agent says otherwise); keep_alive overrides PREFIX_KEEP_ALIVE."""
+    global SHARED_PREFIX, PREFIX_KEEP_ALIVE
+    SHARED_PREFIX = on
+    if keep_alive is not None: PREFIX_KEEP_ALIVE = keep_alive
+
 class Agent:
     def __init__(self, name, objective, model, prompt,
                  expects_json=False, output_key="output", system_hint=None,
-                 required_keys=None, retries=1, temperature=0.0):
+                 required_keys=None, retries=1, temperature=0.0, stream=False, on_token=None,
+                 race_modes=False, hooks=None, host=None, hedge=None, hedge_budget=0.1,
+                 budgets=None, truncate="head", schema=None, types=None,
+                 cascade=None, confidence=None, min_confidence=0.5, cascade_timeout=None, shared_prefix=None):
         self.name=name; self.objective=objective; self.model=model; self.prompt=prompt
         self.expects_json=expects_json; self.output_key=output_key; self.system_hint=system_hint
         self.required_keys=required_keys or []; self.retries=retries; self.temperature=temperature
+        self.stream=stream; self.on_token=on_token; self.race_modes=race_modes; self.hooks=list(hooks or [])
+        self.host=host  # URL or BackendPool; None uses the pipeline's backends or the default host
+        # hedge=q: duplicate a call still running at the q-quantile of this agent's latency,
+        # for at most hedge_budget of its calls.
+        self.hedge=hedge; self.hedge_budget=hedge_budget
+        # budgets={"text": 400} caps an input's rendered tokens; a value may also be
+        # (tokens, "head"|"tail"|"middle") to override truncate for that input.
+        self.budgets=dict(budgets or {}); self.truncate=truncate
+        # schema: a JSON Schema sent as Ollama's format and checked on every reply, or
+        # True (implied by types) for one derived from required_keys plus types.
+        self.types=dict(types or {}); self.derived = schema is True or (schema is None and bool(types))
+        self.schema = schema_for(self.required_keys, self.types) if self.derived else schema
+        # cascade=[cheap, ..., model]: try models in order, moving on when the reply is
+        # invalid, not confident (confidence: a field compared with min_confidence, or
+        # a predicate on the output) or slower than cascade_timeout seconds.
+        self.cascade=list(cascade or []); self.confidence=confidence
+        self.min_confidence=min_confidence; self.cascade_timeout=cascade_timeout
+        # shared_prefix: send prefix() as a chat system message so Ollama keeps it
+        # evaluated between calls; None follows SHARED_PREFIX.
+        self.shared_prefix=shared_prefix
 
-    def run(self, inputs: dict)->dict:
+    _FINGERPRINT = ("name", "objective", "model", "prompt", "expects_json", "output_key",
+                    "system_hint", "required_keys", "retries", "temperature", "budgets", "truncate", "schema", "types",
+                    "cascade", "confidence", "min_confidence", "cascade_timeout", "shared_prefix")
+
+    def render(self, inputs: dict):
+        """The prompt for inputs and the estimated tokens of each rendered input.
+        Inputs over their budget are truncated; their names are in sizes["truncated"]."""
+        vals, sizes, cut, indexed = {}, {}, [], _indexed_fields(self.prompt)
+        for k, v in inputs.items():
+            b = self.budgets.get(k)
+            if b is None:
+                vals[k] = v
+            else:
+                tokens, strategy = b if isinstance(b, (tuple, list)) else (b, self.truncate)
+                vals[k] = _fit(v, tokens, strategy)
+                full = _render(v)
+                if vals[k] != (full if isinstance(full, str) else str(full)): cut.append(k)
+                # an indexed input keeps its (fitted) structure; _fit leaves its JSON valid
+                if k in indexed and isinstance(v, (dict, list, tuple)): vals[k] = json.loads(vals[k])
+            sizes[k] = _est_tokens(str(_render(vals[k])))
         try:
-            p = self.prompt.format(**inputs, objective=self.objective)
+            p = _PROMPT_FORMAT.format(self.prompt, **vals, objective=self.objective)
         except KeyError as e:
             raise ValueError(f"[{self.name}] Missing var: {e}")
         if self.system_hint:
             p = f"{self.system_hint}\n\n---\n{p}"
+        sizes["truncated"] = cut
+        return p, sizes
+
+    def prefix(self)->str:
+        """The static head of every prompt this agent renders: system_hint and the
+        template up to its first input field (objective counts as static)."""
+        head = [f"{self.system_hint}\n\n---\n"] if self.system_hint else []
+        for literal, field, spec, conv in string.Formatter().parse(self.prompt):
+            head.append(literal)
+            if field is None: continue
+            if field != "objective" or spec or conv: break
+            head.append(str(self.objective))
+        return "".join(head)
+
+    def fingerprint(self)->dict:
+        """Everything that shapes this agent's output; keys step memoization."""
+        fp = {k: getattr(self, k) for k in self._FINGERPRINT}
+        if callable(self.confidence): fp["confidence"] = getattr(self.confidence, "__qualname__", repr(self.confidence))
+        fp["shared_prefix"] = SHARED_PREFIX if self.shared_prefix is None else self.shared_prefix
+        return fp
+
+    def _done(self, obj)->bool:
+        """True when obj already satisfies required_keys (and the schema); used to stop streams early."""
+        return self._check(obj) is not None
 
-        llm = Ollama(model=self.model)
-        attempts = self.retries + 1
+    def _check(self, obj):
+        """obj in output shape if it is valid, else None. An explicit schema is
+        checked as is; otherwise obj is coerced to required_keys first and each
+        item checked against the derived schema."""
+        if self.schema and not self.derived:
+            return obj if _validator(self.schema)(obj) is None else None
+        # a confidence field is kept for _confident() even when it is not required
+        keep = (self.confidence,) if isinstance(self.confidence, str) else ()
+        obj = _coerce_json_shape(obj, self.required_keys, keep)
+        ok, why = _validate(obj, self.required_keys)
+        if ok and self.schema:
+            check = _validator(self.schema)
+            ok = all(check(it) is None for it in (obj if isinstance(obj, list) else [obj]))
+        return obj if ok else None
+
+    def _parse(self, raw):
+        """The validated JSON value in raw, or None."""
+        obj = None
+        try:
+            obj = json.loads(raw)
+        except:
+            obj = _extract_json(raw, self.required_keys)
+        return self._check(obj)
+
+    def _span(self):
+        return Span(f"agent {self.name}", "agent", self.hooks,
+                    {"sutra.agent": self.name, "gen_ai.request.model": self.model})
+
+    def _llm(self, llms, kw):
+        """The Ollama client for a call's model (kw["model"], set by cascades) and the remaining kwargs."""
+        kw = dict(kw); m = kw.pop("model", self.model)
+        if m not in llms: llms[m] = Ollama(model=m, host=self.host)
+        return llms[m], kw
+
+    def run(self, inputs: dict)->dict:
+        llms, calls = {}, self._calls(inputs)
+        with self._span() as sp:
+            try:
+                kw = next(calls)
+                while True:
+                    t = time.perf_counter()
+                    try:
+                        if isinstance(kw, _Race): res = _race(self._llm(llms, {})[0], kw)
+                        else: llm, kw = self._llm(llms, kw); res = llm.generate(**kw)
+                    except Exception as e:
+                        _waited(sp, t); kw = calls.throw(e)   # the attempt loop may escalate past a failed model
+                    else:
+                        _waited(sp, t); kw = calls.send(res)
+            except StopIteration as done:
+                return done.value
+            finally:
+                sp.set(**{"sutra.retries": max(0, sp.attrs.get("sutra.model_calls", 0) - 1)})
+
+    async def arun(self, inputs: dict)->dict:
+        """Async run(): same prompts, retries and parsing, over Ollama.agenerate."""
+        llms, calls = {}, self._calls(inputs)
+        with self._span() as sp:
+            try:
+                kw = next(calls)
+                while True:
+                    t = time.perf_counter()
+                    try:
+                        if isinstance(kw, _Race): res = await _arace(self._llm(llms, {})[0], kw)
+                        else: llm, kw = self._llm(llms, kw); res = await llm.agenerate(**kw)
+                    except Exception as e:
+                        _waited(sp, t); kw = calls.throw(e)
+                    else:
+                        _waited(sp, t); kw = calls.send(res)
+            except StopIteration as done:
+                return done.value
+            finally:
+                sp.set(**{"sutra.retries": max(0, sp.attrs.get("sutra.model_calls", 0) - 1)})
+
+    def _call(self, kw, key, span):
+        """One generate() call (a sub-generator of _calls), hedged when self.hedge is set."""
+        if not self.hedge:
+            return (yield kw)
+        delay, t0 = HEDGES.threshold(key, self.hedge), time.monotonic()
+        if delay is None:
+            raw = yield kw
+            HEDGES.record(key, latency=time.monotonic() - t0)
+            return raw
+        accept = (lambda raw: self._parse(raw) is not None) if self.expects_json else (lambda raw: True)
+        launch = lambda i: HEDGES.allow(key, self.hedge_budget)
+        race = _Race([dict(kw, stream=True), dict(kw, stream=True, on_token=None)], accept, delay, launch)
+        results = yield race
+        i, raw = results[-1]
+        if len(race.started) > 1 and span: span.add({"sutra.hedges": 1, "sutra.hedge_wins": int(i == 1)})
+        if i == 0: HEDGES.record(key, latency=race.times[0])
+        else: HEDGES.record(key, hedge_won_at=race.started[1] + race.times[1])
+        return raw
+
+    def _confident(self, value)->bool:
+        """True when value passes the confidence check (always, without one)."""
+        c = self.confidence
+        if c is None: return True
+        if callable(c): return bool(c(value))
+        try:
+            return all(float(it[c]) >= self.min_confidence for it in (value if isinstance(value, list) else [value]))
+        except (KeyError, TypeError, ValueError):
+            return False
+
+    def _calls(self, inputs: dict):
+        """The attempt loop as a generator: yields generate() kwargs, receives the
+        raw text back, and returns the output dict. run()/arun() only drive it."""
+        p, sizes = self.render(inputs)
+        span = _SPAN.get()
+        if span:
+            span.set(**{"sutra.prompt_chars": len(p), "sutra.prompt_tokens_est": _est_tokens(p)})
+            if sizes["truncated"]: span.set(**{"sutra.truncated": ",".join(sizes["truncated"])})
+        base = {}
+        if SHARED_PREFIX if self.shared_prefix is None else self.shared_prefix:
+            pre = self.prefix()
+            if pre.strip() and p.startswith(pre) and len(p) > len(pre):
+                p, base = p[len(pre):], {"system": pre}
+                if span: span.set(**{"sutra.prefix_chars": len(pre)})
+        if not self.cascade:
+            value, ok = yield from self._attempts(p, self.model, self.retries + 1, base, span)
+            return {self.output_key: value}
+
+        tiers = self.cascade if self.model in self.cascade else self.cascade + [self.model]
+        for t, model in enumerate(tiers):
+            final = t == len(tiers) - 1
+            # Cheaper tiers get one attempt and the cascade timeout; the last one the usual retries.
+            extra = {**base, "model": model} if final or self.cascade_timeout is None else \
+                    {**base, "model": model, "timeout": self.cascade_timeout}
+            try:
+                value, ok = yield from self._attempts(p, model, self.retries + 1 if final else 1, extra, span)
+            except (RuntimeError, TimeoutError) as e:
+                if final: raise
+                reason = "timeout" if isinstance(e, TimeoutError) or any(
+                    w in str(e).lower() for w in ("timed out", "timeout")) else "error"
+            else:
+                if not ok and value.get("error") == "deadline":
+                    # No time left: a costlier tier would not fit either.
+                    if not final: CASCADES.record(self.name, model, reason="deadline")
+                    return {self.output_key: value}
+                if final or (ok and self._confident(value)):
+                    CASCADES.record(self.name, model, served=True)
+                    if span: span.set(**{"sutra.tier": t, "sutra.served_model": model})
+                    return {self.output_key: value}
+                reason = "confidence" if ok else "invalid"
+            CASCADES.record(self.name, model, reason=reason)
+            if span: span.add({"sutra.escalations": 1})
+
+    def _attempts(self, p, model, attempts, extra, span):
+        """Up to `attempts` tries of prompt p on model (a sub-generator of _calls);
+        returns (output value, valid). Under a deadline, no further call is made
+        once a typical generation on model no longer fits in the time left."""
+        key = (model, self.name)
         last_raw = ""
+        on_token = self.on_token or ON_TOKEN
+        stream = self.stream or on_token is not None
+        # Stop early only on a reply that required_keys or a schema can recognise as complete.
+        stop_when = self._done if (stream and self.expects_json and (self.required_keys or self.schema)) else None
+        fmt = self.schema or True   # json_mode value: a schema constrains decoding
+        out_of_time = False
 
-        modes = ([True, False] if self.expects_json else [False])
-        for a in range(attempts):
-            prompt_now = p if a == 0 else p + "\n\nReturn ONLY valid JSON."
-            for jm in modes:
-                raw = llm.generate(
-                    prompt_now,
-                    json_mode=jm and self.expects_json,
-                    temperature=self.temperature
-                )
-                last_raw = raw.strip()
+        try:
+            for a in range(attempts):
+                if a and not _room(model):
+                    out_of_time = True; break
+                prompt_now = p if a == 0 else p + "\n\nReturn ONLY valid JSON."
+                call = dict(prompt=prompt_now, temperature=self.temperature,
+                            stream=stream, on_token=on_token, stop_when=stop_when, **extra)
 
                 if not self.expects_json:
-                    return {self.output_key: raw}
+                    raw = yield from self._call(dict(call, json_mode=False), key, span)
+                    return raw, True
 
-                obj = None
-                try:
-                    obj = json.loads(raw)
-                except:
-                    obj = _extract_json(raw)
+                # Likely-winning JSON mode first; both at once when racing.
+                modes = JSON_MODES.order(key)
+                if self.race_modes and len(modes) > 1:
+                    race = [dict(call, json_mode=jm and fmt, stream=True, on_token=on_token if i == 0 else None)
+                            for i, jm in enumerate(modes)]
+                    results = yield _Race(race, lambda raw: self._parse(raw) is not None)
+                else:
+                    results = []
+                    for i, jm in enumerate(modes):
+                        if i and not _room(model):
+                            out_of_time = True; break
+                        raw = yield from self._call(dict(call, json_mode=jm and fmt), key, span)
+                        results.append((i, raw))
+                        if self._parse(raw) is not None: break
+                for i, raw in results:
+                    last_raw = raw.strip()
+                    obj = self._parse(raw)
+                    JSON_MODES.record(key, modes[i], obj is not None)
+                    if obj is None and span: span.add({"sutra.parse_failures": 1})
+                    if obj is not None:
+                        JSON_MODES.finish(key, True)
+                        return obj, True
+        except DeadlineExceeded as e:
+            if span: span.set(**{"sutra.deadline": True})
+            return {"error": "deadline", "message": str(e), "raw": last_raw[:2000]}, False
+
+        JSON_MODES.finish(key, False)
+        if out_of_time:
+            if span: span.set(**{"sutra.deadline": True})
+            return {"error": "deadline", "message": "no time left for another attempt", "raw": last_raw[:2000]}, False
+        return {"error":"invalid_json", "raw": last_raw[:2000]}, False
+
+def pick(state, path, default=None):
+    """The value at a dotted path in state ("classifier.label"); lists (as JSON
+    agents return them) are entered at their first item."""
+    v = state
+    for k in path.split("."):
+        while isinstance(v, list): v = v[0] if v else None
+        if not isinstance(v, dict) or k not in v: return default
+        v = v[k]
+    return v
+
+def _failed(v)->bool:
+    return isinstance(v, dict) and "error" in v
+
+def _is_skipped(v)->bool:
+    return isinstance(v, dict) and "skipped" in v
 
-                obj = _coerce_json_shape(obj, self.required_keys)
-                ok, why = _validate(obj, self.required_keys)
-                if ok:
-                    return {self.output_key: obj}
+class Branch:
+    """Agent-like router for a Step: select (a function of the step's inputs, or a
+    dotted path into them) picks a key, and the agent in routes under that key
+    (else default) runs, its output stored under output_key. A route that is
+    None, or no route at all, skips the step. Use Step(Branch(...), takes=[...])."""
+    def __init__(self, name, select, routes, default=None, output_key=None):
+        self.name=name; self.select=select; self.routes=dict(routes); self.default=default
+        agents = [a for a in list(self.routes.values()) + [default] if a is not None]
+        self.output_key = output_key or (agents[0].output_key if agents else name)
 
-        return {self.output_key: {"error":"invalid_json", "raw": last_raw[:2000]}}
+    def fingerprint(self)->dict:
+        fp = lambda a: a.fingerprint() if hasattr(a, "fingerprint") else getattr(a, "name", None)
+        return {"name": self.name, "output_key": self.output_key, "default": fp(self.default),
+                "routes": {str(k): fp(a) for k, a in self.routes.items()},
+                "select": self.select if isinstance(self.select, str) else getattr(self.select, "__qualname__", "")}
+
+    def route(self, inputs: dict):
+        """(route key, agent or None)."""
+        key = pick(inputs, self.select) if isinstance(self.select, str) else self.select(inputs)
+        agent = self.routes.get(key, self.default) if _hashable(key) else self.default
+        sp = _SPAN.get()
+        if sp: sp.set(**{"sutra.route": str(key)})
+        return key, agent
+
+    def _why(self, key):
+        return f"route {key!r}" if _hashable(key) and key in self.routes else f"no route for {key!r}"
+
+    def run(self, inputs: dict)->dict:
+        key, agent = self.route(inputs)
+        if agent is None: return {self.output_key: {"skipped": self._why(key)}}
+        return {self.output_key: agent.run(inputs)[agent.output_key]}
+
+    async def arun(self, inputs: dict)->dict:
+        import asyncio
+        key, agent = self.route(inputs)
+        if agent is None: return {self.output_key: {"skipped": self._why(key)}}
+        out = await agent.arun(inputs) if hasattr(agent, "arun") else await asyncio.to_thread(agent.run, inputs)
+        return {self.output_key: out[agent.output_key]}
+
+def _prompt_fields(agent)->list:
+    """The state keys an agent's prompt template reads ({text}, {analyzer[0]} -> analyzer);
+    for a Branch, those of all its routes plus the root of a select path."""
+    if isinstance(agent, Branch):
+        keys = [agent.select.split(".", 1)[0]] if isinstance(agent.select, str) else []
+        keys += [k for a in list(agent.routes.values()) + [agent.default] if a is not None for k in _prompt_fields(a)]
+        return list(dict.fromkeys(keys))
+    prompt = getattr(agent, "prompt", None)
+    if not isinstance(prompt, str): return []
+    fields = (re.split(r"[.\[]", f, 1)[0] for _, f, _, _ in string.Formatter().parse(prompt) if f)
+    return list(dict.fromkeys(f for f in fields if f != "objective"))
+
+def _hashable(v)->bool:
+    try: hash(v); return True
+    except TypeError: return False
 
 class Step:
-    def __init__(self, agent: 'Agent', takes=None, on_error="continue"):
-        self.agent=agent; self.takes=takes or []; self.on_error=on_error
+    def __init__(self, agent: 'Agent', takes=None, on_error="continue", after=None, hooks=None,
+                 when=None, skip_failed=True):
+        # takes entries are state keys or dotted projections ("analyzer.issue.description"):
+        # the agent then sees analyzer reduced to {"issue": {"description": ...}}.
+        self.agent=agent; self.takes=takes or []; self.on_error=on_error; self.after=after or []
+        self.hooks=list(hooks or [])
+        # when: a predicate on the state, or a dotted path that must be truthy, for the step to run.
+        # skip_failed: skip when an input failed (or, for keys named in takes, was skipped);
+        # without takes, the inputs are the keys the agent's prompt reads.
+        self.when=when; self.skip_failed=skip_failed
+    def skip_reason(self, state: dict):
+        """Why this step should not run on state, or None."""
+        if self.skip_failed:
+            for k in self.keys or _prompt_fields(self.agent):
+                v = state.get(k)
+                if _failed(v): return f"{k} failed"
+                if self.takes and _is_skipped(v): return f"{k} skipped"
+        if self.when is not None:
+            ok = pick(state, self.when) if isinstance(self.when, str) else self.when(state)
+            if not ok: return "condition not met"
+        return None
+    def _skip(self, state: dict):
+        """The outputs of a skipped step, or None when it should run."""
+        why = self.skip_reason(state)
+        return None if why is None else {self.agent.output_key: {"skipped": why}}
+    @property
+    def keys(self)->list:
+        """The state keys takes reads (the roots of any projections)."""
+        return list(dict.fromkeys(t.split(".", 1)[0] for t in self.takes))
+    def inputs(self, state: dict)->dict:
+        """The part of state this step's agent sees."""
+        if not self.takes: return state
+        out = {}
+        for t in self.takes:
+            k, *path = t.split(".")
+            v = _project(state.get(k), path)
+            out[k] = _merge(out[k], v) if k in out else v
+        return out
+    def run(self, state: dict)->dict:
+        """Run the agent on the keys in takes and return only its outputs."""
+        skipped = self._skip(state)
+        if skipped is not None: return skipped
+        subset = self.inputs(state)
+        try:
+            return self.agent.run(subset)
+        except Exception as e:
+            if self.on_error=="stop": raise
+            return { self.agent.output_key: {"error":"exception", "message": str(e)} }
     def __call__(self, state: dict)->dict:
-        subset = {k: state.get(k) for k in self.takes} if self.takes else state
+        new = state.copy(); new.update(self.run(state)); return new
+    async def arun(self, state: dict)->dict:
+        """Async run(); agents without arun() (e.g. plain mocks) run in a worker thread."""
+        import asyncio
+        skipped = self._skip(state)
+        if skipped is not None: return skipped
+        subset = self.inputs(state)
+        try:
+            if hasattr(self.agent, "arun"): return await self.agent.arun(subset)
+            return await asyncio.to_thread(self.agent.run, subset)
+        except Exception as e:
+            if self.on_error=="stop": raise
+            return { self.agent.output_key: {"error":"exception", "message": str(e)} }
+    async def acall(self, state: dict)->dict:
+        new = state.copy(); new.update(await self.arun(state)); return new
+
+def _boundary(buf, chars)->int:
+    """Where to cut buf to at most chars: the last paragraph, line, sentence or
+    word break in the second half of the window, else chars."""
+    for sep in ("\n\n", "\n", ". ", " "):
+        i = buf.rfind(sep, chars // 2, chars)
+        if i > 0: return i + len(sep)
+    return chars
+
+def chunk_text(source, tokens=1500, overlap=100):
+    """Overlapping chunks of about tokens from a string, a file object or an
+    iterable of strings. The source is read incrementally, so only the current
+    chunk is held in memory."""
+    chars = max(1, tokens * CHARS_PER_TOKEN); overlap = min(overlap * CHARS_PER_TOKEN, chars // 2)
+    if isinstance(source, str): pieces = [source]
+    elif hasattr(source, "read"): pieces = iter(lambda: source.read(1 << 16), "")
+    else: pieces = source
+    buf, fresh = "", 0   # buf[fresh:] has not been sent in a chunk yet
+    for piece in pieces:
+        buf += piece
+        while len(buf) > chars:
+            cut = _boundary(buf, chars)
+            yield buf[:cut]
+            start = buf.find(" ", cut - overlap, cut) + 1 or cut - overlap
+            buf, fresh = buf[start:], cut - start
+    if buf[fresh:].strip(): yield buf
+
+def merge_json(values):
+    """Reduce chunk outputs: lists are concatenated without duplicates, dicts
+    merged key by key, and for anything else the first non-empty value wins."""
+    values = [v for v in values if v not in (None, "", [], {})]
+    if not values: return None
+    if all(isinstance(v, list) for v in values):
+        out, seen = [], set()
+        for it in (x for v in values for x in v):
+            k = json.dumps(it, sort_keys=True, default=str)
+            if k not in seen: seen.add(k); out.append(it)
+        return out
+    if all(isinstance(v, dict) for v in values):
+        return {k: merge_json([v.get(k) for v in values]) for k in dict.fromkeys(k for v in values for k in v)}
+    return values[0]
+
+def concat_outputs(values):
+    """Reduce chunk outputs by concatenation: text joined by blank lines, lists chained."""
+    values = [v for v in values if v not in (None, "")]
+    if all(isinstance(v, str) for v in values): return "\n\n".join(values)
+    return [x for v in values for x in (v if isinstance(v, list) else [v])]
+
+class MapReduceStep(Step):
+    """A step for inputs too long for one prompt: state[field] is split into
+    overlapping chunks of about chunk_tokens, the agent runs on each chunk
+    (at most `workers` at once, reading the source only as fast as chunks are
+    taken), and the chunk outputs are combined by reduce. reduce is a function
+    of the list of outputs, "merge" (merge_json, the default for JSON agents),
+    "concat" (concat_outputs, the default otherwise) or an Agent that sees the
+    outputs as {chunks}; with an agent, outputs that do not fit in chunk_tokens
+    are reduced in groups first, for at most REDUCE_ROUNDS rounds and only
+    while the groups keep shrinking; then one last call reduces everything left.
+    field may also hold a file object or an iterable of strings."""
+    REDUCERS = {"merge": merge_json, "concat": concat_outputs}
+    REDUCE_ROUNDS = 8
+
+    def __init__(self, agent: 'Agent', field="text", chunk_tokens=1500, overlap=100, reduce=None,
+                 workers=4, takes=None, on_error="continue", after=None, hooks=None, when=None, skip_failed=True):
+        takes = list(takes or [])
+        if takes and field not in (t.split(".", 1)[0] for t in takes): takes.append(field)
+        super().__init__(agent, takes, on_error, after, hooks, when, skip_failed)
+        self.field=field; self.chunk_tokens=chunk_tokens; self.overlap=overlap; self.workers=workers
+        if reduce is None: reduce = "merge" if getattr(agent, "expects_json", False) else "concat"
+        self.reduce = self.REDUCERS[reduce] if isinstance(reduce, str) else reduce
+
+    def fingerprint(self)->dict:
+        r = self.reduce
+        return {"field": self.field, "chunk_tokens": self.chunk_tokens, "overlap": self.overlap,
+                "reduce": r.fingerprint() if hasattr(r, "fingerprint") else getattr(r, "__qualname__", repr(r))}
+
+    def _chunks(self, subset):
+        return chunk_text(subset.get(self.field) or "", self.chunk_tokens, self.overlap)
+
+    def _collect(self, outs):
+        """Chunk outputs in order, minus failed ones; counts go on the step span."""
+        key = self.agent.output_key
+        vals = [outs[i].get(key) for i in sorted(outs)]
+        ok = [v for v in vals if not (isinstance(v, dict) and "error" in v)]
+        sp = _SPAN.get()
+        if sp: sp.set(**{"sutra.chunks": len(vals), "sutra.chunk_errors": len(vals) - len(ok)})
+        if vals and not ok: return None, vals[-1]
+        return ok, None
+
+    def _chunk_out(self, f):
+        """A finished chunk's output; an exception becomes that chunk's error for _collect."""
+        try: return f.result()
+        except Exception as e: return {self.agent.output_key: {"error": "exception", "message": str(e)}}
+
+    def _groups(self, vals):
+        """vals split into runs whose rendered size fits chunk_tokens (at least one value each)."""
+        out, cur = [], []
+        for v in vals:
+            if cur and _est_tokens(_dumps(cur + [v])) > self.chunk_tokens: out.append(cur); cur = []
+            cur.append(v)
+        return out + [cur]
+
+    def _rounds(self, vals):
+        """Groups to reduce, round by round (a sub-generator of _reduce/_areduce:
+        yields a round's groups, receives their outputs); returns what the final
+        call reduces. Stops when everything fits, after REDUCE_ROUNDS rounds, or
+        when a round would not shrink the values (reducer outputs too long to pair)."""
+        for r in range(self.REDUCE_ROUNDS):
+            groups = self._groups(vals)
+            if len(groups) == 1 or (r and len(groups) >= len(vals)): break
+            vals = yield groups
+        return vals
+
+    def _reduce(self, subset, vals):
+        if not isinstance(self.reduce, Agent): return self.reduce(vals)
+        rest, key = {k: v for k, v in subset.items() if k != self.field}, self.reduce.output_key
+        rounds = self._rounds(vals)
+        try:
+            groups = next(rounds)
+            while True: groups = rounds.send([self.reduce.run({**rest, "chunks": g})[key] for g in groups])
+        except StopIteration as done:
+            return self.reduce.run({**rest, "chunks": done.value})[key]
+
+    async def _areduce(self, subset, vals):
+        if not isinstance(self.reduce, Agent): return self.reduce(vals)
+        rest, key = {k: v for k, v in subset.items() if k != self.field}, self.reduce.output_key
+        rounds = self._rounds(vals)
         try:
-            out = self.agent.run(subset)
+            groups = next(rounds)
+            while True: groups = rounds.send([(await self.reduce.arun({**rest, "chunks": g}))[key] for g in groups])
+        except StopIteration as done:
+            return (await self.reduce.arun({**rest, "chunks": done.value}))[key]
+
+    def _map_reduce(self, subset):
+        outs, pending = {}, {}
+        with ThreadPoolExecutor(max_workers=self.workers) as ex:
+            try:
+                for i, chunk in enumerate(self._chunks(subset)):
+                    if len(pending) >= self.workers:
+                        for f in wait(pending, return_when=FIRST_COMPLETED)[0]: outs[pending.pop(f)] = self._chunk_out(f)
+                    pending[ex.submit(_in_context(self.agent.run), {**subset, self.field: chunk})] = i
+                for f in as_completed(pending): outs[pending[f]] = self._chunk_out(f)
+            finally:
+                for f in pending: f.cancel()
+        vals, err = self._collect(outs)
+        return {self.agent.output_key: err if err is not None else self._reduce(subset, vals)}
+
+    async def _amap_reduce(self, subset):
+        import asyncio
+        run = self.agent.arun if hasattr(self.agent, "arun") else (lambda inp: asyncio.to_thread(self.agent.run, inp))
+        outs, pending = {}, {}
+        try:
+            for i, chunk in enumerate(self._chunks(subset)):
+                if len(pending) >= self.workers:
+                    for t in (await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED))[0]:
+                        outs[pending.pop(t)] = self._chunk_out(t)
+                pending[asyncio.ensure_future(run({**subset, self.field: chunk}))] = i
+            if pending:
+                for t in (await asyncio.wait(pending))[0]: outs[pending[t]] = self._chunk_out(t)
+            pending = {}
+        finally:
+            for t in pending: t.cancel()
+        vals, err = self._collect(outs)
+        return {self.agent.output_key: err if err is not None else await self._areduce(subset, vals)}
+
+    def run(self, state: dict)->dict:
+        """Map the agent over the chunks of state[field] and reduce the outputs."""
+        skipped = self._skip(state)
+        if skipped is not None: return skipped
+        try:
+            return self._map_reduce(self.inputs(state))
         except Exception as e:
             if self.on_error=="stop": raise
-            out = { self.agent.output_key: {"error":"exception", "message": str(e)} }
-        new = state.copy(); new.update(out); return new
+            return { self.agent.output_key: {"error":"exception", "message": str(e)} }
+
+    async def arun(self, state: dict)->dict:
+        skipped = self._skip(state)
+        if skipped is not None: return skipped
+        try:
+            return await self._amap_reduce(self.inputs(state))
+        except Exception as e:
+            if self.on_error=="stop": raise
+            return { self.agent.output_key: {"error":"exception", "message": str(e)} }
+
+class _Run:
+    """Per-run bookkeeping shared by the sequential, DAG and async executors."""
+    def __init__(self, trace=None, reuse=None):
+        self.trace = trace; self.reuse = reuse or {}
+        self.ahead = None  # with a deadline: per step, the longest chain of steps from it to the end
+
+def _step_key(st, s):
+    """Memo key for a step: its agent's fingerprint plus the values it takes."""
+    fp = getattr(st.agent, "fingerprint", None)
+    if fp is None: return None
+    import hashlib
+    subset = st.inputs(s)
+    parts = [fp(), st.takes, subset] + ([st.fingerprint()] if hasattr(st, "fingerprint") else [])
+    raw = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
 
 class Pipeline:
-    def __init__(self, steps):
+    """Runs steps in order (mode="sequential") or as a dependency graph (mode="dag").
+
+    In dag mode a step waits for every earlier step that writes a key it takes
+    (all earlier steps if takes is empty), that writes the same output_key, that
+    reads the key it writes, or that it names in after=[...]. Independent steps
+    run concurrently on up to `workers` threads; outputs are merged in
+    declaration order, so the result does not depend on completion order.
+    """
+    def __init__(self, steps, mode="sequential", workers=None, name=None, hooks=None, backends=None):
         if not steps: raise ValueError("Pipeline needs steps")
-        self.steps = steps
-    def run(self, initial: dict)->dict:
-        s = dict(initial or {}); tr = Trace()
-        for st in self.steps:
-            tr.dump(f"{st.agent.name}_in", s)
-            s = st(s)
-            tr.dump(f"{st.agent.name}_out", s)
+        if mode not in ("sequential", "dag"): raise ValueError(f"Unknown pipeline mode: {mode}")
+        self.steps = steps; self.mode = mode; self.workers = workers; self.name = name
+        self.hooks = list(hooks or [])  # span hooks for this pipeline's runs, steps and calls
+        # Ollama hosts (list, comma-separated str or BackendPool) for agents without their own host.
+        self.backends = backends if backends is None or isinstance(backends, BackendPool) else BackendPool(backends)
+        self.last_run = None  # run id of the most recent traced run
+        self.last_dedup = None  # NearDuplicates of the most recent run_many(dedup=...)
+    def run(self, initial: dict, trace=True, reuse=None, deadline=None)->dict:
+        """trace is True (TRACE_LEVEL), False, or one of TRACE_LEVELS.
+        reuse maps step indices to outputs that are used instead of running them.
+        deadline (seconds) bounds the run: see _step_budget."""
+        s = dict(initial or {})
+        with self._span() as sp, self._routing(), self._deadline(deadline):
+            run = self._start(trace, s, reuse, sp)
+            status = "error"
+            try:
+                if self.mode == "dag": s = self._run_dag(s, run)
+                else:
+                    for j, st in enumerate(self.steps):
+                        s = {**s, **self._step(j, st, s, run)}
+                status = "ok"
+            finally:
+                if run.trace: run.trace.end(status)
         return s
 
+    async def arun(self, initial: dict, trace=True, timeout=None, reuse=None, deadline=None)->dict:
+        """Async run(). timeout (seconds) bounds the whole pipeline; cancelling the
+        task cancels in-flight model requests and closes their connections.
+        deadline works as in run(): steps share it and return partial results."""
+        import asyncio
+        s = dict(initial or {})
+        with self._span() as sp, self._routing(), self._deadline(deadline):
+            run = self._start(trace, s, reuse, sp)
+            status = "error"
+            try:
+                s = await asyncio.wait_for(self._arun(s, run), timeout)
+                status = "ok"
+            finally:
+                if run.trace: run.trace.end(status)
+        return s
+
+    def resume(self, run_id, from_step=None, trace=True, deadline=None)->dict:
+        """Re-run a traced run, reusing the outputs of its successful steps.
+
+        Steps are reused in order up to the first one that failed or never ran,
+        and never from from_step (a step name) onwards.
+        """
+        initial, done = Trace.load(run_id)
+        names = [st.agent.name for st in self.steps]
+        if from_step is not None and from_step not in names:
+            raise ValueError(f"Unknown step {from_step!r}; steps are {names}")
+        reuse = {}
+        for j, name in enumerate(names[:names.index(from_step) if from_step else None]):
+            out, status = done.get(name, (None, None))
+            if status not in ("ok", "reused", "memo"): break
+            reuse[j] = out
+        return self.run(initial, trace=trace, reuse=reuse, deadline=deadline)
+
+    @contextlib.contextmanager
+    def _routing(self):
+        """Make this pipeline's backends the default for Ollama calls made inside."""
+        token = _BACKEND_POOL.set(self.backends) if self.backends else None
+        try:
+            yield
+        finally:
+            if token: _BACKEND_POOL.reset(token)
+
+    @contextlib.contextmanager
+    def _deadline(self, seconds):
+        token = _DEADLINE.set(time.monotonic() + seconds) if seconds is not None else None
+        try:
+            yield
+        finally:
+            if token: _DEADLINE.reset(token)
+
+    def _ahead(self)->list:
+        """For each step, how many steps (itself included) still have to run after it
+        starts: the rest of the list, or in dag mode the longest chain of dependents."""
+        if self.mode != "dag": return [len(self.steps) - j for j in range(len(self.steps))]
+        deps, out = self.deps(), [1] * len(self.steps)
+        for j in reversed(range(len(self.steps))):
+            out[j] = 1 + max((out[k] for k in range(j + 1, len(self.steps)) if j in deps[k]), default=0)
+        return out
+
+    @contextlib.contextmanager
+    def _step_budget(self, j, run):
+        """Under a run deadline, give step j an equal share of the time left across
+        the steps still ahead of it (its calls get shrinking timeouts and
+        num_predict caps); yields False when the deadline has already passed."""
+        end = _DEADLINE.get()
+        if end is None:
+            yield True; return
+        now = time.monotonic()
+        if now >= end:
+            yield False; return
+        if run.ahead is None: run.ahead = self._ahead()
+        token = _DEADLINE.set(now + (end - now) / run.ahead[j])
+        try:
+            yield True
+        finally:
+            _DEADLINE.reset(token)
+
+    def _span(self):
+        return Span(f"pipeline {self.name or ''}".rstrip(), "pipeline", self.hooks,
+                    {"sutra.pipeline": self.name, "sutra.mode": self.mode})
+
+    def _start(self, trace, s, reuse, span=None):
+        tr = Trace.open(trace, pipeline=self.name)
+        if tr:
+            tr.start(s); self.last_run = tr.id
+            if span: span.set(**{"sutra.run_id": tr.id})
+        return _Run(tr, reuse)
+
+    def _step_span(self, j, st, queued=None):
+        sp = Span(f"step {st.agent.name}", "step", getattr(st, "hooks", ()), {"sutra.step": st.agent.name, "sutra.index": j})
+        if queued is not None: sp.set(**{"sutra.queue_ms": round((time.monotonic() - queued) * 1000, 3)})
+        return sp
+
+    def _step(self, j, st, s, run, queued=None):
+        """Run one step on state s and return its outputs, tracing it."""
+        t0 = time.time()
+        with self._step_span(j, st, queued) as sp:
+            delta, key = self._lookup(j, st, s, run, t0, sp)
+            if delta is not None: return delta
+            try:
+                with self._step_budget(j, run) as ok:
+                    delta = st.run(s) if ok else {st.agent.output_key: {"skipped": "deadline"}}
+            except Exception as e:
+                sp.set(**{"sutra.status": "exception"})
+                if run.trace: run.trace.step(j, st, {}, t0, error=str(e))
+                raise
+            return self._record(j, st, delta, key, run, t0, sp)
+
+    async def _astep(self, j, st, s, run, queued=None):
+        t0 = time.time()
+        with self._step_span(j, st, queued) as sp:
+            delta, key = self._lookup(j, st, s, run, t0, sp)
+            if delta is not None: return delta
+            try:
+                with self._step_budget(j, run) as ok:
+                    delta = await st.arun(s) if ok else {st.agent.output_key: {"skipped": "deadline"}}
+            except Exception as e:
+                sp.set(**{"sutra.status": "exception"})
+                if run.trace: run.trace.step(j, st, {}, t0, error=str(e))
+                raise
+            return self._record(j, st, delta, key, run, t0, sp)
+
+    def _lookup(self, j, st, s, run, t0, sp):
+        """Outputs recorded for this step (resume, then memo) or None, plus the memo key."""
+        if j in run.reuse:
+            delta, status, key = run.reuse[j], "reused", None
+        else:
+            key = _step_key(st, s) if MEMO else None
+            hit = MEMO.get(key) if key else None
+            if hit is None: return None, key
+            delta, status = json.loads(hit), "memo"
+        sp.set(**{"sutra.status": status})
+        if run.trace: run.trace.step(j, st, delta, t0, status=status)
+        return delta, key
+
+    def _record(self, j, st, delta, key, run, t0, sp):
+        failed = any(isinstance(v, dict) and "error" in v for v in delta.values())
+        skipped = bool(delta) and all(_is_skipped(v) for v in delta.values())
+        sp.set(**{"sutra.status": "error" if failed else "skipped" if skipped else "ok"})
+        if skipped:
+            sp.set(**{"sutra.skipped": 1})
+            if run.trace: run.trace.step(j, st, delta, t0, status="skipped")
+            return delta
+        if key and not failed: MEMO.put(key, json.dumps(delta, ensure_ascii=False))
+        if run.trace: run.trace.step(j, st, delta, t0)
+        return delta
+
+    async def _arun(self, s, run):
+        import asyncio
+        if self.mode != "dag":
+            for j, st in enumerate(self.steps):
+                s = {**s, **await self._astep(j, st, s, run)}
+            return s
+
+        base, left = dict(s), dict(enumerate(self.deps()))
+        deltas, running = [{}] * len(self.steps), {}
+        gate = asyncio.Semaphore(self.workers or len(self.steps))
+        async def gated(j, snap):
+            queued = time.monotonic()
+            async with gate: return await self._astep(j, self.steps[j], snap, run, queued)
+        try:
+            while left or running:
+                for j in [j for j, d in left.items() if not d]:
+                    del left[j]
+                    running[asyncio.ensure_future(gated(j, dict(s)))] = j
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for f in sorted(done, key=running.get):
+                    j = running.pop(f)
+                    deltas[j] = f.result()
+                    s.update(deltas[j])
+                    for d in left.values(): d.discard(j)
+        finally:
+            for f in running: f.cancel()
+        for d in deltas: base.update(d)
+        return base
+
+    def deps(self)->list:
+        """For each step, the set of indices of earlier steps it must wait for."""
+        index = {st.agent.name: i for i, st in enumerate(self.steps)}
+        out = []
+        for j, b in enumerate(self.steps):
+            wb, d = b.agent.output_key, set()
+            for name in getattr(b, "after", ()):
+                if index.get(name, j) >= j:
+                    raise ValueError(f"[{b.agent.name}] after={name!r} must name an earlier step")
+                d.add(index[name])
+            for i, a in enumerate(self.steps[:j]):
+                wa = a.agent.output_key
+                if not b.takes or wa in b.keys or wa == wb or not a.takes or wb in a.keys:
+                    d.add(i)
+            out.append(d)
+        return out
+
+    def _run_dag(self, s, run):
+        base, left = dict(s), dict(enumerate(self.deps()))
+        deltas, running = [{}] * len(self.steps), {}
+        with ThreadPoolExecutor(max_workers=self.workers or len(self.steps)) as ex:
+            while left or running:
+                for j in [j for j, d in left.items() if not d]:
+                    del left[j]
+                    running[ex.submit(_in_context(self._step), j, self.steps[j], dict(s), run, time.monotonic())] = j
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for f in sorted(done, key=running.get):
+                    j = running.pop(f)
+                    deltas[j] = f.result()
+                    s.update(deltas[j])
+                    for d in left.values(): d.discard(j)
+        for d in deltas: base.update(d)
+        return base
+
+    def run_many(self, items, workers=4, per_model=None, ordered=True, trace=False, deadline=None, dedup=None):
+        """Run many inputs concurrently and yield (key, state) pairs.
+
+        items is any iterable of input dicts, or of (key, input) pairs; plain
+        dicts are keyed by their position. It is consumed lazily and at most
+        2*workers items are in flight or buffered, so memory stays flat for any
+        corpus size. ordered=False yields in completion order. per_model caps
+        concurrent generations per model. A failing item yields an error state
+        instead of aborting the batch. deadline (seconds) applies to each item.
+
+        dedup (a similarity threshold, True for 0.9, or a NearDuplicates) runs
+        the pipeline once per cluster of near-duplicate inputs: later members get
+        their representative's outputs, with their own inputs and
+        "_dedup": {"of": key, "similarity": s}. Only the outputs (not the whole
+        state) of at most dedup.max_size representatives are kept, so memory
+        stays bounded too. self.last_dedup holds the counts, including model
+        calls avoided.
+        """
+        dd = self.last_dedup = (None if dedup is None or dedup is False else dedup if isinstance(dedup, NearDuplicates)
+                                else NearDuplicates() if dedup is True else NearDuplicates(dedup))
+        # Representatives in flight, the near-duplicates waiting on them, and model calls each made.
+        running, waiting, calls, lock = set(), {}, {}, threading.Lock()
+        gate = _ModelGate(per_model) if per_model else None   # this call's own cap, not the global one
+        def one(inp, key=None):
+            if gate: _MODEL_GATE.set(gate)   # one runs in a copied context
+            try:
+                if dd is None: return self.run(inp, trace=trace, deadline=deadline)
+                with Span("dedup representative", "internal") as sp:
+                    try: return self.run(inp, trace=trace, deadline=deadline)
+                    finally: calls[key] = sp.attrs.get("sutra.model_calls", 0)
+            except Exception as e:
+                return {"error": "exception", "message": str(e)}
+        def resolve(fut, rep, sim, inp, kept):
+            outputs, n = kept
+            if n is None: fut.set_result(dict(outputs)); return    # the representative failed
+            dd.avoided(n)
+            fut.set_result({**inp, **outputs, "_dedup": {"of": rep, "similarity": sim}})
+        def settle(key, inp, done):
+            out, n = done.result(), calls.pop(key, 0)
+            kept = (out, None) if set(out) == {"error", "message"} else \
+                   ({k: v for k, v in out.items() if k not in inp or v is not inp[k]}, n)
+            with lock:
+                running.discard(key); dd.keep(key, kept); waiters = waiting.pop(key, [])
+            for w in waiters: resolve(*w, kept)
+        def reuse(rep, sim, inp):
+            fut = Future()
+            with lock:
+                if rep in running:
+                    waiting.setdefault(rep, []).append((fut, rep, sim, inp)); return fut
+                kept = dd.kept(rep)
+            resolve(fut, rep, sim, inp, kept)
+            return fut
+
+        it = iter(items)
+        window, pending, idx = max(1, workers) * 2, {}, 0
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as ex:
+            while True:
+                while len(pending) < window:
+                    try: item = next(it)
+                    except StopIteration: break
+                    key, inp = item if isinstance(item, tuple) else (idx, item)
+                    near = dd and dd.add(key, inp)
+                    if near: fut = reuse(*near, inp)
+                    elif dd:
+                        with lock: running.add(key)
+                        fut = ex.submit(_in_context(one), inp, key)
+                        fut.add_done_callback(lambda f, k=key, i=inp: settle(k, i, f))
+                    else:
+                        fut = ex.submit(_in_context(one), inp, key)
+                    pending[fut] = (idx, key); idx += 1
+                if not pending: break
+                if ordered:
+                    fut = min(pending, key=lambda f: pending[f][0])
+                    fut.result()
+                    done = [fut]
+                else:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    done = sorted(done, key=lambda f: pending[f][0])
+                for fut in done:
+                    yield pending.pop(fut)[1], fut.result()
+
+    def run_stages(self, items, workers=4, trace=False, chunk=256, keep_alive="30m", prewarm=True):
+        """Like run_many(), but scheduled by model rather than by item, so a box
+        that cannot hold every model at once is not made to swap per item.
+
+        Items are taken `chunk` at a time. Among the steps that are ready (their
+        dependencies done for that item), all calls for one model run before the
+        next model is started: the current model while it has work, else the one
+        with the most ready calls. While a stage drains the next model is loaded
+        (prewarm). The current model carries over from one chunk to the next.
+        Calls carry keep_alive, except a model's last call of the whole run, which
+        asks Ollama to unload it (keep_alive=0). Yields (key, state) in input
+        order per chunk (reading one chunk ahead); self.last_schedule holds
+        stage, switch and load counts.
+        """
+        stats = self.last_schedule = {"items": 0, "stages": 0, "switches": 0, "prewarms": 0, "loads": {}, "load_s": {}}
+        def count_loads(span):
+            a = span["attributes"]
+            if span["kind"] == "client" and a.get("sutra.load_ms", 0) >= LOAD_THRESHOLD * 1000:
+                m = a.get("gen_ai.request.model")
+                stats["loads"][m] = stats["loads"].get(m, 0) + 1
+                stats["load_s"][m] = round(stats["load_s"].get(m, 0) + a["sutra.load_ms"] / 1000, 3)
+
+        it, idx, sched = iter(items), 0, {"current": None, "warmed": 0}
+        def take():
+            nonlocal idx
+            batch = []
+            for item in it:
+                key, inp = item if isinstance(item, tuple) else (idx, item)
+                batch.append((key, inp)); idx += 1
+                if len(batch) >= chunk: break
+            return batch
+        batch = take()
+        while batch:
+            nxt = take()   # a model is only unloaded in the last chunk
+            stats["items"] += len(batch)
+            with Span(f"schedule {self.name or ''}".rstrip(), "internal", [count_loads]), self._routing():
+                out = self._run_stages([inp for _, inp in batch], workers, trace, keep_alive, prewarm, stats,
+                                       sched, final=not nxt)
+            yield from zip([k for k, _ in batch], out)
+            batch = nxt
+
+    def _run_stages(self, inputs, workers, trace, keep_alive, prewarm, stats, sched, final=True):
+        deps = self.deps() if self.mode == "dag" else [{j - 1} if j else set() for j in range(len(self.steps))]
+        model = [getattr(st.agent, "model", None) for st in self.steps]
+        n = len(inputs)
+        states = [dict(inp or {}) for inp in inputs]
+        deltas = [[{}] * len(self.steps) for _ in range(n)]
+        done, failed = [set() for _ in range(n)], [None] * n
+        runs = [self._start(trace, states[i], None) for i in range(n)]
+        todo = {(i, j) for i in range(n) for j in range(len(self.steps))}
+        left = {m: sum(1 for _, j in todo if model[j] == m) for m in set(model)}
+        current, running, warmed = sched["current"], {}, sched["warmed"]
+
+        def unit(i, j, snap, ka):
+            if ka is not None: _CALL_OPTS.set({**_CALL_OPTS.get(), "keep_alive": ka})
+            return self._step(j, self.steps[j], snap, runs[i])
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as ex:
+            while todo or running:
+                ready = {}
+                for i, j in sorted(todo):
+                    if deps[j] <= done[i]: ready.setdefault(model[j], []).append((i, j))
+                busy = {model[j] for i, j in running.values() if i is not None}
+                if not ready.get(current) and current not in busy and ready:
+                    current = max(ready, key=lambda m: len(ready[m]))
+                    stats["switches"] += stats["stages"] > 0; stats["stages"] += 1
+                queued = ready.get(current, [])
+                free = max(0, workers - sum(1 for i, _ in running.values() if i is not None))
+                for i, j in queued[:free]:
+                    todo.discard((i, j)); left[model[j]] -= 1
+                    ka = None if model[j] is None else (keep_alive if left[model[j]] or not final else 0)
+                    running[ex.submit(_in_context(unit), i, j, dict(states[i]), ka)] = (i, j)
+                # Nothing more to start on this model: load the next one while it drains.
+                nxt = max((m for m in ready if m not in (current, None)), key=lambda m: len(ready[m]), default=None)
+                if prewarm and nxt and not queued[free:] and warmed != stats["stages"]:
+                    warmed = stats["stages"]; stats["prewarms"] += 1
+                    running[ex.submit(_in_context(Ollama(nxt).load), keep_alive)] = (None, nxt)
+                if not running: continue
+                fin, _ = wait(running, return_when=FIRST_COMPLETED)
+                for f in fin:
+                    i, j = running.pop(f)
+                    if i is None:
+                        # A failed prewarm only costs the warm-up.
+                        if f.exception() is None and f.result() >= LOAD_THRESHOLD:
+                            stats["loads"][j] = stats["loads"].get(j, 0) + 1
+                            stats["load_s"][j] = round(stats["load_s"].get(j, 0) + f.result(), 3)
+                        continue
+                    if failed[i] is not None: continue
+                    try:
+                        deltas[i][j] = f.result()
+                    except Exception as e:
+                        failed[i] = {"error": "exception", "message": str(e)}
+                        for u in [u for u in todo if u[0] == i]:
+                            todo.discard(u); left[model[u[1]]] -= 1
+                        if runs[i].trace: runs[i].trace.end("error")
+                        continue
+                    states[i].update(deltas[i][j]); done[i].add(j)
+                    if len(done[i]) == len(self.steps) and runs[i].trace: runs[i].trace.end("ok")
+        out = []
+        for i in range(n):
+            if failed[i] is not None:
+                out.append(failed[i]); continue
+            s = dict(inputs[i] or {})
+            for d in deltas[i]: s.update(d)
+            out.append(s)
+        sched.update(current=current, warmed=warmed)
+        return out
+
+# ---------- Bench ----------
+class _MockHandler(BaseHTTPRequestHandler):
+    protocol_version, disable_nagle_algorithm = "HTTP/1.1", True
+    def log_message(self, *a): pass
+
+    def _send(self, obj, code=200):
+        b = json.dumps(obj).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json"); self.send_header("Content-Length", str(len(b)))
+        self.end_headers(); self.wfile.write(b)
+
+    def _chunk(self, obj):
+        line = (json.dumps(obj) + "\n").encode("utf-8")
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line)); self.wfile.flush()
+
+    def _hung_up(self):
+        """True once the client closed the connection (early stop / cancel)."""
+        import select
+        if not select.select([self.connection], [], [], 0)[0]: return False
+        try: return not self.connection.recv(1, socket.MSG_PEEK)
+        except OSError: return True
+
+    def do_GET(self):
+        mock = self.server.mock
+        if self.path == "/api/tags": self._send({"models": [{"name": m} for m in mock.models]})
+        elif self.path == "/api/ps": self._send({"models": [{"name": m} for m in list(mock.loaded)]})
+        else: self._send({"error": "not found"}, 404)
+
+    def do_POST(self):
+        mock, t0 = self.server.mock, time.perf_counter()
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path not in ("/api/generate", "/api/chat"): return self._send({"error": "not found"}, 404)
+        chat = self.path == "/api/chat"
+        if chat: body["prompt"] = "\n".join(str(m.get("content", "")) for m in body.get("messages") or [])
+        if isinstance(body.get("format"), dict) and not mock.schemas:
+            return self._send({"error": "json: cannot unmarshal object into Go struct field "
+                                        "GenerateRequest.format of type string"}, 400)
+        load = mock._load(body.get("model"))
+        if "prompt" not in body or (chat and not body.get("messages")):     # load request
+            mock._unload(body.get("model"), body.get("keep_alive"))
+            return self._send({"model": body.get("model"), "response": "", "done": True,
+                               "load_duration": int(load * 1e9)})
+        text = mock._reply(body)
+        pieces = [text[i:i + 4] for i in range(0, len(text), 4)] or [""]
+        cap = (body.get("options") or {}).get("num_predict")
+        if cap: pieces = pieces[:cap]; text = "".join(pieces)
+        gap = 1.0 / mock.token_rate if mock.token_rate else 0.0
+        fresh = mock._prompt_tokens(body.get("model"), body["prompt"])
+        prompt_s = fresh / mock.prompt_rate if mock.prompt_rate else 0.0
+        done = {"model": body.get("model"), "done": True, "eval_count": len(pieces),
+                "eval_duration": int(len(pieces) * gap * 1e9), "prompt_eval_count": fresh,
+                "prompt_eval_duration": int(prompt_s * 1e9), "load_duration": int(load * 1e9)}
+        out = (lambda piece: {"message": {"role": "assistant", "content": piece}}) if chat else \
+              (lambda piece: {"response": piece})
+        done.update(out(""))
+        time.sleep(mock.latency + prompt_s)
+        try:
+            if body.get("stream", True):
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson"); self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for piece in pieces:
+                    self._chunk({"model": body.get("model"), **out(piece), "done": False})
+                    sent = time.perf_counter()
+                    if gap: time.sleep(gap)
+                    if self._hung_up():
+                        t0 += time.perf_counter() - sent    # bill only up to the last token read
+                        raise ConnectionResetError
+                done["total_duration"] = int((time.perf_counter() - t0) * 1e9)
+                self._chunk(done); self.wfile.write(b"0\r\n\r\n")
+            else:
+                if gap: time.sleep(gap * len(pieces))
+                done.update(out(text)); done["total_duration"] = int((time.perf_counter() - t0) * 1e9)
+                self._send(done)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True     # client stopped early or cancelled
+        mock._unload(body.get("model"), body.get("keep_alive"))
+        mock._served(time.perf_counter() - t0)
+
+class _MockServer(ThreadingHTTPServer):
+    daemon_threads, request_queue_size = True, 512
+
+    def handle_error(self, request, client_address):
+        """Drop clients that hang up (race and hedge losers, cancelled calls) quietly."""
+        if not isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError, ConnectionAbortedError)):
+            super().handle_error(request, client_address)
+
+def _mock_value(sc, name="value"):
+    """A small value satisfying schema sc (enough of the subset schema_for emits)."""
+    if "const" in sc: return sc["const"]
+    if sc.get("enum"): return sc["enum"][0]
+    if sc.get("anyOf") or sc.get("oneOf"): return _mock_value((sc.get("anyOf") or sc["oneOf"])[0], name)
+    t = sc.get("type", "object" if "properties" in sc else "string")
+    t = t[0] if isinstance(t, list) else t
+    if t == "object": return {k: _mock_value(x, k) for k, x in sc.get("properties", {}).items()}
+    if t == "array": return [_mock_value(sc.get("items") or {}, name) for _ in range(max(1, sc.get("minItems", 1)))]
+    return {"integer": 1, "number": 1.0, "boolean": True, "null": None}.get(t, f"{name} value")
+
+class MockOllama:
+    """In-process stand-in for Ollama's /api/generate, /api/chat, /api/tags and /api/ps.
+
+    Replies come from respond(payload) -> text (default: a JSON object with a
+    value for each of `keys`), fenced in chatter unless format="json" was asked
+    for. Each takes `latency` seconds plus one `token_rate`-th of a second per
+    ~4-char token; a `malformed` fraction is cut off halfway. stats["busy"] is
+    the server-side time spent on requests, i.e. the "model time". With
+    max_loaded set, only that many models stay resident: a request for another
+    one first costs `load_time` (counted in stats["loads"]), and keep_alive=0
+    unloads the model after the request, as Ollama does. A schema `format` gets
+    a reply that fits it, or HTTP 400 with schemas=False, like Ollama before 0.5.
+    Prompts cost one `prompt_rate`-th of a second per ~4-char token (0 = free),
+    except the longest part shared with one of the model's recent prompts, which is cached.
+    """
+    def __init__(self, latency=0.05, token_rate=200.0, malformed=0.0, respond=None, keys=(),
+                 models=("mock",), seed=0, port=0, max_loaded=None, load_time=1.0, schemas=True,
+                 prompt_rate=0.0):
+        self.latency, self.token_rate, self.malformed = latency, token_rate, malformed
+        self.max_loaded, self.load_time, self.loaded, self.schemas = max_loaded, load_time, {}, schemas
+        self.prompt_rate, self.slots, self._kv = prompt_rate, 4, {}   # model -> recent prompts (cached prefixes)
+        self.respond = respond or (lambda payload: json.dumps(
+            _mock_value(payload["format"]) if isinstance(payload.get("format"), dict)
+            else {k: f"{k} value" for k in keys} or {"result": "ok"}))
+        self.models = list(models)
+        self.stats = {"requests": 0, "malformed": 0, "busy": 0.0, "loads": 0}
+        self._rng, self._lock = random.Random(seed), threading.Lock()
+        self.server = _MockServer(("127.0.0.1", port), _MockHandler); self.server.mock = self
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="sutra-mock", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown(); self.server.server_close()
+
+    def __enter__(self): return self.start()
+    def __exit__(self, *exc): self.stop()
+
+    def _reply(self, payload):
+        text = self.respond(payload)
+        if not payload.get("format") and text[:1] in "{[": text = f"Here is the result:\n```json\n{text}\n```"
+        with self._lock:
+            bad = self._rng.random() < self.malformed
+            self.stats["requests"] += 1; self.stats["malformed"] += bad
+        return text[:len(text) // 2] if bad else text
+
+    def _load(self, model):
+        if not self.max_loaded: return 0.0
+        with self._lock:
+            if model in self.loaded:
+                self.loaded[model] = self.loaded.pop(model); return 0.0
+            self.loaded[model] = True; self.stats["loads"] += 1
+            while len(self.loaded) > self.max_loaded:
+                gone = next(iter(self.loaded)); self.loaded.pop(gone); self._kv.pop(gone, None)
+        time.sleep(self.load_time)
+        return self.load_time
+
+    def _unload(self, model, keep_alive):
+        if keep_alive in (0, "0", "0s"):
+            with self._lock:
+                self._kv.pop(model, None)
+                if self.max_loaded: self.loaded.pop(model, None)
+
+    def _prompt_tokens(self, model, prompt)->int:
+        """Tokens of prompt not already cached: like Ollama's parallel slots, the
+        model keeps its last few prompts and reuses the longest common prefix."""
+        with self._lock:
+            slots = self._kv.setdefault(model, [])
+            n, i = max(((len(os.path.commonprefix([p, prompt])), i) for i, p in enumerate(slots)), default=(0, None))
+            # A slot is reused when most of it matches; otherwise a free (or the oldest) one is taken.
+            if i is not None and (n * 2 >= len(slots[i]) or len(slots) >= self.slots): slots.pop(i)
+            elif len(slots) >= self.slots: slots.pop(0)
+            slots.append(prompt)
+        return max(1, (len(prompt) - n) // 4)
+
+    def _served(self, dur):
+        with self._lock: self.stats["busy"] += dur
+
+def replay_responses(run_ids=None)->dict:
+    """{step name: [raw reply, ...]} rebuilt from the successful steps of recorded runs."""
+    if run_ids is None: run_ids = Trace.run_ids()
+    out = {}
+    for rid in run_ids:
+        try:
+            for rec in Trace.records(rid):
+                if rec["ev"] != "step" or rec["status"] != "ok": continue
+                for v in rec["out"].values():
+                    out.setdefault(rec["step"], []).append(v if isinstance(v, str) else json.dumps(v, ensure_ascii=False))
+        except Exception:
+            continue
+    return out
+
+def _bench_responder(pipe, replay=None, seed=0):
+    """respond() for MockOllama: tell agents apart by the literal head of their prompt
+    template, then answer with a recorded reply for that step or with its required_keys."""
+    heads = sorted((((getattr(st.agent, "prompt", "") or "").split("{", 1)[0].strip(), st.agent) for st in pipe.steps),
+                   key=lambda h: -len(h[0]))
+    keys = sorted({k for _, a in heads for k in (getattr(a, "required_keys", None) or [])})
+    rng, lock = random.Random(seed), threading.Lock()
+    def respond(payload):
+        prompt = payload.get("prompt", "")
+        agent = next((a for h, a in heads if h and h in prompt), None)
+        pool = (replay or {}).get(getattr(agent, "name", None))
+        if pool:
+            with lock: return rng.choice(pool)
+        if isinstance(payload.get("format"), dict): return json.dumps(_mock_value(payload["format"]))
+        rk = (getattr(agent, "required_keys", None) or []) if agent else keys
+        return json.dumps({k: f"{k} value" for k in rk} or {"result": "ok"})
+    return respond
+
+class _Timed:
+    """Agent proxy that appends each call's wall time to sink[agent name] and the
+    time it waited on the model (from its step span) to waits."""
+    def __init__(self, agent, sink, waits):
+        self._agent, self._sink, self._waits = agent, sink, waits
+        if hasattr(agent, "arun"): self.arun = self._arun
+    def __getattr__(self, k): return getattr(self._agent, k)
+    def _start(self):
+        sp = _SPAN.get()
+        return time.perf_counter(), sp, sp.attrs.get("sutra.model_wait_ms", 0) if sp else 0
+    def _done(self, t0, sp, w0):
+        self._sink.setdefault(self._agent.name, []).append(time.perf_counter() - t0)
+        if sp: self._waits.append((sp.attrs.get("sutra.model_wait_ms", 0) - w0) / 1000)
+    def run(self, inputs):
+        start = self._start()
+        try: return self._agent.run(inputs)
+        finally: self._done(*start)
+    async def _arun(self, inputs):
+        start = self._start()
+        try: return await self._agent.arun(inputs)
+        finally: self._done(*start)
+
+def _pcts(xs)->dict:
+    xs = sorted(xs)
+    if not xs: return {}
+    at = lambda q: xs[min(len(xs) - 1, int(q * len(xs)))]
+    return {"p50": round(at(0.50) * 1000, 3), "p95": round(at(0.95) * 1000, 3),
+            "p99": round(at(0.99) * 1000, 3), "mean": round(sum(xs) / len(xs) * 1000, 3)}
+
+def bench(pipe, inputs, runs=20, concurrency=(1, 4), mock=None, engine="thread", trace=False, allocs=True)->dict:
+    """Run pipe `runs` times at each concurrency level against mock (a started
+    MockOllama) and return the report: throughput, run and per-step latency
+    percentiles (ms), model time vs. framework overhead, and allocations.
+    Every call goes to mock, overriding agent hosts and configured backends.
+    model_ms is the time steps waited on their winning calls (client side);
+    server time beyond that (race and hedge losers, overlapping calls) is
+    duplicate_model_ms, so overhead_ms never counts it."""
+    global _PINNED_HOST
+    sink, waits, pinned = {}, [], _PINNED_HOST
+    for st in pipe.steps: st.agent = _Timed(st.agent, sink, waits)
+    _PINNED_HOST = mock.url
+
+    def one(_):
+        t0 = time.perf_counter()
+        out = pipe.run(dict(inputs), trace=trace)
+        return time.perf_counter() - t0, out
+
+    async def many(n, c):
+        import asyncio
+        sem = asyncio.Semaphore(c)
+        async def aone(_):
+            async with sem:
+                t0 = time.perf_counter()
+                out = await pipe.arun(dict(inputs), trace=trace)
+                return time.perf_counter() - t0, out
+        return await asyncio.gather(*(aone(i) for i in range(n)))
+
+    levels = []
+    try:
+        for c in concurrency:
+            sink.clear(); waits.clear()
+            busy0, req0 = mock.stats["busy"], mock.stats["requests"]
+            t0 = time.perf_counter()
+            if engine == "async":
+                import asyncio
+                res = asyncio.run(many(runs, c))
+            else:
+                with ThreadPoolExecutor(max_workers=c) as ex: res = list(ex.map(one, range(runs)))
+            wall = time.perf_counter() - t0
+            walls = [d for d, _ in res]
+            errors = sum(any(isinstance(v, dict) and "error" in v for v in out.values()) for _, out in res)
+            step_s = sum(sum(v) for v in sink.values()) / runs
+            model_s, busy_s = sum(waits) / runs, (mock.stats["busy"] - busy0) / runs
+            levels.append({
+                "concurrency": c, "runs": runs, "errors": errors, "wall_s": round(wall, 4),
+                "throughput_rps": round(runs / wall, 3), "latency_ms": _pcts(walls),
+                "steps": {name: _pcts(v) for name, v in sink.items()},
+                "requests_per_run": round((mock.stats["requests"] - req0) / runs, 3),
+                "model_ms": round(model_s * 1000, 3),
+                "duplicate_model_ms": round(max(0.0, busy_s - model_s) * 1000, 3),
+                "overhead_ms": round((step_s - model_s) * 1000, 3),
+                "orchestration_ms": round((sum(walls) / runs - step_s) * 1000, 3) if pipe.mode == "sequential" else None,
+            })
+
+        report = {"python": sys.version.split()[0], "platform": sys.platform, "engine": engine, "mode": pipe.mode,
+                  "mock": {"latency": mock.latency, "token_rate": mock.token_rate, "malformed": mock.malformed},
+                  "levels": levels}
+        if allocs:
+            # Process-wide, so the in-process mock server's allocations are included.
+            import tracemalloc
+            n = max(1, min(runs, 10))
+            tracemalloc.start()
+            try:
+                base = tracemalloc.take_snapshot(); peak = 0
+                for i in range(n):
+                    cur = tracemalloc.get_traced_memory()[0]; tracemalloc.reset_peak()
+                    one(i); peak = max(peak, tracemalloc.get_traced_memory()[1] - cur)
+                diff = tracemalloc.take_snapshot().compare_to(base, "filename")
+            finally:
+                tracemalloc.stop()
+            report["allocs"] = {"runs": n, "peak_kib": round(peak / 1024, 1),
+                                "retained_blocks_per_run": round(sum(d.count_diff for d in diff) / n, 1),
+                                "retained_kib_per_run": round(sum(d.size_diff for d in diff) / n / 1024, 2)}
+        return report
+    finally:
+        _PINNED_HOST = pinned
+        for st in pipe.steps: st.agent = st.agent._agent
+
+# ---------- Serve ----------
+class _Job:
+    def __init__(self, pipeline, inp, deadline=None):
+        self.id, self.pipeline, self.input = os.urandom(8).hex(), pipeline, inp
+        self.until = None if deadline is None else time.monotonic() + deadline  # counts time in the queue
+        self.status, self.output, self.error = "queued", None, None
+        self.created, self.finished, self.done = time.time(), None, threading.Event()
+
+    def to_dict(self)->dict:
+        d = {"job": self.id, "pipeline": self.pipeline, "status": self.status}
+        if self.status == "done": d["output"] = self.output
+        if self.error is not None: d["error"] = self.error
+        if self.finished: d["dur"] = round(self.finished - self.created, 6)
+        return d
+
+class PipelineServer:
+    """Keeps pipelines loaded and runs submitted inputs on `workers` threads.
+
+    Jobs wait in a queue of at most `queue_size`; submit() raises queue.Full
+    when it is full (HTTP 503). The last `keep` jobs stay queryable by id. With
+    reload=True a pipeline is rebuilt when its file or any .py file next to it
+    changes; jobs already running finish on the old pipeline.
+    """
+    def __init__(self, files, workers=4, queue_size=64, reload=False, dag=False, trace=False, keep=1000,
+                 deadline=None):
+        self.workers, self.reload, self.dag, self.trace, self.keep = workers, reload, dag, trace, keep
+        self.deadline = deadline  # default per-job deadline in seconds, counted from submit
+        self.pipes, self.jobs = {}, {}
+        self.q, self._lock = queue.Queue(queue_size), threading.Lock()
+        self.counts = {"done": 0, "failed": 0, "rejected": 0, "reloads": 0}
+        for f in files:
+            path, pipe = self._load(f)
+            self.pipes[pipe.name] = [path, pipe, self._mtimes(path)]
+
+    def _load(self, filename):
+        path = pathlib.Path(filename).resolve()
+        return path, _build(_load_pipeline(str(path)), path, self.dag)
+
+    @staticmethod
+    def _mtimes(path)->dict:
+        return {p: p.stat().st_mtime_ns for p in path.parent.glob("*.py")}
+
+    def start(self):
+        for i in range(max(1, self.workers)):
+            threading.Thread(target=self._work, name=f"sutra-serve-{i}", daemon=True).start()
+        if self.reload: threading.Thread(target=self._watch, name="sutra-reload", daemon=True).start()
+        return self
+
+    def submit(self, name, inp, deadline=None)->_Job:
+        if name not in self.pipes: raise KeyError(name)
+        job = _Job(name, inp, self.deadline if deadline is None else deadline)
+        try:
+            self.q.put_nowait(job)
+        except queue.Full:
+            self._count("rejected")
+            raise
+        with self._lock:
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.keep:
+                old = next(iter(self.jobs))
+                if not self.jobs[old].done.is_set(): break
+                del self.jobs[old]
+        return job
+
+    def _work(self):
+        while True:
+            job = self.q.get()
+            job.status = "running"
+            try:
+                left = None if job.until is None else job.until - time.monotonic()
+                job.output = self.pipes[job.pipeline][1].run(job.input, trace=self.trace, deadline=left)
+                job.status = "done"; self._count("done")
+            except Exception as e:
+                job.status, job.error = "failed", str(e); self._count("failed")
+            finally:
+                job.finished = time.time(); job.done.set()
+
+    def _watch(self, interval=1.0):
+        while True:
+            time.sleep(interval)
+            for name, entry in list(self.pipes.items()):
+                path, _, seen = entry
+                now = self._mtimes(path)
+                if now == seen: continue
+                entry[2] = now
+                # Sibling agent modules are cached in sys.modules; drop them so they re-import.
+                mine = (sys.modules.get(__name__), sys.modules.get("sutra"))
+                for mod_name, mod in list(sys.modules.items()):
+                    f = getattr(mod, "__file__", None)
+                    if f and mod not in mine and pathlib.Path(f).resolve().parent == path.parent:
+                        del sys.modules[mod_name]
+                try:
+                    entry[1] = self._load(path)[1]; self._count("reloads")
+                    print(f"Reloaded {name}", file=sys.stderr)
+                except Exception as e:
+                    print(f"Reload of {name} failed, keeping the old pipeline: {e}", file=sys.stderr)
+
+    def _count(self, what):
+        with self._lock: self.counts[what] += 1
+
+    def stats(self)->dict:
+        with self._lock: counts = dict(self.counts)
+        return {"queued": self.q.qsize(), "workers": self.workers, "pipelines": sorted(self.pipes), **counts}
+
+class _ServeHandler(BaseHTTPRequestHandler):
+    protocol_version, disable_nagle_algorithm = "HTTP/1.1", True
+    def log_message(self, *a): pass
+
+    def _send(self, obj, code=200, headers=()):
+        b = json.dumps(obj, ensure_ascii=False, default=str).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json"); self.send_header("Content-Length", str(len(b)))
+        for k, v in headers: self.send_header(k, v)
+        self.end_headers(); self.wfile.write(b)
+
+    def do_GET(self):
+        app, path = self.server.app, urllib.parse.urlsplit(self.path).path.rstrip("/")
+        if path == "/health":
+            self._send(app.stats())
+        elif path == "/pipelines":
+            self._send({name: {"file": str(p), "mode": pipe.mode, "steps": [st.agent.name for st in pipe.steps]}
+                        for name, (p, pipe, _) in app.pipes.items()})
+        elif path.startswith("/jobs/") and path[6:] in app.jobs:
+            self._send(app.jobs[path[6:]].to_dict())
+        else:
+            self._send({"error": "not found"}, 404)
+
+    def do_POST(self):
+        app, u = self.server.app, urllib.parse.urlsplit(self.path)
+        q = urllib.parse.parse_qs(u.query)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not u.path.startswith("/run/"): return self._send({"error": "not found"}, 404)
+        try:
+            inp = json.loads(body or b"{}")
+        except Exception as e:
+            return self._send({"error": f"invalid JSON: {e}"}, 400)
+        try:
+            deadline = float(q["deadline"][0]) if "deadline" in q else None
+        except ValueError:
+            return self._send({"error": "deadline must be a number of seconds"}, 400)
+        try:
+            timeout = float(q["timeout"][0]) if "timeout" in q else None
+        except ValueError:
+            return self._send({"error": "timeout must be a number of seconds"}, 400)
+        try:
+            job = app.submit(u.path[5:].rstrip("/"), inp if isinstance(inp, dict) else {"text": inp}, deadline)
+        except KeyError:
+            return self._send({"error": f"unknown pipeline; have {sorted(app.pipes)}"}, 404)
+        except queue.Full:
+            return self._send({"error": "busy"}, 503, [("Retry-After", "1")])
+        if q.get("wait", ["1"])[0] in ("0", "false"):
+            return self._send(job.to_dict(), 202, [("Location", f"/jobs/{job.id}")])
+        if not job.done.wait(timeout):
+            return self._send(job.to_dict(), 504, [("Location", f"/jobs/{job.id}")])
+        self._send(job.to_dict(), 200 if job.status == "done" else 500)
+
+class _ServeServer(ThreadingHTTPServer):
+    daemon_threads, request_queue_size = True, 128
+
+def serve(app, host="127.0.0.1", port=8765, socket_path=None):
+    """Serve a started PipelineServer over HTTP (or a Unix socket) until interrupted."""
+    if socket_path:
+        import socketserver
+        class _UnixServer(socketserver.ThreadingUnixStreamServer):
+            daemon_threads = True
+        class _UnixHandler(_ServeHandler):
+            disable_nagle_algorithm = False
+        if os.path.exists(socket_path): os.unlink(socket_path)
+        srv = _UnixServer(socket_path, _UnixHandler); where = f"unix:{socket_path}"
+    else:
+        srv = _ServeServer((host, port), _ServeHandler); where = f"http://{host}:{srv.server_address[1]}"
+    srv.app = app
+    if threading.current_thread() is threading.main_thread():
+        import signal
+        def stop(*a): raise KeyboardInterrupt
+        signal.signal(signal.SIGTERM, stop)
+    print(f"Serving {', '.join(sorted(app.pipes))} on {where} ({app.workers} workers)", file=sys.stderr)
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        srv.server_close()
+        if socket_path and os.path.exists(socket_path): os.unlink(socket_path)
+
 # ---------- INTERACTIVE GENERATOR ----------
-def get_available_models(host="http://localhost:11434", timeout=2):
+def get_available_models(host=None, timeout=2):
     """Return a list of model names from a local Ollama instance, or empty list on error."""
     try:
-        resp = urllib.request.urlopen(f"{host.rstrip('/')}/api/tags", timeout=timeout)
-        data = json.loads(resp.read().decode('utf-8'))
+        status, raw = http_pool(host or DEFAULT_HOST).request("GET", "/api/tags", timeout=timeout)
+        if status >= 400: return []
+        data = json.loads(raw.decode('utf-8'))
         models = [m.get('name') for m in data.get('models', []) if isinstance(m, dict) and 'name' in m]
         return [m for m in models if m]
     except Exception:
@@ -338,10 +3761,10 @@ def _import_module(path_str)->types.ModuleType:
     spec.loader.exec_module(mod)
     return mod
 
-def cmd_run(filename, input_json=None):
+def _load_pipeline(filename)->types.ModuleType:
     # 1) Resolve paths
     from pathlib import Path
-    import sys, json, importlib.util
+    import sys, importlib.util
 
     pipeline_path = Path(filename).resolve()
     project_dir = pipeline_path.parent  # e.g., projects/QuizMaster
@@ -354,25 +3777,268 @@ def cmd_run(filename, input_json=None):
     spec = importlib.util.spec_from_file_location("pipeline", str(pipeline_path))
     mod = importlib.util.module_from_spec(spec)
     spec.loader.exec_module(mod)
+    return mod
 
-    # 4) Build + run
+def _stream_to_stderr(piece):
+    sys.stderr.write(piece); sys.stderr.flush()
+
+def _report_cache():
+    for label, store in (("Cache", CACHE), ("Memo", MEMO)):
+        if store:
+            st = store.stats()
+            print(f"{label} ({st['mode']}): {st['hits']} hits, {st['misses']} misses "
+                  f"({st['hit_rate']:.0%}), {st['entries']} entries", file=sys.stderr)
+
+def _report_json_modes():
+    for name, st in json_mode_stats().items():
+        if st["model_calls"] > st["calls"]:
+            modes = ", ".join(f"{m} {v['wins']}/{v['tries']}" for m, v in st["json_mode"].items() if v["tries"])
+            print(f"JSON {name}: {st['ok']}/{st['calls']} ok, {st['model_calls']} model calls ({modes})", file=sys.stderr)
+
+def _report_hedges():
+    for name, st in hedge_stats().items():
+        if st["hedged"]:
+            print(f"Hedges {name}: {st['hedged']}/{st['calls']} calls hedged, {st['wins']} won, "
+                  f"~{st['est_saved_s']:.1f}s saved", file=sys.stderr)
+
+def _report_cascades():
+    for name, st in cascade_stats().items():
+        if st["calls"]:
+            served = ", ".join(f"{m} {n}" for m, n in st["served"].items())
+            up = sum(n for e in st["escalated"].values() for n in e.values())
+            print(f"Cascade {name}: served by {served}; {up} escalations", file=sys.stderr)
+
+def _report_prefixes():
+    for name, st in prefix_stats().items():
+        if st["calls"]:
+            print(f"Prefix {name}: {st['reused']}/{st['calls']} calls reused the cached prefix, "
+                  f"{st['tokens_saved'] / st['calls']:.0f} prompt tokens and {st['saved_ms_per_call']:.1f} ms "
+                  f"prompt eval saved per call", file=sys.stderr)
+
+def _build(mod, filename, dag=False):
     pipe = mod.build()
+    if dag: pipe.mode = "dag"
+    if getattr(pipe, "name", "") is None: pipe.name = pathlib.Path(filename).stem
+    return pipe
+
+def _report_run(pipe, out=None):
+    Trace.flush()
+    run_id = getattr(pipe, "last_run", None)
+    if run_id and (RUNS_DIR / f"{run_id}.jsonl").exists(): print(f"Run: {run_id}", file=sys.stderr)
+    skipped = [k for k, v in (out or {}).items() if _is_skipped(v)]
+    if skipped: print(f"Skipped: {len(skipped)} step(s) ({', '.join(skipped)})", file=sys.stderr)
+    _report_cache()
+
+def cmd_run(filename, input_json=None, stream=False, cache="off", dag=False, trace=None,
+            memo=False, resume=None, from_step=None, deadline=None):
+    global ON_TOKEN
+    if stream: ON_TOKEN = _stream_to_stderr
+    set_cache(cache); set_memo(memo)
+    mod = _load_pipeline(filename)
+
+    # 4) Build + run
+    pipe = _build(mod, filename, dag)
 
     try:
         init = json.loads(input_json) if input_json else {}
     except Exception as e:
         raise ValueError(f"Invalid --input JSON: {e}")
 
-    out = pipe.run(init)
+    if resume:
+        out = pipe.resume(resume, from_step, trace=trace or True, deadline=deadline)
+    elif from_step:
+        raise ValueError("--from-step needs --resume <run_id>")
+    else:
+        out = pipe.run(init, trace=trace or True, deadline=deadline)
+    if stream: sys.stderr.write("\n")
     print(json.dumps(out, indent=2, ensure_ascii=False))
+    _report_run(pipe, out)
 
-def cmd_test(filename):
+def cmd_test(filename, cache="off", dag=False, trace=None, memo=False, deadline=None):
+    set_cache(cache); set_memo(memo)
     mod = _import_module(filename)
-    pipe = mod.build()
+    pipe = _build(mod, filename, dag)
     init = getattr(mod, "DEFAULT_INPUT", {})
     print(f"Testing: {init}")
-    out = pipe.run(init)
+    out = pipe.run(init, trace=trace or True, deadline=deadline)
     print(json.dumps(out, indent=2, ensure_ascii=False))
+    _report_run(pipe, out)
+
+def _read_jsonl(path, skip=(), on_invalid=None):
+    """Yield (line_no, input) for each non-blank line, lazily, skipping line numbers in skip.
+    Non-object lines become {"text": value}; unparsable lines go to on_invalid(line_no, error)."""
+    with open(path, encoding="utf-8") as f:
+        for n, line in enumerate(f, 1):
+            if n in skip or not line.strip(): continue
+            try:
+                obj = json.loads(line)
+            except Exception as e:
+                if on_invalid: on_invalid(n, f"invalid JSON: {e}")
+                continue
+            yield n, (obj if isinstance(obj, dict) else {"text": obj})
+
+def _completed_lines(path)->set:
+    """Line numbers already written to a batch output file; drops a torn trailing record."""
+    p = pathlib.Path(path)
+    if not p.exists(): return set()
+    done, good = set(), 0
+    with open(p, "rb") as f:
+        for raw in f:
+            try:
+                done.add(json.loads(raw)["line"])
+                good += len(raw)
+            except Exception:
+                break
+    if good != p.stat().st_size:
+        with open(p, "r+b") as f: f.truncate(good)
+    return done
+
+def cmd_batch(filename, input_path, output_path=None, workers=4, per_model=None,
+              order="input", resume=False, schedule="item", deadline=None, dedup=None, dedup_fields=None,
+              cache="off", dag=False, trace=None, memo=False):
+    set_cache(cache); set_memo(memo)
+    mod = _load_pipeline(filename)
+    pipe = _build(mod, filename, dag)
+
+    skip = _completed_lines(output_path) if (resume and output_path) else set()
+    if skip: print(f"Resuming: {len(skip)} lines already done", file=sys.stderr)
+
+    out = open(output_path, "a" if resume else "w", encoding="utf-8") if output_path else sys.stdout
+    counts = {"ok": 0, "failed": 0}
+    def emit(rec):
+        counts["failed" if "error" in rec else "ok"] += 1
+        out.write(json.dumps(rec, ensure_ascii=False) + "\n"); out.flush()
+
+    # Malformed lines are reported as soon as they are read, ahead of in-flight items.
+    items = _read_jsonl(input_path, skip, lambda n, err: emit({"line": n, "error": err}))
+    t0 = time.time()
+    try:
+        if schedule == "stage":
+            if deadline: print("--deadline is per item; ignored with --schedule stage", file=sys.stderr)
+            if dedup: print("--dedup is ignored with --schedule stage", file=sys.stderr)
+            results = pipe.run_stages(items, workers=workers, trace=trace or False)
+        else:
+            dd = dedup and NearDuplicates(dedup, fields=dedup_fields and dedup_fields.split(","))
+            results = pipe.run_many(items, workers=workers, per_model=per_model, ordered=(order == "input"),
+                                    trace=trace or False, deadline=deadline, dedup=dd)
+        for n, state in results:
+            if set(state) == {"error", "message"}:
+                emit({"line": n, "error": state["message"]})
+            else:
+                emit({"line": n, "output": state})
+    finally:
+        if out is not sys.stdout: out.close()
+    print(f"Done: {counts['ok']} ok, {counts['failed']} failed in {time.time() - t0:.1f}s", file=sys.stderr)
+    if schedule == "stage":
+        st = pipe.last_schedule
+        loads = ", ".join(f"{m} {c}x ({st['load_s'][m]:.1f}s)" for m, c in st["loads"].items()) or "none seen"
+        print(f"Schedule: {st['stages']} stages, {st['switches']} model switches; loads: {loads}", file=sys.stderr)
+    elif pipe.last_dedup:
+        st = pipe.last_dedup.stats
+        print(f"Dedup: {st['items']} items in {st['clusters']} clusters; {st['duplicates']} near-duplicates "
+              f"reused results ({st['calls_avoided']} model calls avoided)", file=sys.stderr)
+    Trace.flush()
+    _report_cache()
+    _report_json_modes()
+    _report_hedges()
+    _report_cascades()
+    _report_prefixes()
+
+def cmd_bench(filename, input_json=None, runs=20, concurrency="1,4,16", latency=0.05, token_rate=200.0,
+              malformed=0.0, stream=False, replay=False, engine="thread", seed=0, json_path=None,
+              max_loaded=None, load_time=1.0, prompt_rate=0.0, cache="off", dag=False, trace=None, memo=False):
+    global DEFAULT_HOST, ON_TOKEN
+    set_cache(cache); set_memo(memo)
+    mod = _load_pipeline(filename)
+    pipe = _build(mod, filename, dag)
+    try:
+        init = json.loads(input_json) if input_json else getattr(mod, "DEFAULT_INPUT", {})
+    except Exception as e:
+        raise ValueError(f"Invalid --input JSON: {e}")
+    levels = [int(c) for c in str(concurrency).split(",") if c.strip()]
+
+    respond = _bench_responder(pipe, replay_responses() if replay else None, seed)
+    mock = MockOllama(latency, token_rate, malformed, respond=respond, seed=seed,
+                      max_loaded=max_loaded, load_time=load_time, prompt_rate=prompt_rate).start()
+    prev = DEFAULT_HOST, ON_TOKEN
+    DEFAULT_HOST = mock.url
+    if stream: ON_TOKEN = lambda piece: None
+    try:
+        report = bench(pipe, init, runs, levels, mock, engine, trace or False)
+    finally:
+        DEFAULT_HOST, ON_TOKEN = prev
+        mock.stop()
+    report["pipeline"], report["stream"], report["replay"] = pipe.name, stream, replay
+    report["mock"]["loads"] = mock.stats["loads"]
+
+    print(f"{'conc':>5} {'rps':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'model ms':>9} {'dup ms':>8} {'ovh ms':>8} {'errors':>6}")
+    for lv in report["levels"]:
+        lat = lv["latency_ms"]
+        print(f"{lv['concurrency']:>5} {lv['throughput_rps']:>9.2f} {lat['p50']:>9.1f} {lat['p95']:>9.1f} "
+              f"{lat['p99']:>9.1f} {lv['model_ms']:>9.1f} {lv['duplicate_model_ms']:>8.1f} {lv['overhead_ms']:>8.2f} {lv['errors']:>6}")
+        for name, st in lv["steps"].items():
+            print(f"      {name}: p50 {st['p50']:.1f} / p95 {st['p95']:.1f} / p99 {st['p99']:.1f} ms")
+    if max_loaded: print(f"Model loads: {mock.stats['loads']}")
+    report["prefix"] = prefix_stats()
+    _report_prefixes()
+    if "allocs" in report:
+        a = report["allocs"]
+        print(f"Allocs: peak {a['peak_kib']} KiB/run, retained {a['retained_kib_per_run']} KiB/run")
+    if json_path:
+        text = json.dumps(report, indent=2)
+        if json_path == "-": print(text)
+        else: pathlib.Path(json_path).write_text(text + "\n", encoding="utf-8")
+
+def cmd_serve(files, host="127.0.0.1", port=8765, socket_path=None, workers=4, queue_size=64,
+              reload=False, runs_max_age=None, runs_max_size=None, deadline=None, cache="off", dag=False,
+              trace=None, memo=False):
+    set_cache(cache); set_memo(memo)
+    if runs_max_age or runs_max_size:
+        set_run_store(max_age=runs_max_age and _seconds(runs_max_age), max_bytes=runs_max_size and _nbytes(runs_max_size))
+    app = PipelineServer(files, workers, queue_size, reload, dag, trace or False, deadline=deadline).start()
+    serve(app, host, port, socket_path)
+    Trace.flush()
+
+def cmd_runs(run_id=None, pipeline=None, step=None, status=None, since=None, where=(), slowest=False,
+             limit=20, as_json=False, export=None, compact=None, max_age=None, max_size=None, keep_errors=True):
+    store = RUN_STORE or RunStore()
+    n = store.sync()
+    if n: print(f"Indexed {n} run(s)", file=sys.stderr)
+    if compact or max_age or max_size:
+        c = store.compact(_seconds(compact)) if compact else 0
+        d = store.prune(max_age and _seconds(max_age), max_size and _nbytes(max_size), keep_errors)
+        st = store.stats()
+        print(f"Compacted {c}, deleted {d}; {st['runs']} runs ({st['errors']} failed), "
+              f"{st['bytes'] / 1e6:.1f} MB in {store.path}")
+        return
+    if run_id:
+        for rec in Trace.records(run_id):
+            if rec["ev"] == "start": print(json.dumps(rec["state"], ensure_ascii=False)); continue
+            print(f"{rec['step']:<16} {rec.get('status', ''):<9} {rec.get('dur') or 0:>8.3f}s  "
+                  f"{json.dumps(rec['out'], ensure_ascii=False)[:200]}")
+        return
+    cond = {}
+    for w in where:
+        k, sep, v = w.partition("=")
+        if not sep: raise SystemExit(f"--where wants OUTPUT.PATH=VALUE, got {w!r}")
+        cond[k] = v
+    rows = store.query(pipeline, step, status, since and time.time() - _seconds(since), cond or None,
+                       order="dur" if slowest else "ts", limit=limit)
+    if export:
+        with open(export, "w", encoding="utf-8") as f:
+            for rid in dict.fromkeys(r["run_id"] for r in rows):
+                f.write(json.dumps({"run_id": rid, "records": list(Trace.records(rid))}, ensure_ascii=False) + "\n")
+        print(f"Exported {len(set(r['run_id'] for r in rows))} run(s) to {export}", file=sys.stderr)
+        return
+    for r in rows:
+        if as_json: print(json.dumps(r, ensure_ascii=False)); continue
+        when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(r["ts"] or 0))
+        dur = f"{r['dur']:.3f}s" if r["dur"] is not None else "-"
+        if "step" in r:
+            print(f"{r['run_id']}  {when}  {r['step']:<14} {r['model'] or '-':<16} {r['status']:<9} {dur:>9}")
+        else:
+            print(f"{r['run_id']}  {when}  {r['pipeline'] or '-':<16} {r['status']:<10} "
+                  f"{r['steps']} steps, {r['errors']} failed {dur:>9}")
 
 def cmd_doctor():
     models = get_available_models()
@@ -387,6 +4053,17 @@ def cmd_doctor():
         print(f"Test: {r[:60]}")
     except Exception as e:
         print(f"Error: {e}")
+    for host, st in http_stats().items():
+        print(f"HTTP {host}: opened={st['opened']} reused={st['reused']} failed={st['failed']} idle={st['idle']}")
+    if BACKENDS:
+        BACKENDS.probe()
+        for host, st in BACKENDS.stats().items():
+            state = "ejected" if st["ejected"] else "ok"
+            print(f"Backend {host}: {state}, models: {', '.join(st['models']) or '-'}, loaded: {', '.join(st['loaded']) or '-'}")
+
+def _common(args)->dict:
+    """Options shared by run/test/batch, as cmd_* keyword arguments."""
+    return {"cache": args.cache, "dag": args.dag, "trace": args.trace_level, "memo": args.memo}
 
 def main():
     ap = argparse.ArgumentParser(prog="sutra")
@@ -399,21 +4076,124 @@ def main():
     r = sub.add_parser("run")
     r.add_argument("pipeline_file")
     r.add_argument("--input", default=None)
+    r.add_argument("--stream", action="store_true", help="echo tokens to stderr as they arrive")
+    r.add_argument("--resume", metavar="RUN_ID", default=None,
+                   help="re-run a traced run, reusing its successful steps")
+    r.add_argument("--from-step", default=None, help="with --resume: re-run from this step on")
 
     t = sub.add_parser("test")
     t.add_argument("pipeline_file")
 
+    b = sub.add_parser("batch")
+    b.add_argument("pipeline_file")
+    b.add_argument("input_jsonl")
+    b.add_argument("-o", "--output", default=None, help="output JSONL (default stdout)")
+    b.add_argument("--workers", type=int, default=4)
+    b.add_argument("--per-model", type=int, default=None, help="max concurrent calls per model")
+    b.add_argument("--order", choices=["input", "completion"], default="input")
+    b.add_argument("--resume", action="store_true", help="skip lines already in --output")
+    b.add_argument("--schedule", choices=["item", "stage"], default="item",
+                   help="stage: group calls by model to avoid model swaps (see Pipeline.run_stages)")
+    b.add_argument("--dedup", type=float, nargs="?", const=0.9, default=None, metavar="THRESHOLD",
+                   help="run near-duplicate inputs once and reuse the result (MinHash similarity, default 0.9)")
+    b.add_argument("--dedup-fields", default=None, help="comma-separated input fields compared by --dedup (default all)")
+
+    k = sub.add_parser("bench", help="benchmark a pipeline against an in-process mock Ollama")
+    k.add_argument("pipeline_file")
+    k.add_argument("--input", default=None, help="input JSON (default: the pipeline's DEFAULT_INPUT)")
+    k.add_argument("-n", "--runs", type=int, default=20, help="runs per concurrency level")
+    k.add_argument("--concurrency", default="1,4,16", help="comma-separated concurrency levels")
+    k.add_argument("--latency", type=float, default=0.05, help="mock seconds before the first token")
+    k.add_argument("--token-rate", type=float, default=200.0, help="mock tokens per second (0 = instant)")
+    k.add_argument("--malformed", type=float, default=0.0, help="fraction of truncated mock replies")
+    k.add_argument("--stream", action="store_true", help="stream every generation")
+    k.add_argument("--replay", action="store_true", help=f"answer with step outputs recorded in {RUNS_DIR}")
+    k.add_argument("--async", dest="engine", action="store_const", const="async", default="thread",
+                   help="drive runs with Pipeline.arun instead of threads")
+    k.add_argument("--max-loaded", type=int, default=None, help="mock keeps only N models resident")
+    k.add_argument("--load-time", type=float, default=1.0, help="mock seconds to load a model")
+    k.add_argument("--prompt-rate", type=float, default=0.0,
+                   help="mock prompt tokens evaluated per second, uncached part only (0 = free)")
+    k.add_argument("--seed", type=int, default=0)
+    k.add_argument("--json", dest="json_path", default=None, help="write the report as JSON ('-' for stdout)")
+
+    v = sub.add_parser("serve", help="keep pipelines loaded and run inputs posted over HTTP")
+    v.add_argument("pipeline_files", nargs="+")
+    v.add_argument("--host", default="127.0.0.1")
+    v.add_argument("--port", type=int, default=8765)
+    v.add_argument("--socket", default=None, help="listen on this Unix socket instead")
+    v.add_argument("--workers", type=int, default=4)
+    v.add_argument("--queue", type=int, default=64, help="max queued jobs before answering 503")
+    v.add_argument("--reload", action="store_true", help="rebuild a pipeline when its files change")
+    v.add_argument("--runs-max-age", default=None, help="index runs and delete those older than this (e.g. 30d)")
+    v.add_argument("--runs-max-size", default=None, help="index runs and keep at most this much history (e.g. 1G)")
+
+    u = sub.add_parser("runs", help=f"query and maintain the run history in {RUNS_DIR}")
+    u.add_argument("run_id", nargs="?", help="print one run's steps and outputs")
+    u.add_argument("--pipeline", default=None)
+    u.add_argument("--step", default=None, help="list this step's calls instead of runs")
+    u.add_argument("--status", default=None, help="ok, error, exception, running, ...")
+    u.add_argument("--since", default=None, help="only runs started within this long (e.g. 7d, 12h)")
+    u.add_argument("--where", action="append", default=[], metavar="OUTPUT.PATH=VALUE",
+                   help="steps whose output matches, e.g. reviewer.verdict=reject (repeatable)")
+    u.add_argument("--slowest", action="store_true", help="sort by duration instead of recency")
+    u.add_argument("-n", "--limit", type=int, default=20)
+    u.add_argument("--json", action="store_true", help="one JSON object per line")
+    u.add_argument("--export", metavar="PATH", default=None, help="write the matching runs' full traces as JSONL")
+    u.add_argument("--compact", metavar="AGE", default=None, help="move runs older than AGE into the index")
+    u.add_argument("--max-age", default=None, help="delete runs older than this")
+    u.add_argument("--max-size", default=None, help="delete the oldest runs beyond this size (e.g. 500MB)")
+    u.add_argument("--drop-errors", action="store_true", help="let --max-age/--max-size delete failed runs too")
+
+    for p in (r, t, b, k, v):
+        p.add_argument("--cache", choices=CACHE_MODES, default="off",
+                       help=f"model response cache in {CACHE_PATH}")
+        p.add_argument("--dag", action="store_true", help="run independent steps in parallel")
+        p.add_argument("--trace-level", choices=TRACE_LEVELS, default=None,
+                       help=f"run traces in {RUNS_DIR} (default: {TRACE_LEVEL}; off for batch)")
+        p.add_argument("--memo", action="store_true",
+                       help=f"skip steps whose inputs and agent are unchanged ({MEMO_PATH})")
+        p.add_argument("--spans", metavar="PATH", default=None, help="append every span as JSONL to PATH")
+        p.add_argument("--prom", metavar="PATH", default=None, help="write Prometheus text-format metrics to PATH")
+        p.add_argument("--shared-prefix", action="store_true",
+                       help="send each agent's static prompt head as a cached chat system message")
+
+    for p in (r, t, b, v):
+        p.add_argument("--deadline", type=float, default=None, metavar="SECONDS",
+                       help="time budget per run; steps share it and unfinished ones report why")
+
     d = sub.add_parser("doctor")
 
     args = ap.parse_args()
+    if getattr(args, "spans", None): add_hook(JsonlExporter(args.spans))
+    if getattr(args, "prom", None): add_hook(PrometheusExporter(args.prom))
+    if getattr(args, "shared_prefix", False): set_shared_prefix()
     if args.cmd == "create":
         cmd_create(args.project_name, args.description)
     elif args.cmd == "run":
-        cmd_run(args.pipeline_file, args.input)
+        cmd_run(args.pipeline_file, args.input, args.stream, resume=args.resume,
+                from_step=args.from_step, deadline=args.deadline, **_common(args))
     elif args.cmd == "test":
-        cmd_test(args.pipeline_file)
+        cmd_test(args.pipeline_file, deadline=args.deadline, **_common(args))
+    elif args.cmd == "batch":
+        cmd_batch(args.pipeline_file, args.input_jsonl, args.output, args.workers,
+                  args.per_model, args.order, args.resume, args.schedule, args.deadline, args.dedup,
+                  args.dedup_fields, **_common(args))
+    elif args.cmd == "bench":
+        cmd_bench(args.pipeline_file, args.input, args.runs, args.concurrency, args.latency, args.token_rate,
+                  args.malformed, args.stream, args.replay, args.engine, args.seed, args.json_path,
+                  args.max_loaded, args.load_time, args.prompt_rate, **_common(args))
+    elif args.cmd == "serve":
+        cmd_serve(args.pipeline_files, args.host, args.port, args.socket, args.workers, args.queue,
+                  args.reload, args.runs_max_age, args.runs_max_size, args.deadline, **_common(args))
+    elif args.cmd == "runs":
+        cmd_runs(args.run_id, args.pipeline, args.step, args.status, args.since, args.where, args.slowest,
+                 args.limit, args.json, args.export, args.compact, args.max_age, args.max_size, not args.drop_errors)
     elif args.cmd == "doctor":
         cmd_doctor()
 
 if __name__ == "__main__":
+    # Pipelines do `from sutra import ...`; make that resolve to this module so
+    # CLI settings (e.g. ON_TOKEN) reach the same globals the agents read.
+    sys.modules.setdefault("sutra", sys.modules[__name__])
     main()
@@ -0,0 +1,7 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def _workdir(tmp_path, monkeypatch):
+    """Run every test in its own directory, so .sutra/ traces and stores stay out of the repo."""
+    monkeypatch.chdir(tmp_path)
@@ -0,0 +1,54 @@
+import time
+
+import pytest
+
+import sutra
+
+
+def test_read_timeout_does_not_fail_over_or_eject():
+    slow = [sutra.MockOllama(latency=2.0, token_rate=0).start() for _ in range(2)]
+    try:
+        pool = sutra.BackendPool([m.url for m in slow])
+        llm = sutra.Ollama("mock", host=pool)
+        t0 = time.monotonic()
+        with pytest.raises(TimeoutError):
+            llm.generate("hi", timeout=0.5)
+        assert time.monotonic() - t0 < 1.5
+        assert sum(m.stats["requests"] for m in slow) == 1
+        assert all(b["fails"] == 0 and not b["ejected"] for b in pool.stats().values())
+    finally:
+        for m in slow: m.stop()
+
+
+def test_refused_connection_fails_over():
+    up = sutra.MockOllama(latency=0, token_rate=0).start()
+    down = sutra.MockOllama().start(); down.stop()   # a port nobody listens on
+    try:
+        pool = sutra.BackendPool([down.url, up.url], eject_after=1)
+        pool.probe = lambda backends=None: None        # rank by order only
+        text = sutra.Ollama("mock", host=pool).generate("hi")
+        assert "result" in text
+        assert pool.stats()[down.url]["fails"] == 1
+    finally:
+        up.stop()
+
+
+def test_schema_fallback_reply_is_not_cached_under_schema_key(tmp_path):
+    schema = {"type": "object", "properties": {"v": {"type": "string"}}, "required": ["v"]}
+    cache = sutra.set_cache("readwrite", path=tmp_path / "cache.db")
+    mock = sutra.MockOllama(latency=0, token_rate=0, schemas=False).start()
+    try:
+        sutra.Ollama("mock", host=mock.url).generate("hi", temperature=0.2, json_mode=schema)
+        assert mock.url in sutra.NO_SCHEMA
+        assert cache.get(cache.key("mock", mock.url, "hi", 0.2, schema, schema)) is None
+        assert cache.get(cache.key("mock", mock.url, "hi", 0.2, schema, "json")) is not None
+    finally:
+        mock.stop(); sutra.set_cache("off"); sutra.NO_SCHEMA.discard(mock.url)
+
+
+def test_clients_share_one_keep_alive_connection_per_host():
+    with sutra.MockOllama(latency=0, token_rate=0) as mock:
+        for stream in (False, True, False):
+            sutra.Ollama("mock", host=mock.url).generate("hi", stream=stream)
+        st = sutra.http_pool(mock.url).stats
+        assert st["opened"] == 1 and st["reused"] == 2
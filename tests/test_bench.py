@@ -0,0 +1,28 @@
+import sutra
+
+
+def test_bench_sends_every_call_to_the_mock():
+    real = sutra.MockOllama(latency=0, token_rate=0).start()
+    mock = sutra.MockOllama(latency=0.01, token_rate=0).start()
+    try:
+        steps = [sutra.Step(sutra.Agent("a", "o", "mock", "Go {x}", host=real.url)),
+                 sutra.Step(sutra.Agent("b", "o", "mock", "Then {x}", output_key="b"))]
+        pipe = sutra.Pipeline(steps, backends=[real.url])
+        report = sutra.bench(pipe, {"x": 1}, runs=3, concurrency=(1,), mock=mock, allocs=False)
+        assert real.stats["requests"] == 0 and mock.stats["requests"] == 6
+        assert report["levels"][0]["model_ms"] > 0
+    finally:
+        real.stop(); mock.stop()
+
+
+def test_bench_overhead_excludes_race_losers():
+    mock = sutra.MockOllama(latency=0.05, token_rate=0).start()
+    try:
+        agent = sutra.Agent("a", "o", "mock", "Go {x}", expects_json=True, race_modes=True)
+        report = sutra.bench(sutra.Pipeline([sutra.Step(agent)]), {"x": 1}, runs=4, concurrency=(1,),
+                             mock=mock, allocs=False)
+        lv = report["levels"][0]
+        assert lv["requests_per_run"] == 2
+        assert lv["model_ms"] >= 50 and lv["overhead_ms"] >= 0 and lv["duplicate_model_ms"] > 0
+    finally:
+        mock.stop()
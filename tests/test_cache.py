@@ -0,0 +1,25 @@
+import pytest
+
+import sutra
+
+
+def test_identical_request_is_served_from_cache(tmp_path):
+    cache = sutra.set_cache("readwrite", path=tmp_path / "cache.db")
+    try:
+        with sutra.MockOllama(latency=0, token_rate=0) as mock:
+            llm = sutra.Ollama("mock", host=mock.url)
+            first = llm.generate("hi")
+            assert llm.generate("hi") == first and llm.last.get("cached")
+            llm.generate("other prompt")
+            assert mock.stats["requests"] == 2 and cache.hits == 1
+    finally:
+        sutra.set_cache("off")
+
+
+def test_replay_only_raises_on_a_miss(tmp_path):
+    sutra.set_cache("replay-only", path=tmp_path / "cache.db")
+    try:
+        with sutra.MockOllama(latency=0, token_rate=0) as mock, pytest.raises(RuntimeError):
+            sutra.Ollama("mock", host=mock.url).generate("hi")
+    finally:
+        sutra.set_cache("off")
@@ -0,0 +1,29 @@
+import time
+
+import sutra
+
+
+def test_deadline_in_cheap_tier_is_not_an_invalid_escalation():
+    with sutra.MockOllama(latency=0, token_rate=0, models=("small", "big")) as mock:
+        agent = sutra.Agent("casc-deadline", "o", "big", "Answer {q}", expects_json=True,
+                            cascade=["small"], host=mock.url)
+        token = sutra._DEADLINE.set(time.monotonic() - 1)
+        try:
+            out = agent.run({"q": "x"})
+        finally:
+            sutra._DEADLINE.reset(token)
+        assert out["output"]["error"] == "deadline"
+        st = sutra.cascade_stats()["casc-deadline"]
+        assert st["escalated"] == {"small": {"deadline": 1}} and st["calls"] == 0
+        assert mock.stats["requests"] == 0
+
+
+def test_confident_cheap_tier_serves_without_confidence_in_required_keys():
+    reply = '{"label": "bug", "confidence": 0.95}'
+    with sutra.MockOllama(latency=0, token_rate=0, models=("small", "big"), respond=lambda p: reply) as mock:
+        agent = sutra.Agent("casc-confident", "o", "big", "Answer {q}", expects_json=True, required_keys=["label"],
+                            cascade=["small"], confidence="confidence", host=mock.url)
+        out = agent.run({"q": "x"})["output"]
+    assert out == [{"label": "bug", "confidence": 0.95}]
+    st = sutra.cascade_stats()["casc-confident"]
+    assert st["served"] == {"small": 1} and st["escalated"] == {}
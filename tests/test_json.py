@@ -0,0 +1,35 @@
+import sutra
+
+
+def test_extract_json_finds_the_value_in_chatty_replies():
+    assert sutra._extract_json('Sure!\n```json\n{"a": 1}\n```\nDone.') == {"a": 1}
+    assert sutra._extract_json("Result: {'a': 1, 'b': [1, 2,],}") == {"a": 1, "b": [1, 2]}
+    assert sutra._extract_json("no json at all") is None
+
+
+def test_extract_json_prefers_values_with_the_required_keys():
+    text = 'See [1] and {"note": "x"} then {"label": "bug", "note": "y"}'
+    assert sutra._extract_json(text, ["label"]) == {"label": "bug", "note": "y"}
+
+
+def test_agent_learns_the_json_mode_that_works():
+    respond = lambda payload: "not json" if payload.get("format") else '{"ok": true}'
+    with sutra.MockOllama(latency=0, token_rate=0, respond=respond) as mock:
+        a = sutra.Agent("jm-learn", "o", "mock", "Go {x}", expects_json=True, host=mock.url)
+        for _ in range(3): assert a.run({"x": 1})["output"] == {"ok": True}
+        n = mock.stats["requests"]
+        a.run({"x": 1})
+        assert mock.stats["requests"] == n + 1   # plain mode first now, no wasted format="json" call
+    assert sutra.JSON_MODES.order(("mock", "jm-learn"))[0] is False
+
+
+def test_schema_is_sent_as_format_and_enforced():
+    formats, replies = [], ['{"verdict": "maybe"}', '{"verdict": "approve"}']
+    def respond(payload):
+        formats.append(payload.get("format"))
+        return replies.pop(0) if replies else '{"verdict": "maybe"}'
+    with sutra.MockOllama(latency=0, token_rate=0, respond=respond) as mock:
+        a = sutra.Agent("schema", "o", "mock", "Decide {x}", expects_json=True, required_keys=["verdict"],
+                        types={"verdict": ["approve", "reject"]}, host=mock.url)
+        assert a.run({"x": 1})["output"] == [{"verdict": "approve"}]   # the off-schema reply was retried
+    assert formats[0]["properties"]["verdict"] == {"enum": ["approve", "reject"]}
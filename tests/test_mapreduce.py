@@ -0,0 +1,49 @@
+import asyncio
+
+import sutra
+
+
+def _step(reducer_calls):
+    def respond(payload):
+        if "Reduce" in payload["prompt"]: reducer_calls.append(1)
+        return "x" * 400   # ~100 tokens: two never fit in one 150-token group
+    mock = sutra.MockOllama(latency=0, token_rate=0, respond=respond).start()
+    mapper = sutra.Agent("mapper", "o", "mock", "Summarize {text}", output_key="summary")
+    reducer = sutra.Agent("reducer", "o", "mock", "Reduce {chunks}", output_key="summary")
+    for a in (mapper, reducer): a.host = mock.url
+    return mock, sutra.MapReduceStep(mapper, chunk_tokens=150, overlap=0, reduce=reducer)
+
+
+def test_reduce_stops_when_outputs_do_not_shrink():
+    calls = []
+    mock, step = _step(calls)
+    try:
+        text = " ".join(f"sentence {i} of a long document." for i in range(300))
+        chunks = len(list(sutra.chunk_text(text, 150, 0)))
+        out = step.run({"text": text})
+        assert out["summary"] == "x" * 400
+        # one round over the chunk outputs, then a single final reduce
+        assert len(calls) == chunks + 1
+        calls.clear()
+        assert asyncio.run(step.arun({"text": text}))["summary"] == "x" * 400
+        assert len(calls) == chunks + 1
+    finally:
+        mock.stop()
+
+
+def test_failed_chunk_is_dropped_not_raised():
+    class Flaky:
+        name, output_key, expects_json = "flaky", "summary", False
+        def run(self, inputs):
+            if "sentence 0 " in inputs["text"]: raise RuntimeError("boom")
+            return {"summary": "ok"}
+    step = sutra.MapReduceStep(Flaky(), chunk_tokens=150, overlap=0, reduce="concat")
+    text = " ".join(f"sentence {i} of a long document." for i in range(300))
+    chunks = len(list(sutra.chunk_text(text, 150, 0)))
+    with sutra.Span("step", "step") as sp:
+        out = step.run({"text": text})
+    assert out["summary"] == sutra.concat_outputs(["ok"] * (chunks - 1))
+    assert sp.attrs["sutra.chunk_errors"] == 1
+    with sutra.Span("step", "step") as sp:
+        out = asyncio.run(step.arun({"text": text}))
+    assert out["summary"] == sutra.concat_outputs(["ok"] * (chunks - 1)) and sp.attrs["sutra.chunk_errors"] == 1
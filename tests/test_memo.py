@@ -0,0 +1,47 @@
+import sutra
+
+
+def test_fingerprint_covers_request_shaping_settings():
+    base = dict(name="a", objective="o", model="m", prompt="{x}")
+    fp = sutra.Agent(**base).fingerprint()
+    for kw in ({"types": {"v": int}}, {"confidence": "score"}, {"cascade_timeout": 2.0}, {"shared_prefix": True}):
+        assert sutra.Agent(**base, **kw).fingerprint() != fp, kw
+
+
+def test_fingerprint_names_a_confidence_predicate():
+    def sure(out): return True
+    a = sutra.Agent("a", "o", "m", "{x}", confidence=sure)
+    assert a.fingerprint()["confidence"].endswith("sure")
+
+
+def _steps(mock):
+    return [sutra.Step(sutra.Agent("a", "o", "mock", "A {x}", output_key="a", host=mock.url)),
+            sutra.Step(sutra.Agent("b", "o", "mock", "B {a}", output_key="b", expects_json=True,
+                                   retries=0, host=mock.url), takes=["a"])]
+
+
+def test_memoized_steps_are_not_rerun():
+    sutra.set_memo(True)
+    try:
+        with sutra.MockOllama(latency=0, token_rate=0) as mock:
+            p = sutra.Pipeline(_steps(mock))
+            first = p.run({"x": 1})
+            n = mock.stats["requests"]
+            assert p.run({"x": 1}) == first and mock.stats["requests"] == n
+            p.run({"x": 2})
+            assert mock.stats["requests"] > n
+    finally:
+        sutra.set_memo(False)
+
+
+def test_resume_reuses_successful_steps():
+    replies = {"B": ["no json here", "no json here", '{"ok": true}']}
+    def respond(payload):
+        q = replies.get(payload["prompt"][:1])
+        return q.pop(0) if q else "plain text"
+    with sutra.MockOllama(latency=0, token_rate=0, respond=respond) as mock:
+        p = sutra.Pipeline(_steps(mock))
+        assert "error" in p.run({"x": 1})["b"]
+        n = mock.stats["requests"]
+        out = p.resume(p.last_run)
+        assert out["b"] == {"ok": True} and mock.stats["requests"] == n + 1   # only b ran again
@@ -0,0 +1,20 @@
+import json
+import socket
+import struct
+import time
+
+import sutra
+
+
+def test_client_reset_is_not_reported(capfd):
+    with sutra.MockOllama(latency=0, token_rate=0) as mock:
+        host, port = mock.url.rsplit("/", 1)[-1].split(":")
+        for _ in range(3):
+            s = socket.create_connection((host, int(port)))
+            body = json.dumps({"model": "mock", "prompt": "hi", "stream": False}).encode()
+            s.sendall(b"POST /api/generate HTTP/1.1\r\nHost: x\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body))
+            s.recv(65536)
+            # reset the kept-alive connection while the server waits for the next request
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0)); s.close()
+        time.sleep(0.2)
+    assert "Traceback" not in capfd.readouterr().err
@@ -0,0 +1,62 @@
+import asyncio
+import time
+
+import sutra
+
+
+def _agent(mock, name, prompt, key):
+    return sutra.Agent(name, "o", "mock", prompt, output_key=key, host=mock.url)
+
+
+def test_dag_runs_independent_steps_in_parallel():
+    with sutra.MockOllama(latency=0.2, token_rate=0) as mock:
+        steps = [sutra.Step(_agent(mock, "a", "A {x}", "a"), takes=["x"]),
+                 sutra.Step(_agent(mock, "b", "B {x}", "b"), takes=["x"]),
+                 sutra.Step(_agent(mock, "c", "C {a} {b}", "c"), takes=["a", "b"])]
+        t0 = time.perf_counter()
+        out = sutra.Pipeline(steps, mode="dag").run({"x": 1})
+        wall = time.perf_counter() - t0
+    assert all(k in out for k in "abc")
+    assert 0.4 <= wall < 0.55   # a and b together, then c
+
+
+def test_async_engine_matches_threaded_run():
+    with sutra.MockOllama(latency=0, token_rate=0) as mock:
+        steps = [sutra.Step(_agent(mock, "a", "A {x}", "a")), sutra.Step(_agent(mock, "b", "B {a}", "b"))]
+        p = sutra.Pipeline(steps)
+        assert asyncio.run(p.arun({"x": 1})) == p.run({"x": 1})
+
+
+def test_conditional_steps_and_branches_skip_model_calls():
+    prompts = []
+    def respond(payload):
+        prompts.append(payload["prompt"][:1])
+        return '{"label": "bug"}'
+    with sutra.MockOllama(latency=0, token_rate=0, respond=respond) as mock:
+        cls = sutra.Agent("cls", "o", "mock", "C {x}", expects_json=True, output_key="cls", host=mock.url)
+        bug = _agent(mock, "bug", "B {cls}", "route")
+        doc = _agent(mock, "doc", "D {cls}", "route")
+        steps = [sutra.Step(cls),
+                 sutra.Step(sutra.Branch("route", "cls.label", {"bug": bug, "docs": doc}), takes=["cls"]),
+                 sutra.Step(_agent(mock, "urgent", "U {x}", "urgent"), when="urgent_flag")]
+        out = sutra.Pipeline(steps).run({"x": 1})
+    assert prompts == ["C", "B"]
+    assert out["urgent"] == {"skipped": "condition not met"}
+
+
+def test_steps_after_a_failure_are_skipped():
+    with sutra.MockOllama(latency=0, token_rate=0) as mock:
+        steps = [sutra.Step(_agent(mock, "a", "A {missing}", "a")), sutra.Step(_agent(mock, "b", "B {a}", "b"))]
+        out = sutra.Pipeline(steps).run({"x": 1})
+    assert "error" in out["a"] and out["b"] == {"skipped": "a failed"} and mock.stats["requests"] == 0
+
+
+def test_run_deadline_bounds_a_slow_pipeline():
+    with sutra.MockOllama(latency=1.0, token_rate=0) as mock:
+        steps = [sutra.Step(_agent(mock, "a", "A {x}", "a")), sutra.Step(_agent(mock, "b", "B {x}", "b"))]
+        t0 = time.perf_counter()
+        out = sutra.Pipeline(steps).run({"x": 1}, deadline=0.3)
+        wall = time.perf_counter() - t0
+    assert wall < 0.6
+    assert out["a"]["error"] == "deadline"
+    assert "skipped" in out["b"] or out["b"].get("error") == "deadline"
@@ -0,0 +1,23 @@
+import sutra
+
+HEADER = "You are a meticulous reviewer of bug reports. " * 40 + "\n\nReport: {x}"
+
+
+def test_shared_prefix_goes_out_as_a_system_message_and_is_reused():
+    seen = []
+    def respond(payload):
+        seen.append(payload.get("messages")); return "ok"
+    with sutra.MockOllama(latency=0, token_rate=0, prompt_rate=20000.0, respond=respond) as mock:
+        a = sutra.Agent("pre", "o", "mock", HEADER, shared_prefix=True, host=mock.url)
+        for i in range(3): assert a.run({"x": f"report {i}"})["output"] == "ok"
+    system, user = seen[0]
+    assert system == {"role": "system", "content": a.prefix()} and user["content"] == "report 0"
+    st = sutra.prefix_stats()["mock/pre"]
+    assert st["reused"] == 2 and st["tokens_saved"] > 0
+
+
+def test_agents_without_shared_prefix_send_one_prompt():
+    seen = []
+    with sutra.MockOllama(latency=0, token_rate=0, respond=lambda p: seen.append(p) or "ok") as mock:
+        sutra.Agent("plain", "o", "mock", HEADER, host=mock.url).run({"x": "r"})
+    assert "messages" not in seen[0] and seen[0]["prompt"].endswith("Report: r")
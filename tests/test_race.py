@@ -0,0 +1,47 @@
+import asyncio
+
+import pytest
+
+import sutra
+
+
+@pytest.fixture
+def mock():
+    m = sutra.MockOllama(latency=0, token_rate=0, respond=lambda payload: "not json").start()
+    yield m
+    m.stop()
+
+
+def _race():
+    return sutra._Race([{"prompt": "a"}, {"prompt": "b"}], accept=lambda raw: False, delay=1.0)
+
+
+def test_quick_invalid_reply_does_not_launch_hedge(mock):
+    race = _race()
+    out = sutra._race(sutra.Ollama("mock", host=mock.url), race)
+    assert [i for i, _ in out] == [0] and list(race.started) == [0]
+    assert mock.stats["requests"] == 1
+
+
+def test_quick_invalid_reply_does_not_launch_hedge_async(mock):
+    race = _race()
+    out = asyncio.run(sutra._arace(sutra.Ollama("mock", host=mock.url), race))
+    assert [i for i, _ in out] == [0] and list(race.started) == [0]
+    assert mock.stats["requests"] == 1
+
+
+def test_slow_call_is_hedged_and_the_hedge_wins():
+    import time
+    seen = []
+    def respond(payload):
+        seen.append(1)
+        if len(seen) == 1: time.sleep(1.0)   # the first call stalls
+        return "done"
+    with sutra.MockOllama(latency=0, token_rate=0, respond=respond) as mock:
+        a = sutra.Agent("hedged", "o", "mock", "Go {x}", hedge=0.9, hedge_budget=1.0, host=mock.url)
+        for _ in range(20): sutra.HEDGES.record(("mock", "hedged"), latency=0.02)
+        t0 = time.monotonic()
+        assert a.run({"x": 1})["output"] == "done"
+        assert time.monotonic() - t0 < 0.5
+    st = sutra.hedge_stats()["mock/hedged"]
+    assert st["hedged"] == 1 and st["wins"] == 1
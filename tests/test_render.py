@@ -0,0 +1,22 @@
+import sutra
+
+
+def test_indexed_template_reads_structured_input():
+    a = sutra.Agent("a", "o", "m", "{analyzer[0][summary]} / {x[score]:.1f} / {x}")
+    p, _ = a.render({"analyzer": [{"summary": "short"}], "x": {"score": 0.25}})
+    assert p == 'short / 0.2 / {"score":0.25}'
+
+
+def test_indexed_template_with_budget_keeps_structure():
+    a = sutra.Agent("a", "o", "m", "{items[0]}", budgets={"items": 5})
+    p, sizes = a.render({"items": ["first", "x" * 200]})
+    assert p == "first" and sizes["truncated"] == ["items"]
+
+
+def test_projected_takes_pass_only_the_path_and_render_compactly():
+    a = sutra.Agent("a", "o", "m", "Issue: {analyzer}")
+    st = sutra.Step(a, takes=["analyzer.issue.description"])
+    state = {"analyzer": [{"issue": {"description": "d1", "lines": [1, 2]}, "noise": "x" * 500}]}
+    sub = st.inputs(state)
+    assert sub == {"analyzer": [{"issue": {"description": "d1"}}]}
+    assert a.render(sub)[0] == 'Issue: [{"issue":{"description":"d1"}}]'
@@ -0,0 +1,50 @@
+import threading
+import time
+
+import sutra
+
+
+def _pipe(mock):
+    return sutra.Pipeline([sutra.Step(sutra.Agent("a", "o", "mock", "Go {x}", host=mock.url))])
+
+
+def test_per_model_is_scoped_to_the_call():
+    with sutra.MockOllama(latency=0.05, token_rate=0) as mock:
+        capped, free = {}, {}
+        def run(pipe, out, **kw):
+            t0 = time.perf_counter()
+            assert len(list(pipe.run_many([{"x": i} for i in range(4)], workers=4, **kw))) == 4
+            out["s"] = time.perf_counter() - t0
+        t = threading.Thread(target=run, args=(_pipe(mock), capped), kwargs={"per_model": 1})
+        t.start(); time.sleep(0.01)
+        assert sutra.MODEL_GATE.limit is None
+        run(_pipe(mock), free)
+        t.join()
+        assert capped["s"] >= 0.2 and free["s"] < 0.15
+
+
+def test_run_many_yields_every_item_in_order_and_keeps_going_past_errors():
+    with sutra.MockOllama(latency=0, token_rate=0) as mock:
+        items = [("a", {"x": 1}), ("b", {"y": 2}), ("c", {"x": 3})]   # b lacks {x}
+        out = list(_pipe(mock).run_many(items, workers=2))
+    assert [k for k, _ in out] == ["a", "b", "c"]
+    assert "result" in out[0][1]["output"] and out[1][1]["output"]["error"]
+    assert out[2][1]["x"] == 3
+
+
+def test_near_duplicates_reuse_their_representatives_outputs():
+    text = "The login page crashes when the password field is left empty on Safari 17."
+    items = [{"x": text}, {"x": text.upper() + "  "}, {"x": "Completely different report about invoices."}]
+    with sutra.MockOllama(latency=0, token_rate=0) as mock:
+        p = _pipe(mock)
+        out = dict(p.run_many(items, workers=2, dedup=0.9))
+        assert mock.stats["requests"] == 2
+    assert out[1]["_dedup"]["of"] == 0 and out[1]["output"] == out[0]["output"] and out[1]["x"] == items[1]["x"]
+    assert "_dedup" not in out[2] and p.last_dedup.stats["calls_avoided"] == 1
+
+
+def test_near_duplicates_keep_at_most_max_size_representatives():
+    nd = sutra.NearDuplicates(0.9, max_size=2)
+    for i, t in enumerate(["alpha beta gamma delta", "one two three four five", "red green blue yellow"]):
+        assert nd.add(i, {"x": t}) is None
+    assert len(nd._reps) == 2 and 0 not in nd._reps
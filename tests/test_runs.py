@@ -0,0 +1,42 @@
+import sutra
+
+
+def _runs(mock):
+    p = sutra.Pipeline([sutra.Step(sutra.Agent("a", "o", "mock", "A {x}", output_key="a", host=mock.url))],
+                       name="hist")
+    p.run({"x": 1}); ok = p.last_run
+    p.run({"y": 1}); bad = p.last_run
+    sutra.Trace.flush()
+    return ok, bad
+
+
+def test_run_store_indexes_and_queries_traces():
+    with sutra.MockOllama(latency=0, token_rate=0) as mock:
+        ok, bad = _runs(mock)
+    store = sutra.RunStore()
+    assert store.sync() == 2
+    assert {r["run_id"] for r in store.query(pipeline="hist")} == {ok, bad}
+    assert [r["run_id"] for r in store.query(status="error")] == [bad]
+    assert store.query(step="a", where={"a": sutra.Trace.load(ok)[1]["a"][0]["a"]})[0]["run_id"] == ok
+
+
+def test_compacted_runs_still_load_and_prune_keeps_errors():
+    with sutra.MockOllama(latency=0, token_rate=0) as mock:
+        ok, bad = _runs(mock)
+    store = sutra.RunStore()
+    assert store.compact(older_than=-1) == 2
+    assert not (sutra.RUNS_DIR / f"{ok}.jsonl").exists()
+    assert sutra.Trace.load(ok)[0] == {"x": 1}
+    assert store.prune(max_age=-1) == 1 and [r["run_id"] for r in store.query()] == [bad]
+
+
+def test_legacy_run_directories_are_dated_by_their_id():
+    import json, time
+    d = sutra.RUNS_DIR / "20200101-120000"
+    d.mkdir(parents=True)
+    (d / "01_a_in.json").write_text(json.dumps({"x": 1}))
+    (d / "02_a_out.json").write_text(json.dumps({"x": 1, "a": "ok"}))
+    store = sutra.RunStore()
+    store.sync()
+    (run,) = store.query()
+    assert run["ts"] == time.mktime(time.strptime("20200101-120000", "%Y%m%d-%H%M%S"))
@@ -0,0 +1,26 @@
+import sutra
+
+
+def _pipeline(mock, models, mode="sequential"):
+    steps = [sutra.Step(sutra.Agent(f"s{j}", "o", m, "Go {x}", output_key=f"o{j}", host=mock.url), takes=["x"])
+             for j, m in enumerate(models)]
+    return sutra.Pipeline(steps, mode=mode)
+
+
+def test_model_stays_loaded_across_chunks():
+    with sutra.MockOllama(latency=0, token_rate=0, max_loaded=1, load_time=0.01) as mock:
+        p = _pipeline(mock, ["mock"])
+        out = list(p.run_stages([{"x": i} for i in range(8)], workers=2, chunk=2, prewarm=False))
+        assert len(out) == 8 and all("o0" in s for _, s in out)
+        assert mock.stats["loads"] == 1
+        assert p.last_schedule["stages"] == 1 and p.last_schedule["switches"] == 0
+        assert not mock.loaded   # unloaded after its last call of the run
+
+
+def test_two_models_switch_only_when_the_model_changes():
+    with sutra.MockOllama(latency=0, token_rate=0, models=("a", "b"), max_loaded=1, load_time=0.01) as mock:
+        p = _pipeline(mock, ["a", "b"], mode="dag")   # independent steps
+        list(p.run_stages([{"x": i} for i in range(6)], workers=2, chunk=3, prewarm=False))
+        # a, then b, then (next chunk) b carries on before a again
+        assert p.last_schedule["switches"] == p.last_schedule["stages"] - 1 == 2
+        assert mock.stats["loads"] == 3
@@ -0,0 +1,47 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+import sutra
+
+PIPE = '''from sutra import Agent, Step, Pipeline
+def build():
+    return Pipeline([Step(Agent("echo", "o", "mock", "Echo {text}"))], name="echo")
+'''
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    mock = sutra.MockOllama(latency=0, token_rate=0).start()
+    monkeypatch.setattr(sutra, "DEFAULT_HOST", mock.url)
+    (tmp_path / "echo.py").write_text(PIPE)
+    app = sutra.PipelineServer([str(tmp_path / "echo.py")], workers=2).start()
+    srv = sutra._ServeServer(("127.0.0.1", 0), sutra._ServeHandler); srv.app = app
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{srv.server_address[1]}", app
+    srv.shutdown(); srv.server_close(); mock.stop()
+
+
+def _post(url, body):
+    req = urllib.request.Request(url, json.dumps(body).encode(), {"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(req, timeout=10) as r: return r.status, json.loads(r.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def test_serve_runs_jobs_on_a_loaded_pipeline(server):
+    url, app = server
+    for _ in range(2):
+        code, job = _post(f"{url}/run/echo", {"text": "hi"})
+        assert code == 200 and job["status"] == "done" and "result" in job["output"]["output"]
+    assert app.stats()["done"] == 2
+
+
+def test_serve_rejects_bad_requests(server):
+    url, _ = server
+    assert _post(f"{url}/run/echo?timeout=abc", {"text": "hi"})[0] == 400
+    assert _post(f"{url}/run/nope", {"text": "hi"})[0] == 404
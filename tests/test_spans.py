@@ -0,0 +1,18 @@
+import sutra
+
+
+def test_spans_nest_and_carry_ollama_counters():
+    spans, metrics = [], sutra.Metrics()
+    with sutra.MockOllama(latency=0, token_rate=0) as mock:
+        p = sutra.Pipeline([sutra.Step(sutra.Agent("a", "o", "mock", "A {x}", host=mock.url))],
+                           name="spans", hooks=[spans.append, metrics])
+        p.run({"x": 1}, trace=False)
+    kinds = {s["kind"]: s for s in spans}
+    assert {"client", "agent", "step"} <= set(kinds)
+    gen = kinds["client"]["attributes"]
+    assert gen["gen_ai.usage.output_tokens"] > 0 and gen["sutra.agent"] == "a"
+    assert kinds["client"]["parent_span_id"] == kinds["agent"]["span_id"]
+    assert kinds["step"]["attributes"]["sutra.model_calls"] == 1   # rolled up
+    text = metrics.prometheus()
+    assert 'sutra_steps_total{pipeline="spans",status="ok",step="a"} 1' in text
+    assert "sutra_generation_duration_seconds_count" in text
@@ -0,0 +1,34 @@
+import pytest
+
+import sutra
+
+REPLIES = ['Step 1 [see note] and [2] then the answer: {"label": "bug", "confidence": 0.9}',
+           '<think>maybe {"label": "x"} no</think>{"label": "bug", "confidence": 0.9}']
+
+
+@pytest.mark.parametrize("reply", REPLIES)
+@pytest.mark.parametrize("required", [[], ["label"]])
+def test_streaming_parses_like_a_plain_call(reply, required):
+    with sutra.MockOllama(latency=0, token_rate=0, respond=lambda payload: reply) as mock:
+        out = {}
+        for stream in (False, True):
+            a = sutra.Agent("s", "o", "mock", "Classify {x}", expects_json=True, required_keys=required,
+                            stream=stream, host=mock.url)
+            out[stream] = a.run({"x": "y"})["output"]
+        assert out[True] == out[False]
+        assert sutra.pick({"o": out[True]}, "o.label") == "bug"
+
+
+def test_scanner_skips_think_split_across_chunks():
+    scan, found = sutra._JsonScanner(), []
+    for piece in ['<thi', 'nk>{"a": 1}</th', 'ink>', '{"b"', ': 2}']:
+        found += scan.feed(piece)
+    assert found == ['{"b": 2}']
+
+
+def test_stream_stops_once_a_complete_reply_arrives():
+    reply = '{"label": "bug"}' + " and some trailing chatter" * 20
+    with sutra.MockOllama(latency=0, token_rate=500, respond=lambda payload: reply) as mock:
+        llm = sutra.Ollama("mock", host=mock.url)
+        text = llm.generate("hi", stream=True, stop_when=lambda obj: "label" in obj)
+    assert llm.last["early_stop"] and text.endswith('{"label": "bug"}')
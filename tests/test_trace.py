@@ -0,0 +1,25 @@
+import json
+
+import sutra
+
+
+def test_trace_records_step_deltas_and_rebuilds_states():
+    with sutra.MockOllama(latency=0, token_rate=0) as mock:
+        steps = [sutra.Step(sutra.Agent("a", "o", "mock", "A {x}", output_key="a", host=mock.url)),
+                 sutra.Step(sutra.Agent("b", "o", "mock", "B {a}", output_key="b", host=mock.url), takes=["a"])]
+        p = sutra.Pipeline(steps, name="t")
+        final = p.run({"x": 1, "big": "y" * 1000}, trace="full")
+    sutra.Trace.flush()
+    lines = [json.loads(l) for l in (sutra.RUNS_DIR / f"{p.last_run}.jsonl").read_text().splitlines()]
+    assert [r["ev"] for r in lines] == ["start", "step", "step", "end"]
+    assert set(lines[2]["out"]) == {"b"} and "big" not in json.dumps(lines[1:])   # deltas, not snapshots
+    assert list(sutra.Trace.states(p.last_run))[-1] == ("b", final)
+
+
+def test_errors_level_writes_only_failed_runs():
+    with sutra.MockOllama(latency=0, token_rate=0) as mock:
+        p = sutra.Pipeline([sutra.Step(sutra.Agent("a", "o", "mock", "A {x}", host=mock.url))])
+        p.run({"x": 1}, trace="errors"); ok = p.last_run
+        p.run({"y": 1}, trace="errors"); bad = p.last_run
+    sutra.Trace.flush()
+    assert not (sutra.RUNS_DIR / f"{ok}.jsonl").exists() and (sutra.RUNS_DIR / f"{bad}.jsonl").exists()